@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""
+Host-level orderbook server.
+
+Decodes the orderbooks of one channel and time frame from the local
+Mongo once and publishes them in multiprocessing.shared_memory segments,
+in the layout of an orderbook cache.  Simulator processes on the host
+attach to the segments read-only and replay the books with
+CachedOrderbooks, so the decode and the memory are paid once per host
+rather than once per partition.
+
+A published channel is described by a directory under $SIM_BOOKS holding
+a cache manifest plus the segment of every array, so find_cache() finds
+it as it would a cache on disk.  The segments live until the server is
+stopped.
+
+Usage: book_server.py <envId> <exchange> <market> <depth> <start> <end>
+"""
+
+import functools
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+from datetime import datetime
+from multiprocessing import resource_tracker, shared_memory
+
+import dateutil.parser
+import numpy as np
+
+from pymongo import MongoClient
+
+from orderbook_cache import (
+    OrderbookCacheWriter, cache_name, find_cache, read_manifest,
+    CACHE_VERSION)
+from orderbooks import Orderbooks
+
+try:
+    profile
+except NameError:
+    profile = lambda x: x
+
+
+@profile
+def decode(orderbooks, writer: OrderbookCacheWriter) -> dict:
+    """Replay orderbooks into writer and return its arrays"""
+
+    count = 0
+
+    try:
+        while True:
+            orderbook = orderbooks.next()
+            writer.append(
+                orderbook, orderbook["buy_trades"], orderbook["sell_trades"])
+            count += 1
+
+    except StopIteration:
+        pass
+
+    logging.info("{0:25}{1:<d}".format('Orderbooks:', count))
+
+    return writer.arrays()
+
+
+def publish(path: str, arrays: dict, manifest: dict) -> list:
+    """
+    Copy arrays into new shared memory segments and describe them in
+    path/manifest.json.  Returns the segments, which must be kept open
+    while they are served and passed to unpublish() when done.
+    """
+
+    segments = []
+    layout = {}
+
+    for name, array in arrays.items():
+
+        array = np.ascontiguousarray(array)
+
+        segment = shared_memory.SharedMemory(
+            create=True, size=max(array.nbytes, 1))
+        segments.append(segment)
+
+        np.ndarray(array.shape, dtype=array.dtype,
+                   buffer=segment.buf)[...] = array
+
+        layout[name] = {
+            "segment": segment.name,
+            "dtype": np.lib.format.dtype_to_descr(array.dtype),
+            "shape": list(array.shape),
+        }
+
+    # Readers never see a partial description
+    tmp_path = path + '.tmp'
+
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    with open(os.path.join(tmp_path, "manifest.json"), 'w') as f:
+        json.dump({
+            **manifest,
+            "version": CACHE_VERSION,
+            "count": len(arrays["ids"]),
+            "pid": os.getpid(),
+            "segments": layout,
+        }, f, indent=4)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+    return segments
+
+
+def unpublish(path: str, segments: list) -> None:
+
+    shutil.rmtree(path, ignore_errors=True)
+
+    for segment in segments:
+        segment.close()
+        segment.unlink()
+
+
+def attach(path: str) -> dict:
+    """
+    The arrays published at path, as read-only views of the segments.
+    Attachments are kept for reuse, so a process simulating several
+    partitions of the channel attaches only once.
+    """
+
+    version = os.stat(os.path.join(path, "manifest.json")).st_mtime_ns
+
+    return attach_segments(path, version)[0]
+
+
+def open_segment(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach to a segment without handing it to the resource tracker,
+    which would unlink it from under the server when this process exits.
+    Before Python 3.13 attaching always registers, so registration is
+    suppressed for the call.
+    """
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    except TypeError:
+        pass
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+
+    try:
+        return shared_memory.SharedMemory(name=name)
+
+    finally:
+        resource_tracker.register = register
+
+
+@functools.lru_cache(maxsize=8)
+def attach_segments(path: str, version: int) -> tuple:
+
+    manifest = read_manifest(path)
+
+    if manifest == None or "segments" not in manifest:
+        raise FileNotFoundError('Not Published: ' + path)
+
+    arrays = {}
+    segments = []
+
+    for name, layout in manifest["segments"].items():
+
+        try:
+            segment = open_segment(layout["segment"])
+
+        except OSError:
+            for segment in segments:
+                segment.close()
+            raise
+
+        segments.append(segment)
+
+        array = np.ndarray(
+            tuple(layout["shape"]),
+            dtype=np.lib.format.descr_to_dtype(layout["dtype"]),
+            buffer=segment.buf)
+        array.flags.writeable = False
+
+        arrays[name] = array
+
+    # The segments stay open as long as their arrays are cached
+    return arrays, segments
+
+
+def serving(manifest: dict) -> bool:
+    """Whether the server that published manifest is still running"""
+
+    try:
+        os.kill(manifest["pid"], 0)
+
+    except ProcessLookupError:
+        return False
+
+    except PermissionError:
+        pass
+
+    except (KeyError, TypeError):
+        return False
+
+    return True
+
+
+def find_books(
+    envId: int,
+    exchange: str,
+    market: str,
+    depth: float,
+    start: datetime,
+    end: datetime,
+) -> str:
+    """
+    The path of published books covering the partition, or None.  Books
+    left behind by a server that was killed are skipped, as their
+    segments may be gone.
+    """
+
+    books_dir = os.environ.get('SIM_BOOKS')
+
+    if not books_dir:
+        return None
+
+    return find_cache(envId, exchange, market, depth, start, end, books_dir,
+                      usable=serving)
+
+
+def serve(
+    orderbooks_collection,
+    *,
+    envId: int,
+    exchange: str,
+    market: str,
+    depth: float,
+    start: datetime,
+    end: datetime,
+) -> None:
+    """Publish the channel's orderbooks until SIGINT or SIGTERM"""
+
+    assert os.environ['SIM_BOOKS'], 'SIM_BOOKS Not Defined'
+
+    path = os.path.join(
+        os.environ['SIM_BOOKS'],
+        f'{cache_name(envId, exchange, market, depth)}-{os.getpid()}')
+
+    writer = OrderbookCacheWriter(
+        path,
+        envId=envId,
+        exchange=exchange,
+        market=market,
+        depth=depth,
+        trim=depth > 0,
+        start=start,
+        end=end,
+    )
+
+    arrays = decode(
+        Orderbooks(
+            orderbooks_collection=orderbooks_collection,
+            envId=envId,
+            exchange=exchange,
+            market=market,
+            depth=depth,
+            start=start,
+            end=end,
+        ),
+        writer)
+
+    segments = publish(path, arrays, writer.manifest)
+    del arrays
+
+    logging.info("{0:25}{1}".format('Serving:', path))
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        while True:
+            signal.pause()
+
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+    finally:
+        unpublish(path, segments)
+        logging.info("{0:25}{1}".format('Stopped:', path))
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        format='[%(levelname)-5s] %(message)s',
+        level=logging.INFO,
+        datefmt='')
+
+    assert len(sys.argv) == 7, __doc__
+
+    assert os.environ['LOCALDB'], 'LOCALDB Not Defined'
+    local_sim_db = MongoClient(os.environ['LOCALDB'])['sim']
+
+    try:
+        serve(
+            local_sim_db.orderbooks,
+            envId=int(sys.argv[1]),
+            exchange=sys.argv[2].lower(),
+            market=sys.argv[3].lower(),
+            depth=float(sys.argv[4]),
+            start=dateutil.parser.parse(sys.argv[5]),
+            end=dateutil.parser.parse(sys.argv[6]),
+        )
+
+    except StopIteration:
+        logging.info("No Orderbooks")
@@ -72,77 +72,98 @@ class Co2Validator:
 
         self.trader = Trader(bot_config)
 
+    # Keys the bot writes for each cycle, fetched together
+    FIELDS = (
+        "buy_rates",
+        "buy_quantities",
+        "sell_rates",
+        "sell_quantities",
+        "buy_candidate_rates",
+        "sell_candidate_rates",
+    )
+
+    @staticmethod
+    def parse(raw: str) -> np.array:
+        """Comma terminated floats as a (1, n) array"""
+        return np.fromstring(raw[0:-1], sep=',').reshape(1, -1)
+
     def redis_get(self, cycle_time, field):
-        raw = self.r.get(":".join([cycle_time, field]))
-        raw = raw[0:-1]  # Remove the dangling comma
-        raw = raw.split(',')
-        raw = [float(i) for i in raw]
-        return np.array([raw])
+        return self.parse(self.r.get(":".join([cycle_time, field])))
 
-    def run(self):
+    def fetch_cycle(self, cycle_time) -> dict:
+        """All of a cycle's fields in a single round trip"""
 
-        try:
+        values = self.r.mget(
+            [":".join([cycle_time, field]) for field in self.FIELDS])
 
-            p = self.r.pubsub()
-            p.psubscribe('*')
+        return {
+            field: self.parse(raw) for field, raw in zip(self.FIELDS, values)
+        }
+
+    def validate(self, message: dict):
+
+        np.set_printoptions(precision=12)
+        np.set_printoptions(suppress=True)
 
-            while True:
-                # print("Waiting...")
-                message = p.get_message()
+        logging.fatal("")
 
-                if message != None:
+        rx_msg = json.loads(message["data"])
 
-                    if message['type'] == 'pmessage':
+        cycle_time, rust_buy_rate, rust_sell_rate = itemgetter(
+            'cycle_time', 'buy_rate', 'sell_rate')(rx_msg)
 
-                        np.set_printoptions(precision=12)
-                        np.set_printoptions(suppress=True)
+        logging.error("Cycle Time: %r", cycle_time)
 
-                        logging.fatal("")
+        cycle = self.fetch_cycle(cycle_time)
 
-                        rx_msg = json.loads(message["data"])
+        # buyOB
+        buy_rates = cycle["buy_rates"]
+        buy_quantities = cycle["buy_quantities"]
 
-                        cycle_time, rust_buy_rate, rust_sell_rate = itemgetter(
-                            'cycle_time', 'buy_rate', 'sell_rate')(rx_msg)
+        assert buy_rates.size == buy_quantities.size
 
-                        logging.error("Cycle Time: %r", cycle_time)
+        buyob = np.vstack((buy_rates, buy_quantities)).T
+        logging.debug('buyob:\n%r', buyob)
 
-                        # buyOB
-                        buy_rates = self.redis_get(cycle_time, "buy_rates")
-                        buy_quantities = self.redis_get(cycle_time,
-                                                   "buy_quantities")
+        # sellOB
+        sell_rates = cycle["sell_rates"]
+        sell_quantities = cycle["sell_quantities"]
 
-                        assert buy_rates.size == buy_quantities.size
+        assert sell_rates.size == sell_quantities.size
 
-                        buyob = np.vstack((buy_rates, buy_quantities)).T
-                        logging.debug('buyob:\n%r', buyob)
+        sellob = np.vstack((sell_rates, sell_quantities)).T
+        logging.debug('sellob:\n%r', sellob)
 
-                        # sellOB
-                        sell_rates = self.redis_get(cycle_time, "sell_rates")
-                        sell_quantities = self.redis_get(cycle_time,
-                                                    "sell_quantities")
+        # buy_rates
+        buy_rates_ref = np.flip(cycle["buy_candidate_rates"][0])
+        assert buy_rates_ref.size > 0
 
-                        assert sell_rates.size == sell_quantities.size
+        # sell_rates
+        sell_rates_ref = np.flip(cycle["sell_candidate_rates"][0])
+        assert sell_rates_ref.size > 0
 
-                        sellob = np.vstack((sell_rates, sell_quantities)).T
-                        logging.debug('sellob:\n%r', sellob)
+        timer = Timer()
+        buy_rate, sell_rate = self.trader.compute_orders(
+            buyob, sellob)
 
-                        # buy_rates
-                        buy_rates_ref = np.flip(
-                            self.redis_get(cycle_time, "buy_candidate_rates")[0])
-                        assert buy_rates_ref.size > 0
+        logging.error(
+            "Elapsed Time: %f, buy_rate: %f, sell_rate: %f",
+            timer(), buy_rate, sell_rate)
 
-                        # sell_rates
-                        sell_rates_ref = np.flip(
-                            self.redis_get(cycle_time, "sell_candidate_rates")[0])
-                        assert sell_rates_ref.size > 0
+        return buy_rate, sell_rate
+
+    def run(self):
+
+        try:
+
+            p = self.r.pubsub()
+            p.psubscribe('*')
 
-                        timer = Timer()
-                        buy_rate, sell_rate = self.trader.compute_orders(
-                            buyob, sellob)
+            # Blocks until the bot publishes the next cycle
+            for message in p.listen():
 
-                        logging.error(
-                            "Elapsed Time: %f, buy_rate: %f, sell_rate: %f",
-                            timer(), buy_rate, sell_rate)
+                if message['type'] == 'pmessage':
+                    self.validate(message)
 
         except StopIteration:
             assert False  # Must not be here
@@ -22,6 +22,7 @@ from orderbooks import Orderbooks
 import numpy as np
 from numpy import array
 from match_result import MatchResult
+from redis_drain import drain
 import functools
 import redis
 from pickle import loads, dumps
@@ -90,72 +91,34 @@ def run():
     r = redis.Redis(encoding=u'utf-8', decode_responses=True, db=0)
 
     # Move the sim:trades to the main db
-    sim_trade_list_keys = ":".join([partition_id, "sim:trades"])
-    sim_trade_keys = r.lrange (sim_trade_list_keys, 0, -1)
-
-    logging.debug ("sim_trade_keys: %r", sim_trade_keys)
-    logging.debug ("Sim Trades: %d", len(sim_trade_keys))
     logging.debug (
         "Before sim_db.trades.count_documents({}): %d", 
         sim_db.trades.count_documents({}))    
 
-    sim_trades = []
-    for sim_trade_key in sim_trade_keys:
-
-        sim_trade = r.hgetall (sim_trade_key)
-        assert 'runId' in sim_trade, 'Corrupt Sim Trade'
-
-        sim_trade["runId"] = ObjectId(sim_trade["runId"])
-        sim_trade["ob"] = ObjectId(sim_trade["ob"])
-        sim_trade["s"] = ObjectId(sim_trade["s"])
-        sim_trade["p"] = ObjectId(sim_trade["p"])
-
-        sim_trades.append (sim_trade)
-
-    # Cleanup
-    for sim_trade_key in sim_trade_keys:
-        r.delete (sim_trade_key)
-
-    if len(sim_trades) > 0:
-        sim_db.trades.insert_many (sim_trades)
+    sim_trade_count = drain(
+        r,
+        ":".join([partition_id, "sim:trades"]),
+        sim_db.trades,
+        required='runId',
+    )
 
+    logging.debug ("Sim Trades: %d", sim_trade_count)
     logging.debug (
         "After sim_db.trades.count_documents({}): %d", 
         sim_db.trades.count_documents({})) 
 
-    # Cleanup
-    r.delete (sim_trade_list_keys)
-
     # Move the matchings to the main db
-    matching_list_keys = ":".join([partition_id, "matchings"])
-    matching_keys = r.lrange (matching_list_keys, 0, -1)
-
-    # logging.error ("matching_keys: %r", matching_keys)
-    logging.debug ("len(matching_keys): %d", len(matching_keys))
     logging.debug (
         "Before sim_db.matchings.count_documents({}): %d", 
         sim_db.matchings.count_documents({}))    
 
-    matchings = []
-    for matching_key in matching_keys:
-
-        matching = r.hgetall (matching_key)
-
-        matching["runId"] = ObjectId(matching["runId"])
-        matching["ob"] = ObjectId(matching["ob"])
-        matching["s"] = ObjectId(matching["s"])
-        matching["p"] = ObjectId(matching["p"])
-
-        # Cleanup as we go
-        r.delete (matching_key)
-
-        matchings.append (matching)
-
-    sim_db.matchings.insert_many (matchings)
+    matching_count = drain(
+        r,
+        ":".join([partition_id, "matchings"]),
+        sim_db.matchings,
+    )
 
-    # Cleanup as we go
-    r.delete (matching_list_keys)
-   
+    logging.debug ("Matchings: %d", matching_count)
     logging.debug ("After sim_db.matchings.count_documents({}): %d", sim_db.matchings.count_documents({}))
 
 if __name__ == '__main__':
@@ -0,0 +1,222 @@
+import logging
+import queue
+import threading
+
+from bson import json_util
+
+from stage_timer import NULL_STAGE, StageTimer
+
+try:
+    profile
+except NameError:
+    profile = lambda x: x
+
+
+class DocumentSink:
+    """
+    Buffers documents and hands them to the backend in batches of
+    batch_size.  Whatever is still buffered is written by flush() or
+    close(); callers must close the sink at the end of a partition.
+    """
+
+    batch_size: int
+    written_count: int = 0
+
+    # Times the batch writes when set
+    timer: StageTimer = None
+
+    def __init__(self, *, batch_size: int = 1000):
+
+        assert batch_size > 0
+
+        self.batch_size = batch_size
+        self.buffer = []
+
+    def __str__(self):
+        return str(self.__class__) + '\n' + '\n'.join(
+            '{} = {}'.format(
+                item,
+                self.__dict__[item]) for item in self.__dict__)
+
+    @profile
+    def write(self, document: dict) -> None:
+
+        self.buffer.append(document)
+
+        if len(self.buffer) >= self.batch_size:
+            self.send_buffer()
+
+    def send_buffer(self) -> None:
+
+        if len(self.buffer) > 0:
+
+            batch = self.buffer
+            self.buffer = []
+
+            with self.timer.stage("writes") if self.timer != None \
+                    else NULL_STAGE:
+                self.write_batch(batch)
+
+            self.written_count += len(batch)
+
+    def flush(self) -> None:
+        self.send_buffer()
+
+    def close(self) -> None:
+        self.flush()
+
+    def write_batch(self, documents: list) -> None:
+        raise NotImplementedError
+
+
+class MongoSink(DocumentSink):
+    """Writes each batch with a single unordered insert_many"""
+
+    def __init__(self, collection, *, batch_size: int = 1000):
+
+        super().__init__(batch_size=batch_size)
+        self.collection = collection
+
+    def write_batch(self, documents: list) -> None:
+        self.collection.insert_many(documents, ordered=False)
+
+
+class FileSink(DocumentSink):
+    """Appends each document to a local file as one line of extended JSON"""
+
+    def __init__(self, path: str, *, batch_size: int = 1000):
+
+        super().__init__(batch_size=batch_size)
+        self.path = path
+
+    def write_batch(self, documents: list) -> None:
+
+        with open(self.path, 'a') as f:
+            f.writelines(
+                json_util.dumps(document) + '\n' for document in documents)
+
+
+class MemorySink(DocumentSink):
+    """Keeps every document in memory, e.g. for tuning sweeps and tests"""
+
+    def __init__(self, *, batch_size: int = 1000):
+
+        super().__init__(batch_size=batch_size)
+        self.documents = []
+
+    def write_batch(self, documents: list) -> None:
+        self.documents.extend(documents)
+
+
+class LogSink(DocumentSink):
+    """Logs every document at debug level"""
+
+    def write_batch(self, documents: list) -> None:
+        for document in documents:
+            logging.debug('%s', json_util.dumps(document))
+
+
+class StreamingSink(DocumentSink):
+    """
+    Hands each full batch to a background thread that writes it through
+    another sink, so the caller keeps working while the batch is sent.
+    At most max_pending batches wait to be written; beyond that write()
+    blocks until the writer catches up, which keeps memory bounded no
+    matter how long the run is.
+    """
+
+    def __init__(
+        self,
+        sink: DocumentSink,
+        *,
+        batch_size: int = 1000,
+        max_pending: int = 4,
+    ):
+
+        super().__init__(batch_size=batch_size)
+
+        self.sink = sink
+        self.error = None
+        self.pending = queue.Queue(maxsize=max_pending)
+
+        self.writer = threading.Thread(target=self.drain, daemon=True)
+        self.writer.start()
+
+    def drain(self) -> None:
+
+        while True:
+
+            batch = self.pending.get()
+
+            try:
+                if batch is None:
+                    return
+
+                # After a failure, discard the rest; the error is raised
+                # to the caller by its next write, flush or close
+                if self.error is None:
+                    self.sink.write_batch(batch)
+
+            except Exception as err:
+                logging.exception('Exception: %s', err)
+                self.error = err
+
+            finally:
+                self.pending.task_done()
+
+    def check(self) -> None:
+
+        if self.error is not None:
+            raise self.error
+
+    def write_batch(self, documents: list) -> None:
+
+        self.check()
+
+        # Blocks while max_pending batches are outstanding
+        self.pending.put(documents)
+
+    def flush(self) -> None:
+
+        self.send_buffer()
+
+        # Wait for the writer to catch up
+        self.pending.join()
+        self.check()
+
+    def close(self) -> None:
+
+        try:
+            self.flush()
+
+        finally:
+            # Stop the writer thread, even if the last batches failed
+            if self.writer.is_alive():
+                self.pending.put(None)
+                self.writer.join()
+
+
+def make_sink(
+    kind: str,
+    *,
+    collection=None,
+    path: str = None,
+    batch_size: int = 1000,
+) -> DocumentSink:
+
+    if kind == "mongo":
+        assert collection != None, 'Collection Required'
+        return MongoSink(collection, batch_size=batch_size)
+
+    elif kind == "file":
+        assert path, 'Path Required'
+        return FileSink(path, batch_size=batch_size)
+
+    elif kind == "memory":
+        return MemorySink(batch_size=batch_size)
+
+    elif kind == "log":
+        return LogSink(batch_size=batch_size)
+
+    else:
+        raise Exception(f'Unknown Sink: {kind}')
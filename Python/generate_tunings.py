@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import tuning_generator
+
+
+def init_worker():
+
+    logging.basicConfig(
+        format='[%(levelname)-5s] %(message)s',
+        level=logging.ERROR,
+        datefmt='')
+
+    # One connection per worker, reused for every config it generates
+    tuning_generator.connect()
+
+
+def run_config(name: str) -> tuple:
+
+    start = time.time()
+
+    config, tuning = tuning_generator.generate_tuning(name)
+
+    return config, tuning, time.time() - start
+
+
+def get_config_names(config_db, args: list) -> list:
+    """
+    The args are config names, or a single JSON filter on the
+    generate.tuning configs; with no args every config is generated.
+    """
+
+    if len(args) == 1 and args[0].startswith('{'):
+        query = json.loads(args[0])
+    elif len(args) == 0:
+        query = {}
+    else:
+        return args
+
+    return [config["name"] for config in config_db["generate.tuning"].find(
+        filter=query, projection={"_id": 0, "name": 1})]
+
+
+def generate_tunings(
+    config_db,
+    names: list,
+    pool,
+    *,
+    batch_size: int = 50,
+) -> int:
+    """
+    Generate the configs' tunings on pool and upsert them batch_size at
+    a time.  A failed config does not stop the others from being saved.
+    Returns the return code (0 if every config succeeded).
+    """
+
+    failures = 0
+    requests = []
+
+    def flush():
+        if len(requests) > 0:
+            config_db["tuning"].bulk_write(requests, ordered=False)
+            requests.clear()
+
+    futures = {pool.submit(run_config, name): name for name in names}
+
+    for future in as_completed(futures):
+
+        name = futures[future]
+
+        try:
+            config, tuning, elapsed = future.result()
+
+        except Exception as err:
+            logging.exception('Exception: %s', err)
+            failures += 1
+            logging.info("{0:30}{1:10}".format(f'{name}:', "FAILED"))
+            continue
+
+        if tuning == None:
+            status = "NO TRADES"
+        else:
+            status = "COMPLETE"
+            requests.append(tuning_generator.tuning_upsert(config, tuning))
+
+        logging.info("{0:30}{1:10}{2:8.1f}".format(
+            f'{name}:', status, elapsed))
+
+        if len(requests) >= batch_size:
+            flush()
+
+    flush()
+
+    return 1 if failures > 0 else 0
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        format='[%(levelname)-5s] %(message)s',
+        level=logging.INFO,
+        datefmt='')
+
+    start_execution = time.time()
+
+    config_db = tuning_generator.connect()["configuration"]
+
+    names = get_config_names(config_db, sys.argv[1:])
+
+    # One worker per core unless TUNING_WORKERS says otherwise
+    workers = int(os.environ.get('TUNING_WORKERS', os.cpu_count()))
+
+    # Tunings are upserted this many at a time
+    batch_size = int(os.environ.get('TUNING_BATCH', 50))
+
+    logging.info("{0:30}{1:<d}".format("Configs:", len(names)))
+    logging.info("{0:30}{1:<d}".format("Workers:", workers))
+
+    # Spawned, so that no MongoClient is shared across a fork
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker) as pool:
+
+        returncode = generate_tunings(
+            config_db, names, pool, batch_size=batch_size)
+
+    logging.info(
+        "{0:30}{1:4.1f}".format(
+            'Execution Time (secs):', time.time() - start_execution))
+
+    sys.exit(returncode)
@@ -27,48 +27,71 @@ import functools
 import time
 from get_object_size import get_object_size
 import redis
+from redis_export import RedisExporter
 from pickle import loads, dumps
 import json
+from orderbook_cache import OrderbookCacheWriter, cache_path
+from trade_records import trades_sorted
 
 try:
     profile
 except NameError:
     def profile(x): return x
         
-orderbook_trades = {}
-
-
-def get_trades(
+def group_trades(
     trades,
     envId: int,
     exchange: str,
     market: str,
-    start: datetime,
-    end: datetime,
-):
+    orderbook_ids: list,
+    *,
+    chunk_size: int = 1000,
+) -> dict:
+    """
+    Fetch the trades of many orderbooks with one query per chunk_size
+    orderbooks and group them by orderbook id.  Each entry is the
+    (buy_trades, sell_trades) pair find_trades would give the orderbook.
+    """
 
-    try:
+    assert chunk_size > 0
+
+    orderbook_trades = {}
+
+    for start in range(0, len(orderbook_ids), chunk_size):
 
         filter = {
             "e": envId,
             "x": exchange,
             "m": market,
-            "ts": {
-                "$gte": start,
-                "$lte": end,
-            }
+            "ob": {
+                "$in": orderbook_ids[start:start + chunk_size]
+            },
         }
 
-        for trade in trades.find(filter):
+        for trade in trades.find(filter=filter, batch_size=10000):
 
-            if "ob" in trade:
-                if trade["ob"] in orderbook_trades:
-                    orderbook_trades[trade["ob"]].append(trade)
-                else:
-                    orderbook_trades[trade["ob"]] = [trade]
+            if trade["ob"] not in orderbook_trades:
+                orderbook_trades[trade["ob"]] = ([], [])
 
-    except Exception as err:
-        logging.exception(err)
+            buy_trades, sell_trades = orderbook_trades[trade["ob"]]
+
+            # Corral the buy and sell trades into separate lists
+            if trade['buy']:
+                buy_trades.append(trade)
+            else:
+                sell_trades.append(trade)
+
+    for buy_trades, sell_trades in orderbook_trades.values():
+
+        # Sort the buy trades into decreasing order
+        buy_trades.sort(key=operator.itemgetter('r'),
+                        reverse=True)
+
+        # Sort the sell trades into increasing order
+        sell_trades.sort(key=operator.itemgetter('r'),
+                         reverse=False)
+
+    return orderbook_trades
 
 
 def check(conf_schema, conf):
@@ -92,16 +115,28 @@ def find_trades(trades, filter):
         else:
             sell_trades.append(trade)
 
-        # Sort the buy trades into decreasing order
-        buy_trades.sort(key=operator.itemgetter('r'),
-                        reverse=True)
+    # Sort the buy trades into decreasing order
+    buy_trades.sort(key=operator.itemgetter('r'),
+                    reverse=True)
 
-        # Sort the sell trades into increasing order
-        sell_trades.sort(key=operator.itemgetter('r'),
-                         reverse=False)
+    # Sort the sell trades into increasing order
+    sell_trades.sort(key=operator.itemgetter('r'),
+                     reverse=False)
 
     return buy_trades, sell_trades
 
+
+def close_exports(cache_writer, redis_exporter):
+    """Finish whichever of the cache and Redis exports are enabled"""
+
+    if cache_writer != None:
+        cache_writer.close()
+        logging.info("{0:25}{1}".format('Cache:', cache_writer.path))
+
+    if redis_exporter != None:
+        redis_exporter.close()
+
+
 if __name__ == '__main__':
 
     returncode = 0
@@ -189,16 +224,6 @@ if __name__ == '__main__':
                 'End Time:', 
                 str(config["timeFrame"]["endTime"])))
 
-        trades = remote_mongo_client.history.trades
-        get_trades(
-            trades=trades,
-            envId=config["envId"],
-            exchange=config["exchange"],
-            market=config["market"],
-            start=config["timeFrame"]["startTime"],
-            end=config["timeFrame"]["endTime"],
-        )
-
         # Get first and last orderbook
         first_orderbook = Orderbooks.get_first_orderbook(
             envId=config["envId"],
@@ -282,11 +307,30 @@ if __name__ == '__main__':
                 depth=config["depth"],
                 start=config["timeFrame"]["startTime"],
                 end=config["timeFrame"]["endTime"],
+                checkpoints_collection=
+                    remote_mongo_client.history.orderbook_checkpoints
+                    if config.get("useCheckpoints", False) else None,
             )
 
         except StopIteration:
             os._exit(0)
 
+        # Either fetch the trades of all replayed orderbooks up front
+        # (batchTrades) or query them per orderbook as it is replayed
+        batch_trades = config.get("batchTrades", False)
+
+        if batch_trades:
+            orderbook_trades = group_trades(
+                trades=trades,
+                envId=config["envId"],
+                exchange=config["exchange"],
+                market=config["market"],
+                orderbook_ids=[
+                    ob["_id"] for ob in input_orderbooks.find(
+                        filter=orderbooks.replay_filter,
+                        projection={"_id": True})],
+            )
+
         orderbook = None
 
         total_orderbooks = 0
@@ -294,6 +338,27 @@ if __name__ == '__main__':
         last_ob_timestamp = None
         corrupt_orderbooks = 0
         
+        # Optionally also write a columnar cache for repeated simulations
+        cache_writer = None
+
+        if config.get("saveCache", False):
+            cache_writer = OrderbookCacheWriter(
+                cache_path(
+                    config["envId"],
+                    config["exchange"],
+                    config["market"],
+                    config["depth"],
+                    start=config["timeFrame"]["startTime"],
+                    end=config["timeFrame"]["endTime"]),
+                envId=config["envId"],
+                exchange=config["exchange"],
+                market=config["market"],
+                depth=config["depth"],
+                trim=config["trim"],
+                start=config["timeFrame"]["startTime"],
+                end=config["timeFrame"]["endTime"],
+            )
+
         r = redis.Redis(
             host='localhost', 
             port=6379, 
@@ -301,6 +366,15 @@ if __name__ == '__main__':
             decode_responses=True, 
             db=0)
 
+        # Orderbooks are exported to Redis through a batched pipeline.
+        # Packed columns are written as bytes, which r sends as is; only
+        # a client with decode_responses=False can read them back.
+        redis_exporter = RedisExporter(
+            r,
+            books_per_pipeline=config.get("redisPipelineBooks", 100),
+            packed=config.get("redisPacked", False),
+        ) if config["saveRedis"] else None
+
         try:
 
             while True:
@@ -321,13 +395,18 @@ if __name__ == '__main__':
                 sim_config.orderbook_id = orderbook['_id']
 
                 # Get all trades associated with the orderbook
-                filter = {
-                    "e": orderbook['e'],
-                    "x": orderbook['x'],
-                    "m": orderbook['m'],
-                    "ob": orderbook['_id'],
-                }
-                buy_trades, sell_trades = find_trades(trades, filter)
+                if batch_trades:
+                    buy_trades, sell_trades = orderbook_trades.pop(
+                        orderbook['_id'], ([], []))
+
+                else:
+                    filter = {
+                        "e": orderbook['e'],
+                        "x": orderbook['x'],
+                        "m": orderbook['m'],
+                        "ob": orderbook['_id'],
+                    }
+                    buy_trades, sell_trades = find_trades(trades, filter)
 
                 for x in buy_trades:
                     x["_id"] = str(x["_id"])
@@ -365,26 +444,45 @@ if __name__ == '__main__':
 
                     depth = config["depth"]
 
+                    # The levels are saved with aggregates recomputed
+                    # for the saved levels
+                    buy_notional = orderbook.pop('buyNotional', None)
+                    sell_notional = orderbook.pop('sellNotional', None)
+                    orderbook.pop('buyQuantity', None)
+                    orderbook.pop('sellQuantity', None)
+
                     orderbook['buy'] = \
-                        Orderbooks.apply_depth(depth, orderbook['buy']) \
+                        Orderbooks.apply_depth(
+                            depth, orderbook['buy'], buy_notional) \
                         if config["trim"] else orderbook['buy']
 
                     orderbook['sell'] = \
-                        Orderbooks.apply_depth(depth, orderbook['sell']) \
+                        Orderbooks.apply_depth(
+                            depth, orderbook['sell'], sell_notional) \
                         if config["trim"] else orderbook['sell']
 
                     buy_trades_count += len(buy_trades)
                     sell_trades_count += len(sell_trades)
 
+                    aggregates = Orderbooks.aggregates(
+                        orderbook['buy'], orderbook['sell'],
+                        buy_notional, sell_notional)
+
+                    # Checked once here rather than on every simulation
+                    aggregates["tradesSorted"] = \
+                        trades_sorted(buy_trades, sell_trades)
+
                     insertObj = {
                         **orderbook,
+                        **aggregates,
                         **{"buy_trades": buy_trades},
                         **{"sell_trades": sell_trades}
                     }
 
                     # Can't save numpy arrays hence convert OBs to list
-                    insertObj['buy'] = insertObj['buy'].tolist()
-                    insertObj['sell'] = insertObj['sell'].tolist()
+                    for key in ('buy', 'sell', 'buyNotional', 'sellNotional',
+                                'buyQuantity', 'sellQuantity'):
+                        insertObj[key] = insertObj[key].tolist()
 
                     try:
                         local_sim_db.orderbooks.replace_one(
@@ -395,88 +493,19 @@ if __name__ == '__main__':
                     except pymongo.errors.DuplicateKeyError:
                         pass
 
-                    if config["saveRedis"]:
-                        redis_key = str(orderbook['e']) + ':' + orderbook['x'] + ':' + orderbook['m']
-                        redis_score = int(orderbook["ts"].timestamp()*1000)
-
-                        r.zadd (redis_key, {str(orderbook['_id']): redis_score} )
-
-                        # load buy_trades
-                        score = 0
-                        for t in buy_trades:
-                            hmset_key = ":".join([str(orderbook['_id']), str(score), "buy_trades"])
-                            r.hmset (
-                                hmset_key, {
-                                "_id": str(t["_id"]).encode(),
-                                "e": t['e'],
-                                "x": t['x'].encode(),
-                                "m": t['m'].encode(),
-                                "ts": str(t['ts']).encode(),
-                                "ob": str(t['ob']).encode(),
-                                "r": t['r'],
-                                "q": t['q'],
-                            }) 
-                            r.zadd (
-                                ":".join([
-                                    str(orderbook['_id']), 
-                                    "buy_trades",
-                                    ]), 
-                                {hmset_key : score} )
-                            score += 1
-
-                        # load sell_trades
-                        score = 0
-                        for t in sell_trades:
-                            hmset_key = ":".join([str(orderbook['_id']), str(score), "sell_trades"])
-                            r.hmset (
-                                hmset_key, {
-                                "_id": str(t["_id"]).encode(),
-                                "e": t['e'],
-                                "x": t['x'].encode(),
-                                "m": t['m'].encode(),
-                                "ts": str(t['ts']).encode(),
-                                "ob": str(t['ob']).encode(),
-                                "r": t['r'],
-                                "q": t['q'],
-                            }) 
-                            r.zadd (
-                                ":".join([
-                                    str(orderbook['_id']), 
-                                    "sell_trades",
-                                    ]), 
-                                {hmset_key : score} )
-                            score += 1
-
-                        r.hmset (str(orderbook['_id']), {
-                            "e": orderbook['e'],
-                            "x": orderbook['x'].encode(),
-                            "m": orderbook['m'].encode(),
-                            "ts": str(orderbook['ts']).encode(),
-                            "N": orderbook['N'],
-                            "V": str(orderbook['V']).encode(),
-                        })
-
-                        buy_rates_key = ":".join([str(orderbook['_id']),"buy_rates"])
-                        r.delete (buy_rates_key)
-                        r.rpush (buy_rates_key, *orderbook['buy'][:, 0])
-
-                        buy_quantities_key = ":".join([str(orderbook['_id']),"buy_quantities"])
-                        r.delete (buy_quantities_key)
-                        r.rpush (buy_quantities_key, *orderbook['buy'][:, 1])
-
-                        sell_rates_key = ":".join([str(orderbook['_id']),"sell_rates"])
-                        r.delete (sell_rates_key)
-                        r.rpush (sell_rates_key, *orderbook['sell'][:, 0])
-
-                        sell_quantities_key = ":".join([str(orderbook['_id']),"sell_quantities"])
-                        r.delete (sell_quantities_key)
-                        r.rpush (sell_quantities_key, *orderbook['sell'][:, 1])
+                    if cache_writer != None:
+                        cache_writer.append(orderbook, buy_trades, sell_trades)
+
+                    if redis_exporter != None:
+                        redis_exporter.add(orderbook, buy_trades, sell_trades)
 
 
         except StopIteration:
             if orderbooks.corrupt_order_book_count > 0:
                 logging.info(f'Corrupt Orderbook Count:  {orderbooks.corrupt_order_book_count}')
 
+            close_exports(cache_writer, redis_exporter)
+
             returncode = 0
 
         except KeyError as err:
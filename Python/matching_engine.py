@@ -16,8 +16,12 @@ import numpy
 from bson.objectid import ObjectId
 from schema import And, Optional, Schema, SchemaError, Use
 
+import matching_kernel
 import sim_config
+import sim_trace
+from document_sink import DocumentSink, MongoSink
 from match_result import MatchResult
+from trade_records import trade_arrays, trade_at, trade_columns
 import numpy as np
 
 try:
@@ -26,14 +30,44 @@ except NameError:
     def profile(x): return x
 
 
+class Assets:
+    """A live, read-only view of a MatchingEngine's funds and inventory"""
+
+    __slots__ = ("engine",)
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        yield self.engine.funds
+        yield self.engine.inventory
+
+    def __getitem__(self, i):
+        return (self.engine.funds, self.engine.inventory)[i]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(list(self), dtype=dtype or float)
+
+    def __repr__(self):
+        return 'Assets({0!r}, {1!r})'.format(*self)
+
+    def tolist(self) -> list:
+        return list(self)
+
+
 class MatchingEngine:
 
-    assets: np.array
+    funds: float
+    inventory: float
     QL: float
     IL: float
     actual_fee_rate: float
     min_notional: float
     trades_collection = None
+    trade_sink: DocumentSink = None
     buy_blocked_count: int = 0
     buy_no_trades_count: int = 0
     buy_notion_failure_count: int = 0
@@ -47,6 +81,9 @@ class MatchingEngine:
 
     sim_trades_idx: int = 0
 
+    # Match with matching_kernel rather than the loops below
+    kernel: bool = False
+
     def __init__(
         self,
         *,
@@ -55,10 +92,20 @@ class MatchingEngine:
         assets: np.array([math.inf, 0], dtype = float),
         actual_fee_rate: float,
         min_notional=0.0005,
-        trades_collection,
+        trades_collection=None,
+        trade_sink: DocumentSink = None,
+        kernel: bool = None,
     ) -> None:
 
         assert QL > 0
+        assert trades_collection != None or trade_sink != None
+
+        if kernel != None:
+            self.kernel = kernel
+
+        if self.kernel and not matching_kernel.compiled:
+            logging.warning('numba is not installed; '
+                            'the matching kernel is not compiled')
 
         self.assets = assets
         self.QL = QL
@@ -67,14 +114,35 @@ class MatchingEngine:
         self.min_notional = min_notional
         self.trades_collection = trades_collection
 
+        # Without an explicit sink, sim trades go straight to the collection
+        self.trade_sink = trade_sink if trade_sink != None \
+            else MongoSink(trades_collection, batch_size=1)
+
     def __str__(self):
         return str(self.__class__) + '\n' + '\n'.join(('{} = {}'.format(
             item, self.__dict__[item]
         ) for item in self.__dict__))
 
+    @property
+    def assets(self) -> Assets:
+        """The funds and inventory; assign a pair to set them"""
+        return Assets(self)
+
+    @assets.setter
+    def assets(self, assets) -> None:
+
+        funds, inventory = assets
+
+        self.funds = float(funds)
+        self.inventory = float(inventory)
+
     if __debug__:
         pass
 
+    def flush(self) -> None:
+        """Write out any buffered sim trades"""
+        self.trade_sink.flush()
+
     @profile
     def match(
         self,
@@ -86,41 +154,40 @@ class MatchingEngine:
 
         assert buy_rate > 0 and sell_rate > 0
 
-        funds, inventory = self.assets
-
-        if __debug__:
-            logging.debug('buy_rate: %f, sell_rate: %f, IL: %f',
-                          buy_rate,
-                          sell_rate,
-                          self.IL)
-
-            logging.debug(
-                'QL: %f funds: %f, IL - inventory * sell_rate: %f',
-                self.QL,
-                funds,
-                self.IL - inventory * sell_rate)
-
-        # Take a snapshot of the assets;
-        # both buy and sell sides start with the same snapshot
-        start_assets = self.assets
-
+        if sim_trace.enabled:
+            sim_trace.trace(
+                "match",
+                buyRate=buy_rate,
+                sellRate=sell_rate,
+                QL=self.QL,
+                IL=self.IL,
+                funds=self.funds,
+                inventory=self.inventory,
+            )
+
+        # Each side starts from the current assets, so sell starts from
+        # the assets buy left
         buy_result = self.buy(
-            start_assets=start_assets,
+            start_assets=None,
             buy_rate=buy_rate,
             sell_rate=sell_rate,
             sell_trades=sell_trades,
         )
 
         sell_result = self.sell(
-            start_assets=start_assets,
+            start_assets=None,
             sell_rate=sell_rate,
             buy_trades=buy_trades,
         )
 
-        if buy_result == MatchResult.MATCHED or sell_result == MatchResult.MATCHED:
-
-            _, i = self.assets
-            logging.debug ("i: %4.16f, b: %4.16f, s: %4.16f", i, buy_rate, sell_rate)
+        if sim_trace.enabled:
+            sim_trace.trace(
+                "matched",
+                buyMatch=buy_result.name,
+                sellMatch=sell_result.name,
+                funds=self.funds,
+                inventory=self.inventory,
+            )
 
         return buy_result, sell_result
 
@@ -137,18 +204,19 @@ class MatchingEngine:
             self.buy_no_trades_count += 1
             return MatchResult.NO_TRADES
 
-        logging.debug ("sell_trades: %r", sell_trades)
+        if self.kernel:
+            return self.kernel_buy(start_assets, buy_rate, sell_rate,
+                                   sell_trades)
 
-        funds, inventory = start_assets
+        funds, inventory = (self.funds, self.inventory) \
+            if start_assets is None else start_assets
 
         ceiling = self.IL - inventory * sell_rate
         quantity = min(self.QL, funds, ceiling)
 
-        """
-        if __debug__:
-            logging.debug ('ceiling: ' + str(ceiling))
-            logging.debug ('quantity: ' + str(quantity))
-        """
+        if sim_trace.enabled:
+            sim_trace.trace("buy", trades=len(sell_trades),
+                            ceiling=ceiling, quantity=quantity)
 
         if (ceiling <= 0 or funds <= 0):
 
@@ -158,10 +226,12 @@ class MatchingEngine:
         matched = False
         match = 0
 
-        for trade in sell_trades:
+        rates, quantities = trade_columns(sell_trades)
+
+        for i, rate in enumerate(rates):
 
             # Trades higher than rate are ignored
-            if trade['r'] <= buy_rate:
+            if rate <= buy_rate:
 
                 if quantity <= 0:
                     if matched:
@@ -170,7 +240,7 @@ class MatchingEngine:
                         self.buy_unmatchable_count += 1
                         return MatchResult.UNMATCHABLE
                
-                base = min(quantity, trade['q'] * buy_rate)
+                base = min(quantity, quantities[i] * buy_rate)
                 quote = base/buy_rate
                 fee = quote * self.actual_fee_rate
                 notion = quote * buy_rate
@@ -183,15 +253,17 @@ class MatchingEngine:
                         self.buy_notion_failure_count += 1
                         return MatchResult.MIN_NOTIONAL_FAILURE
 
-                if __debug__:
-                    logging.debug('actual_fee_rate: %f, base: %f, quote: %f, fee: %f',
-                                  self.actual_fee_rate, base, quote, fee)
+                if sim_trace.enabled:
+                    sim_trace.trace("fill", buy=True, i=i, match=match,
+                                    r=buy_rate, q=quote, b=-base, fee=fee)
 
-                logging.debug('BUY  r: %f, q: %f',buy_rate, quote)
                 matched = True
                 self.buy_match_count += 1
 
-                self.trades_collection.insert_one({
+                # Only now is the full history trade needed
+                trade = trade_at(sell_trades, i)
+
+                self.trade_sink.write({
                     "runId": sim_config.partition_config["runId"],
                     "simVersion": sim_config.partition_config["simVersion"],
                     "s": sim_config.partition_config["simId"],
@@ -212,7 +284,8 @@ class MatchingEngine:
                 })
 
                 quantity -= base
-                self.assets += [-base, quote-fee]
+                self.funds += -base
+                self.inventory += quote - fee
 
                 self.sim_trades_idx += 1
                 match += 1
@@ -231,15 +304,23 @@ class MatchingEngine:
         buy_trades: [dict],
     ) -> MatchResult:
 
-        _, inventory = start_assets
-
         if len(buy_trades) == 0:
 
             self.sell_no_trades_count += 1
             return MatchResult.NO_TRADES
 
+        if self.kernel:
+            return self.kernel_sell(start_assets, sell_rate, buy_trades)
+
+        inventory = self.inventory if start_assets is None \
+            else start_assets[1]
+
         quantity = min(self.QL, inventory * sell_rate)
 
+        if sim_trace.enabled:
+            sim_trace.trace("sell", trades=len(buy_trades),
+                            quantity=quantity)
+
         if quantity <= 0:
             self.sell_blocked_count += 1
             return MatchResult.BLOCKED
@@ -247,10 +328,12 @@ class MatchingEngine:
         matched = False
         match = 0
 
-        for trade in buy_trades:
+        rates, quantities = trade_columns(buy_trades)
+
+        for i, rate in enumerate(rates):
 
             # Trades lower than rate are ignored
-            if trade['r'] >= sell_rate:
+            if rate >= sell_rate:
 
                 if quantity <= 0:
 
@@ -261,16 +344,11 @@ class MatchingEngine:
                         self.sell_unmatchable_count += 1
                         return MatchResult.UNMATCHABLE
 
-                base = min(quantity, trade['q'] * sell_rate)
+                base = min(quantity, quantities[i] * sell_rate)
                 quote = base / sell_rate
                 fee = base * self.actual_fee_rate
                 notion = quote * sell_rate
 
-                """
-                if __debug__:
-                    logging.debug(f'base: {base}, quote: {quote}, fee: {fee}, notion: {notion}')
-                """
-
                 # Ensure we meet the min notional
                 if notion < self.min_notional:
                     if matched:
@@ -279,14 +357,16 @@ class MatchingEngine:
                         self.sell_notion_failure_count += 1
                         return MatchResult.MIN_NOTIONAL_FAILURE
 
-                matched = True
+                if sim_trace.enabled:
+                    sim_trace.trace("fill", buy=False, i=i, match=match,
+                                    r=sell_rate, q=-quote, b=base, fee=fee)
 
-                logging.debug('SELL r: %f, q: %f',sell_rate, quote)
+                matched = True
                 self.sell_match_count += 1
 
-                logging.debug ("SELL_TRADE: %2.8f, %s", sell_rate, sim_config.orderbook_id)
+                trade = trade_at(buy_trades, i)
 
-                self.trades_collection.insert_one({
+                self.trade_sink.write({
                     "runId": sim_config.partition_config["runId"],
                     "simVersion": sim_config.partition_config["simVersion"],
                     "s": sim_config.partition_config["simId"],
@@ -306,7 +386,8 @@ class MatchingEngine:
                 })
 
                 quantity -= base
-                self.assets += [base-fee, -quote]
+                self.funds += base - fee
+                self.inventory += -quote
 
                 self.sim_trades_idx += 1
                 match += 1
@@ -316,3 +397,140 @@ class MatchingEngine:
         else:
             self.sell_unmatchable_count += 1
             return MatchResult.UNMATCHABLE
+
+    @profile
+    def kernel_buy(
+        self,
+        start_assets: np.array,
+        buy_rate: float,
+        sell_rate: float,
+        sell_trades: [dict],
+    ) -> MatchResult:
+        """buy() with matching_kernel.match_buy doing the matching"""
+
+        funds, inventory = (self.funds, self.inventory) \
+            if start_assets is None else start_assets
+
+        ceiling = self.IL - inventory * sell_rate
+
+        if sim_trace.enabled:
+            sim_trace.trace("buy", trades=len(sell_trades), ceiling=ceiling,
+                            quantity=min(self.QL, funds, ceiling))
+
+        rates, quantities = trade_arrays(sell_trades)
+        index, fills = matching_kernel.fill_buffers(len(rates))
+
+        code, self.funds, self.inventory, n = matching_kernel.match_buy(
+            rates, quantities, float(buy_rate), float(sell_rate),
+            float(funds), float(inventory), self.funds, self.inventory,
+            float(self.QL), float(self.IL),
+            float(self.actual_fee_rate), float(self.min_notional),
+            index, fills)
+
+        for match, (i, (quantity, base, quote, fee)) in enumerate(
+                zip(index[:n].tolist(), fills[:n].tolist())):
+
+            if sim_trace.enabled:
+                sim_trace.trace("fill", buy=True, i=i, match=match,
+                                r=buy_rate, q=quote, b=-base, fee=fee)
+
+            trade = trade_at(sell_trades, i)
+
+            self.trade_sink.write({
+                "runId": sim_config.partition_config["runId"],
+                "simVersion": sim_config.partition_config["simVersion"],
+                "s": sim_config.partition_config["simId"],
+                "p": sim_config.partition_config["_id"],
+                "ceiling": ceiling,
+                "idx": self.sim_trades_idx,
+                "match": match,
+                "ts": datetime.now(),
+                "buy": True,
+                "o": sim_config.orderbook_id,
+                "t": trade['_id'],
+                "quantity": quantity,
+                "r": buy_rate,
+                "q": quote,
+                "b": -base,
+                "buyFee": fee,
+                "historyTrade": trade,
+            })
+
+            self.sim_trades_idx += 1
+
+        self.buy_match_count += n
+
+        if code == matching_kernel.BLOCKED:
+            self.buy_blocked_count += 1
+        elif code == matching_kernel.MIN_NOTIONAL_FAILURE:
+            self.buy_notion_failure_count += 1
+        elif code == matching_kernel.UNMATCHABLE:
+            self.buy_unmatchable_count += 1
+
+        return matching_kernel.RESULTS[code]
+
+    @profile
+    def kernel_sell(
+        self,
+        start_assets: np.array,
+        sell_rate: float,
+        buy_trades: [dict],
+    ) -> MatchResult:
+        """sell() with matching_kernel.match_sell doing the matching"""
+
+        inventory = self.inventory if start_assets is None \
+            else start_assets[1]
+
+        if sim_trace.enabled:
+            sim_trace.trace("sell", trades=len(buy_trades),
+                            quantity=min(self.QL, inventory * sell_rate))
+
+        rates, quantities = trade_arrays(buy_trades)
+        index, fills = matching_kernel.fill_buffers(len(rates))
+
+        code, self.funds, self.inventory, n = matching_kernel.match_sell(
+            rates, quantities, float(sell_rate), float(inventory),
+            self.funds, self.inventory, float(self.QL),
+            float(self.actual_fee_rate), float(self.min_notional),
+            index, fills)
+
+        for match, (i, (quantity, base, quote, fee)) in enumerate(
+                zip(index[:n].tolist(), fills[:n].tolist())):
+
+            if sim_trace.enabled:
+                sim_trace.trace("fill", buy=False, i=i, match=match,
+                                r=sell_rate, q=-quote, b=base, fee=fee)
+
+            trade = trade_at(buy_trades, i)
+
+            self.trade_sink.write({
+                "runId": sim_config.partition_config["runId"],
+                "simVersion": sim_config.partition_config["simVersion"],
+                "s": sim_config.partition_config["simId"],
+                "p": sim_config.partition_config["_id"],
+                "idx": self.sim_trades_idx,
+                "match": match,
+                "ts": datetime.now(),
+                "buy": False,
+                "o": sim_config.orderbook_id,
+                "t": trade['_id'],
+                "quantity": quantity,
+                "r": sell_rate,
+                "q": -quote,
+                "b": base,
+                "sellFee": fee,
+                "historyTrade": trade,
+            })
+
+            self.sim_trades_idx += 1
+
+        self.sell_match_count += n
+
+        if code == matching_kernel.BLOCKED:
+            self.sell_blocked_count += 1
+        elif code == matching_kernel.MIN_NOTIONAL_FAILURE:
+            self.sell_notion_failure_count += 1
+        elif code == matching_kernel.UNMATCHABLE:
+            self.sell_unmatchable_count += 1
+
+        return matching_kernel.RESULTS[code]
@@ -0,0 +1,173 @@
+"""
+Compiled matching kernel.
+
+The per-trade loops of MatchingEngine.buy and sell, over packed rate and
+quantity arrays.  The loops are compiled with numba when it is installed
+and run as plain Python otherwise; either way they do the engine's
+arithmetic in the engine's order, so results and assets agree with it
+bit for bit.  numba is optional and not in requirements.txt, whose
+numpy pin predates it; see the README.
+
+Each fill is recorded in a row of a fills array of FILL_COLUMNS, with
+the index of the history trade it matched in the index array; the
+engine turns them into sim trades.
+"""
+
+import numpy as np
+
+from match_result import MatchResult
+
+try:
+    from numba import njit
+    compiled = True
+
+except ImportError:
+    compiled = False
+
+    def njit(**kwargs):
+        return lambda f: f
+
+
+# Match results are returned as codes indexing RESULTS
+RESULTS = tuple(MatchResult)
+NO_TRADES, BLOCKED, MIN_NOTIONAL_FAILURE, UNMATCHABLE, MATCHED = range(5)
+
+assert RESULTS == (
+    MatchResult.NO_TRADES,
+    MatchResult.BLOCKED,
+    MatchResult.MIN_NOTIONAL_FAILURE,
+    MatchResult.UNMATCHABLE,
+    MatchResult.MATCHED,
+)
+
+# Columns of a fill: the quantity left before it, base, quote and fee
+FILL_COLUMNS = ("quantity", "base", "quote", "fee")
+
+
+def fill_buffers(count: int) -> tuple:
+    """Index and fills arrays for up to count fills"""
+
+    return (np.empty(count, dtype=np.int64),
+            np.empty((count, len(FILL_COLUMNS)), dtype=np.float64))
+
+
+@njit(cache=True)
+def match_buy(
+    rates,
+    quantities,
+    buy_rate,
+    sell_rate,
+    start_funds,
+    start_inventory,
+    funds,
+    inventory,
+    QL,
+    IL,
+    actual_fee_rate,
+    min_notional,
+    index,
+    fills,
+):
+    """
+    Buy from the sell trades, limited by the start assets; returns the
+    result code, the funds and inventory after the fills and the number
+    of fills.
+    """
+
+    ceiling = IL - start_inventory * sell_rate
+    quantity = min(QL, start_funds, ceiling)
+
+    if ceiling <= 0 or start_funds <= 0:
+        return BLOCKED, funds, inventory, 0
+
+    n = 0
+
+    for i in range(len(rates)):
+
+        # Trades higher than rate are ignored
+        if rates[i] <= buy_rate:
+
+            if quantity <= 0:
+                return MATCHED if n > 0 else UNMATCHABLE, funds, inventory, n
+
+            base = min(quantity, quantities[i] * buy_rate)
+            quote = base / buy_rate
+            fee = quote * actual_fee_rate
+            notion = quote * buy_rate
+
+            # Ensure we meet the min notional
+            if notion < min_notional:
+                return MATCHED if n > 0 else MIN_NOTIONAL_FAILURE, \
+                    funds, inventory, n
+
+            index[n] = i
+            fills[n, 0] = quantity
+            fills[n, 1] = base
+            fills[n, 2] = quote
+            fills[n, 3] = fee
+            n += 1
+
+            quantity -= base
+            funds += -base
+            inventory += quote - fee
+
+    return MATCHED if n > 0 else UNMATCHABLE, funds, inventory, n
+
+
+@njit(cache=True)
+def match_sell(
+    rates,
+    quantities,
+    sell_rate,
+    start_inventory,
+    funds,
+    inventory,
+    QL,
+    actual_fee_rate,
+    min_notional,
+    index,
+    fills,
+):
+    """
+    Sell to the buy trades, limited by the start inventory; returns the
+    result code, the funds and inventory after the fills and the number
+    of fills.
+    """
+
+    quantity = min(QL, start_inventory * sell_rate)
+
+    if quantity <= 0:
+        return BLOCKED, funds, inventory, 0
+
+    n = 0
+
+    for i in range(len(rates)):
+
+        # Trades lower than rate are ignored
+        if rates[i] >= sell_rate:
+
+            if quantity <= 0:
+                return MATCHED if n > 0 else UNMATCHABLE, funds, inventory, n
+
+            base = min(quantity, quantities[i] * sell_rate)
+            quote = base / sell_rate
+            fee = base * actual_fee_rate
+            notion = quote * sell_rate
+
+            # Ensure we meet the min notional
+            if notion < min_notional:
+                return MATCHED if n > 0 else MIN_NOTIONAL_FAILURE, \
+                    funds, inventory, n
+
+            index[n] = i
+            fills[n, 0] = quantity
+            fills[n, 1] = base
+            fills[n, 2] = quote
+            fills[n, 3] = fee
+            n += 1
+
+            quantity -= base
+            funds += base - fee
+            inventory += -quote
+
+    return MATCHED if n > 0 else UNMATCHABLE, funds, inventory, n
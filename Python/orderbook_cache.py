@@ -0,0 +1,494 @@
+"""
+Columnar, memory-mapped cache of loaded orderbooks.
+
+A cache holds the orderbooks of one (envId, exchange, market, depth) and
+time frame as flat .npy files in a directory under $SIM_CACHE:
+
+    manifest.json           channel, depth and time frame of the load
+    ids.npy                 (n, 12) uint8, orderbook ObjectIds
+    ts.npy                  (n,) datetime64[ms]
+    buy.npy, sell.npy       (levels, 2) float64, [rate, quantity] rows
+    buy_offsets.npy, ...    (n + 1,) int64, book i is rows [o[i], o[i+1])
+    buy_notional.npy, ...   (levels,) float64, cumulative notional per book
+    buy_quantity.npy, ...   (levels,) float64, cumulative quantity per book
+    buy_trades.npy, ...     TRADE_RECORD_DTYPE, (r, q, ref) per history trade
+    buy_trade_ids.npy, ...  TRADE_ID_DTYPE, the trade table ref points into
+    buy_trade_offsets.npy   (n + 1,) int64
+    trades_sorted.npy       (n,) bool, each book's trades in match order
+
+Replay slices the memory-mapped arrays, so the books and trade records
+handed to the simulation are zero-copy views and nothing is BSON-decoded.
+"""
+
+import errno
+import functools
+import json
+import logging
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from stage_timer import StageTimer
+from trade_records import (
+    TRADE_ID_DTYPE, TRADE_RECORD_DTYPE, TradeRecords, TradeTable,
+    trades_sorted)
+
+try:
+    profile
+except NameError:
+    profile = lambda x: x
+
+
+# Caches written with another layout are ignored
+CACHE_VERSION = 3
+
+SIDES = ("buy", "sell")
+
+
+def cache_name(
+    envId: int,
+    exchange: str,
+    market: str,
+    depth: float,
+    start: datetime = None,
+    end: datetime = None,
+) -> str:
+
+    name = f'{envId}-{exchange}-{market}-{depth:g}'
+
+    # Loads of other time frames get caches of their own
+    if start != None and end != None:
+        name += '-{0:%Y%m%dT%H%M%S}-{1:%Y%m%dT%H%M%S}'.format(start, end)
+
+    return name.lower()
+
+
+def cache_path(
+    envId: int,
+    exchange: str,
+    market: str,
+    depth: float,
+    cache_dir: str = None,
+    *,
+    start: datetime = None,
+    end: datetime = None,
+) -> str:
+
+    if cache_dir == None:
+        assert os.environ['SIM_CACHE'], 'SIM_CACHE Not Defined'
+        cache_dir = os.environ['SIM_CACHE']
+
+    return os.path.join(
+        cache_dir, cache_name(envId, exchange, market, depth, start, end))
+
+
+def find_cache(
+    envId: int,
+    exchange: str,
+    market: str,
+    depth: float,
+    start: datetime,
+    end: datetime,
+    cache_dir: str = None,
+    *,
+    usable=None,
+) -> str:
+    """
+    Return the path of a cache covering the channel and time frame, or
+    None.  A cache loaded to a larger depth also serves smaller depths
+    (the simulation trims the books itself).  usable, if given, is called
+    with each candidate's manifest and may reject it.
+    """
+
+    if cache_dir == None:
+        cache_dir = os.environ.get('SIM_CACHE')
+
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return None
+
+    prefix = cache_name(envId, exchange, market, 0)[:-1]
+
+    candidates = []
+
+    for name in os.listdir(cache_dir):
+
+        # Skip caches still being written or being removed
+        if not name.startswith(prefix) or '.tmp' in name or '.old-' in name:
+            continue
+
+        manifest = read_manifest(os.path.join(cache_dir, name))
+
+        if manifest == None or manifest.get("version") != CACHE_VERSION:
+            continue
+
+        if usable != None and not usable(manifest):
+            continue
+
+        if cache_name(
+                manifest["envId"],
+                manifest["exchange"],
+                manifest["market"], 0) != cache_name(
+                    envId, exchange, market, 0):
+            continue
+
+        loaded_depth = manifest["depth"] if manifest["trim"] else 0
+
+        if loaded_depth != 0 and (depth == 0 or loaded_depth < depth):
+            continue
+
+        if to_datetime64(manifest["startTime"]) > to_datetime64(start) or \
+                to_datetime64(manifest["endTime"]) < to_datetime64(end):
+            continue
+
+        candidates.append((loaded_depth if loaded_depth > 0 else np.inf, name))
+
+    if len(candidates) == 0:
+        return None
+
+    return os.path.join(cache_dir, min(candidates)[1])
+
+
+def read_manifest(path: str) -> dict:
+
+    try:
+        with open(os.path.join(path, "manifest.json")) as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+        return None
+
+
+def load_cache(path: str) -> dict:
+    """
+    Memory-map the arrays of a cache.  The mapping is kept for reuse, so
+    a process simulating several partitions of the same channel maps it
+    only once; rewriting the cache gives it a new version.
+    """
+
+    version = os.stat(os.path.join(path, "manifest.json")).st_mtime_ns
+
+    return map_cache(path, version)
+
+
+@functools.lru_cache(maxsize=8)
+def map_cache(path: str, version: int) -> dict:
+
+    return {
+        name[:-len('.npy')]: np.load(
+            os.path.join(path, name), mmap_mode='r')
+        for name in os.listdir(path) if name.endswith('.npy')
+    }
+
+
+def to_datetime64(ts) -> np.datetime64:
+
+    if isinstance(ts, datetime):
+        ts = ts.replace(tzinfo=None)
+
+    return np.datetime64(ts, 'ms')
+
+
+class OrderbookCacheWriter:
+    """
+    Accumulates loaded orderbooks and their trades and writes them out
+    as a cache on close().  The cache is assembled in a temporary
+    directory and renamed into place, so readers never see a partial one.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        envId: int,
+        exchange: str,
+        market: str,
+        depth: float,
+        trim: bool,
+        start: datetime,
+        end: datetime,
+    ):
+
+        self.path = path
+
+        self.manifest = {
+            "envId": envId,
+            "exchange": exchange,
+            "market": market,
+            "depth": depth,
+            "trim": trim,
+            "startTime": str(to_datetime64(start)),
+            "endTime": str(to_datetime64(end)),
+        }
+
+        self.ids = []
+        self.ts = []
+        self.levels = {side: [] for side in SIDES}
+        self.notional = {side: [] for side in SIDES}
+        self.quantity = {side: [] for side in SIDES}
+        self.trades_sorted = []
+        self.trades = {side: [] for side in SIDES}
+        self.trade_ids = {side: [] for side in SIDES}
+        self.trade_count = {side: 0 for side in SIDES}
+
+    @profile
+    def append(self, orderbook: dict, buy_trades: list, sell_trades: list):
+
+        self.ids.append(np.frombuffer(
+            ObjectId(orderbook["_id"]).binary, dtype=np.uint8))
+        self.ts.append(to_datetime64(orderbook["ts"]))
+
+        for side in SIDES:
+
+            levels = np.asarray(orderbook[side], dtype=float).reshape(-1, 2)
+
+            self.levels[side].append(levels)
+            self.notional[side].append(np.cumsum(levels[:, 0] * levels[:, 1]))
+            self.quantity[side].append(np.cumsum(levels[:, 1]))
+
+        self.trades_sorted.append(trades_sorted(buy_trades, sell_trades))
+
+        for side, trades in (("buy", buy_trades), ("sell", sell_trades)):
+
+            records, ids = self.pack_trades(
+                trades, len(self.ids) - 1, self.trade_count[side])
+
+            self.trades[side].append(records)
+            self.trade_ids[side].append(ids)
+            self.trade_count[side] += len(trades)
+
+    @staticmethod
+    def pack_trades(trades: list, orderbook: int, first_ref: int) -> tuple:
+        """Trade records and the trade table rows they refer to"""
+
+        records = np.empty(len(trades), dtype=TRADE_RECORD_DTYPE)
+        ids = np.empty(len(trades), dtype=TRADE_ID_DTYPE)
+
+        for i, trade in enumerate(trades):
+            records[i] = (trade["r"], trade["q"], first_ref + i)
+            ids[i] = (
+                np.frombuffer(ObjectId(trade["_id"]).binary, dtype=np.uint8),
+                np.datetime64(trade["ts"], 'ms'),
+                orderbook,
+            )
+
+        return records, ids
+
+    @staticmethod
+    def offsets(chunks: list) -> np.ndarray:
+        return np.concatenate(
+            ([0], np.cumsum([len(x) for x in chunks]))).astype(np.int64)
+
+    def arrays(self) -> dict:
+        """The accumulated orderbooks as a dict of flat arrays"""
+
+        arrays = {
+            "ids": np.array(self.ids, dtype=np.uint8).reshape(-1, 12),
+            "ts": np.array(self.ts, dtype="datetime64[ms]"),
+            "trades_sorted": np.array(self.trades_sorted, dtype=bool),
+        }
+
+        for side in SIDES:
+
+            arrays[side] = np.concatenate(
+                self.levels[side]).reshape(-1, 2) \
+                if len(self.levels[side]) > 0 else np.empty((0, 2))
+            arrays[f'{side}_offsets'] = self.offsets(self.levels[side])
+
+            for name in ("notional", "quantity"):
+                chunks = getattr(self, name)[side]
+                arrays[f'{side}_{name}'] = np.concatenate(chunks) \
+                    if len(chunks) > 0 else np.empty(0)
+
+            arrays[f'{side}_trades'] = np.concatenate(
+                self.trades[side]) \
+                if len(self.trades[side]) > 0 \
+                else np.empty(0, dtype=TRADE_RECORD_DTYPE)
+            arrays[f'{side}_trade_ids'] = np.concatenate(
+                self.trade_ids[side]) \
+                if len(self.trade_ids[side]) > 0 \
+                else np.empty(0, dtype=TRADE_ID_DTYPE)
+            arrays[f'{side}_trade_offsets'] = self.offsets(self.trades[side])
+
+        return arrays
+
+    def close(self) -> None:
+        """
+        Write the cache, unless another cache already covers the channel,
+        depth and time frame; path is then that cache's.
+        """
+
+        cache_dir, name = os.path.split(self.path)
+
+        covering = find_cache(
+            self.manifest["envId"],
+            self.manifest["exchange"],
+            self.manifest["market"],
+            self.manifest["depth"] if self.manifest["trim"] else 0,
+            self.manifest["startTime"],
+            self.manifest["endTime"],
+            cache_dir)
+
+        if covering != None and covering != self.path:
+            logging.debug('Cache Covered: %s', covering)
+            self.path = covering
+            return
+
+        # Concurrent writers each assemble their own copy
+        tmp_path = tempfile.mkdtemp(prefix=name + '.tmp-', dir=cache_dir)
+
+        for name, array in self.arrays().items():
+            np.save(os.path.join(tmp_path, name + '.npy'), array)
+
+        with open(os.path.join(tmp_path, "manifest.json"), 'w') as f:
+            json.dump({
+                **self.manifest,
+                "version": CACHE_VERSION,
+                "count": len(self.ids),
+            }, f, indent=4)
+
+        os.chmod(tmp_path, 0o755)
+
+        replace_dir(tmp_path, self.path)
+
+        logging.debug('Cache Written: %s', self.path)
+
+
+def replace_dir(tmp_path: str, path: str) -> None:
+    """
+    Rename tmp_path to path, first moving aside and removing any
+    directory already there.  Readers see either directory, never a mix.
+    """
+
+    while True:
+
+        try:
+            os.rename(tmp_path, path)
+            return
+
+        except OSError as err:
+            if err.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+
+        # Another writer may move it first
+        old_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.old-',
+                                    dir=os.path.dirname(path))
+
+        try:
+            os.rename(path, os.path.join(old_path, 'cache'))
+        except FileNotFoundError:
+            pass
+
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+class CachedOrderbooks:
+    """
+    Replays orderbooks from a cache written by OrderbookCacheWriter with
+    the same next() interface as Orderbooks.  The buy and sell sides of
+    each orderbook are views into the memory-mapped level arrays, and
+    the trades are TradeRecords over the memory-mapped trade records.
+    """
+
+    corrupt_order_book_count = 0
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        start: datetime,
+        end: datetime,
+        arrays: dict = None,
+        timer: StageTimer = None,
+    ):
+
+        assert start < end
+
+        self.timer = timer if timer != None else StageTimer(enabled=False)
+
+        self.manifest = read_manifest(path) if path else {}
+
+        if arrays == None:
+            arrays = load_cache(path)
+
+        self.arrays = arrays
+
+        self.tables = {
+            side: TradeTable(
+                arrays[f'{side}_trade_ids'],
+                arrays["ids"],
+                buy=side == "buy",
+                envId=self.manifest.get("envId"),
+                exchange=self.manifest.get("exchange"),
+                market=self.manifest.get("market"),
+            ) for side in SIDES
+        }
+
+        # Orderbooks with start <= ts < end
+        ts = arrays["ts"]
+        self.idx = int(np.searchsorted(ts, to_datetime64(start), 'left'))
+        self.stop = int(np.searchsorted(ts, to_datetime64(end), 'left'))
+
+        self.actual_end = ts[self.stop - 1].tolist() \
+            if self.stop > self.idx else None
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return self.stop - self.idx
+
+    def side(self, side: str, i: int, name: str = None) -> np.ndarray:
+        """The levels of a side, or its name aggregate, of the i'th book"""
+
+        offsets = self.arrays[f'{side}_offsets']
+        array = self.arrays[side if name == None else f'{side}_{name}']
+
+        return array[offsets[i]:offsets[i+1]]
+
+    def trades(self, side: str, i: int) -> TradeRecords:
+
+        offsets = self.arrays[f'{side}_trade_offsets']
+
+        return TradeRecords(
+            self.arrays[f'{side}_trades'][offsets[i]:offsets[i+1]],
+            self.tables[side])
+
+    @profile
+    def next(self):
+
+        if self.idx >= self.stop:
+            raise StopIteration
+
+        i = self.idx
+        self.idx += 1
+
+        with self.timer.stage("fetch"):
+            return self.orderbook(i)
+
+    __next__ = next
+
+    def orderbook(self, i: int) -> dict:
+
+        orderbook_id = ObjectId(bytes(self.arrays["ids"][i]))
+
+        return {
+            "_id": orderbook_id,
+            "e": self.manifest.get("envId"),
+            "x": self.manifest.get("exchange"),
+            "m": self.manifest.get("market"),
+            "ts": self.arrays["ts"][i].tolist(),
+            "s": True,
+            "buy": self.side("buy", i),
+            "sell": self.side("sell", i),
+            "buyNotional": self.side("buy", i, "notional"),
+            "sellNotional": self.side("sell", i, "notional"),
+            "buyQuantity": self.side("buy", i, "quantity"),
+            "sellQuantity": self.side("sell", i, "quantity"),
+            "tradesSorted": bool(self.arrays["trades_sorted"][i]),
+            "buy_trades": self.trades("buy", i),
+            "sell_trades": self.trades("sell", i),
+        }
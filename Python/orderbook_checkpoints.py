@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Orderbook checkpoints: the full state of a channel's orderbook every so
+often, so Orderbooks can start from the latest one before its start time
+instead of replaying every delta since the start snapshot.
+
+A checkpoint is stored in history.orderbook_checkpoints as
+
+    e, x, m, ts     the channel, and the ts of the last orderbook applied
+    buy, sell       the sides as packed (levels, 2) float64 [rate, quantity]
+    ob              _id of that last orderbook
+
+Every valid orderbook with a ts up to and including the checkpoint's ts
+has been applied to it.
+
+Usage: orderbook_checkpoints.py <envId> <exchange> <market> <start> <end> [minutes]
+"""
+
+import os
+import sys
+import logging
+from datetime import datetime, timedelta
+import dateutil.parser
+from pymongo import MongoClient, ReplaceOne, ASCENDING
+from orderbooks import Orderbooks
+
+try:
+    profile
+except NameError:
+    profile = lambda x: x
+
+
+@profile
+def build_checkpoints(
+    orderbooks_collection,
+    checkpoints_collection,
+    *,
+    envId: int,
+    exchange: str,
+    market: str,
+    start: datetime,
+    end: datetime,
+    interval: timedelta = timedelta(minutes=15),
+    batch_size: int = 100,
+) -> int:
+    """
+    Replay the channel's orderbooks from the snapshot before start up to
+    end and checkpoint the state at least interval apart from start on.
+    Returns the number of checkpoints written.
+    """
+
+    checkpoints_collection.create_index([
+        ("e", ASCENDING),
+        ("x", ASCENDING),
+        ("m", ASCENDING),
+        ("ts", ASCENDING),
+    ], unique=True)
+
+    orderbooks = Orderbooks(
+        orderbooks_collection=orderbooks_collection,
+        envId=envId,
+        exchange=exchange,
+        market=market,
+        depth=0,
+        start=start,
+        end=end,
+    )
+
+    due = start.replace(tzinfo=None)
+
+    requests = []
+    count = 0
+    last = None
+
+    def checkpoint(orderbook: dict) -> None:
+
+        requests.append(ReplaceOne(
+            {"e": envId, "x": exchange, "m": market, "ts": orderbook["ts"]},
+            {
+                "e": envId,
+                "x": exchange,
+                "m": market,
+                "ts": orderbook["ts"],
+                "buy": Orderbooks.pack_levels(
+                    orderbooks.buy_orderbook.to_array()),
+                "sell": Orderbooks.pack_levels(
+                    orderbooks.sell_orderbook.to_array()),
+                "ob": orderbook["_id"],
+            },
+            upsert=True))
+
+        if len(requests) >= batch_size:
+            checkpoints_collection.bulk_write(requests, ordered=False)
+            requests.clear()
+
+    for orderbook in orderbooks.iter:
+
+        # Only once every orderbook at the last ts has been applied
+        if (last != None and orderbook["ts"] > last["ts"] and
+                last["ts"].replace(tzinfo=None) >= due):
+            checkpoint(last)
+            count += 1
+            due = last["ts"].replace(tzinfo=None) + interval
+
+        orderbooks.apply(orderbook)
+        last = orderbook
+
+    if last != None and last["ts"].replace(tzinfo=None) >= due:
+        checkpoint(last)
+        count += 1
+
+    if len(requests) > 0:
+        checkpoints_collection.bulk_write(requests, ordered=False)
+
+    return count
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        format='[%(levelname)-5s] %(message)s',
+        level=logging.INFO,
+        datefmt='')
+
+    assert len(sys.argv) >= 6, __doc__
+
+    assert os.environ['MONGODB'], 'MONGODB Not Defined'
+    history = MongoClient(os.environ['MONGODB']).history
+
+    try:
+        count = build_checkpoints(
+            history.orderbooks,
+            history.orderbook_checkpoints,
+            envId=int(sys.argv[1]),
+            exchange=sys.argv[2].lower(),
+            market=sys.argv[3].lower(),
+            start=dateutil.parser.parse(sys.argv[4]),
+            end=dateutil.parser.parse(sys.argv[5]),
+            interval=timedelta(minutes=float(sys.argv[6])) \
+                if len(sys.argv) > 6 else timedelta(minutes=15),
+        )
+
+    except StopIteration:
+        # No snapshot to start from
+        count = 0
+
+    logging.info("{0:25}{1:<d}".format('Checkpoints:', count))
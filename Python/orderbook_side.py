@@ -0,0 +1,159 @@
+import bisect
+
+import numpy as np
+
+try:
+    profile
+except NameError:
+    profile = lambda x: x
+
+
+class OrderbookSide:
+    """
+    One side of an orderbook, held as parallel lists that are always
+    kept in price order (decreasing for the buy side, increasing for the
+    sell side).
+
+    Levels are located with a binary search on the sort keys, so each
+    insert, update or remove is O(log n) to find plus a C-level shift of
+    the lists; there is never a full sort or a uniqueness scan.  The sort
+    key of a level is its rate on the sell side and its negated rate on
+    the buy side, which lets both sides share an ascending key list.
+
+    The cumulative notional of the side is maintained incrementally:
+    changes only mark the first level they touch, and notional() re-sums
+    from there.
+    """
+
+    __slots__ = ("descending", "_keys", "_quantities", "_notional", "_dirty")
+
+    def __init__(self, levels=(), *, descending: bool):
+
+        self.descending = descending
+        self._keys = []
+        self._quantities = []
+        self._notional = np.empty(0, dtype=float)
+        self._dirty = 0
+
+        self.load(levels)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __str__(self):
+        return str(self.__class__) + '\n' + str(self.to_list())
+
+    def _key(self, rate: float) -> float:
+        return -rate if self.descending else rate
+
+    def load(self, levels) -> None:
+        """
+        Replace the contents of the side with a snapshot given as an
+        iterable of [rate, quantity] pairs in any order.
+        """
+
+        pairs = sorted(
+            ((self._key(rate), quantity) for rate, quantity in levels),
+            key=lambda x: x[0])
+
+        self._keys = [key for key, _ in pairs]
+        self._quantities = [quantity for _, quantity in pairs]
+        self._dirty = 0
+
+        # Ensure the snapshot has unique rates
+        assert all(self._keys[i] < self._keys[i+1]
+                   for i in range(len(self._keys)-1)), 'Duplicate Rates'
+
+    def set(self, rate: float, quantity: float) -> None:
+        """Insert a level or update the quantity of an existing one"""
+
+        key = self._key(rate)
+        idx = bisect.bisect_left(self._keys, key)
+
+        if idx < len(self._keys) and self._keys[idx] == key:
+            self._quantities[idx] = quantity
+        else:
+            self._keys.insert(idx, key)
+            self._quantities.insert(idx, quantity)
+
+        self._dirty = min(self._dirty, idx)
+
+    def remove(self, rate: float) -> None:
+        """Remove a level; unknown rates are ignored"""
+
+        key = self._key(rate)
+        idx = bisect.bisect_left(self._keys, key)
+
+        if idx < len(self._keys) and self._keys[idx] == key:
+            del self._keys[idx]
+            del self._quantities[idx]
+
+            self._dirty = min(self._dirty, idx)
+
+    @profile
+    def apply_delta(self, deltas) -> None:
+        """
+        Apply a list of [op, rate, quantity] deltas, where op is
+        0 (insert), 1 (remove) or 2 (update).
+        """
+
+        for delta in deltas:
+
+            if delta[0] == 1:   # Remove
+                self.remove(delta[1])
+
+            elif delta[0] == 0 or delta[0] == 2:  # Insert or Update
+                self.set(delta[1], delta[2])
+
+    def rates(self) -> np.ndarray:
+
+        keys = np.array(self._keys, dtype=float)
+        return -keys if self.descending else keys
+
+    def quantities(self) -> np.ndarray:
+        return np.array(self._quantities, dtype=float)
+
+    def to_array(self) -> np.ndarray:
+        """The side as an (n, 2) array of [rate, quantity] rows"""
+
+        if len(self._keys) == 0:
+            return np.empty((0, 2), dtype=float)
+
+        return np.column_stack((self.rates(), self.quantities()))
+
+    @profile
+    def notional(self, levels: np.ndarray = None) -> np.ndarray:
+        """
+        The cumulative notional (rate * quantity) of the side from the
+        best level down, as np.cumsum(np.prod(levels, axis=1)) would give
+        it.  Levels above the first change since the last call keep their
+        sums.  Pass the array from to_array() to avoid rebuilding it.
+        """
+
+        if levels is None:
+            levels = self.to_array()
+
+        assert len(levels) == len(self._keys)
+
+        dirty = min(self._dirty, len(levels))
+
+        if dirty < len(levels) or len(self._notional) != len(levels):
+
+            x = levels[dirty:, 0] * levels[dirty:, 1]
+
+            # Carry the last valid sum in so the result is identical to
+            # summing the side from the top
+            tail = np.cumsum(
+                np.concatenate((self._notional[dirty-1:dirty], x))) \
+                if dirty > 0 else np.cumsum(x)
+
+            self._notional = np.concatenate(
+                (self._notional[:dirty], tail[1:] if dirty > 0 else tail))
+
+        self._dirty = len(levels)
+
+        return self._notional
+
+    def to_list(self) -> list:
+        return [[self._key(key), quantity]
+                for key, quantity in zip(self._keys, self._quantities)]
@@ -6,15 +6,22 @@ from functools import reduce
 from datetime import datetime, timedelta
 import os
 import numpy as np
+from orderbook_side import OrderbookSide
+from stage_timer import StageTimer
 
 try:
     profile
 except NameError:
     profile = lambda x: x
 
+# Checkpoint sides are stored as packed little-endian float64 rows
+CHECKPOINT_DTYPE = np.dtype('<f8')
+
+
 class Orderbooks:
 
     time_of_start_snapshot = None
+    time_of_checkpoint = None
     actual_end = None
     corrupt_order_book_count = 0
 
@@ -28,16 +35,19 @@ class Orderbooks:
             depth: float,
             start: datetime,
             end: datetime,
+            timer: StageTimer = None,
+            checkpoints_collection: Collection = None,
     ):
 
         self.start = start
         self.end = end
         self.depth = depth
+        self.timer = timer if timer != None else StageTimer(enabled=False)
 
         assert start < end
 
-        self.buy_orderbook = []
-        self.sell_orderbook = []
+        self.buy_orderbook = OrderbookSide(descending=True)
+        self.sell_orderbook = OrderbookSide(descending=False)
 
         start_snapshot = Orderbooks.get_start_snapshot(
             envId,
@@ -46,14 +56,38 @@ class Orderbooks:
             start,
             orderbooks_collection=orderbooks_collection)
 
-        self.buy_orderbook = start_snapshot["buy"]
-        self.sell_orderbook = start_snapshot["sell"]
+        self.time_of_start_snapshot = start_snapshot["ts"]
+
+        checkpoint = Orderbooks.get_checkpoint(
+            envId,
+            exchange,
+            market,
+            start,
+            checkpoints_collection=checkpoints_collection) \
+            if checkpoints_collection != None else None
+
+        # A checkpoint taken at or after the start snapshot holds the
+        # state replaying from the snapshot would reach at its ts
+        if (checkpoint != None and
+                self.time_of_start_snapshot <= checkpoint["ts"]):
 
-        # Ensure both buy and sell OBs are sorted
-        self.buy_orderbook.sort(reverse=True)
-        self.sell_orderbook.sort(reverse=False)
+            self.time_of_checkpoint = checkpoint["ts"]
 
-        self.time_of_start_snapshot = start_snapshot["ts"]
+            self.buy_orderbook.load(
+                Orderbooks.unpack_levels(checkpoint["buy"]))
+            self.sell_orderbook.load(
+                Orderbooks.unpack_levels(checkpoint["sell"]))
+
+            # Every orderbook at the checkpoint's ts is already applied
+            ts_range = {"$gt": self.time_of_checkpoint, "$lt": end}
+
+        else:
+
+            # Both sides are kept sorted from here on
+            self.buy_orderbook.load(start_snapshot["buy"])
+            self.sell_orderbook.load(start_snapshot["sell"])
+
+            ts_range = {"$gte": self.time_of_start_snapshot, "$lt": end}
 
         last_orderbook = Orderbooks.get_last_orderbook(
             envId,
@@ -67,26 +101,24 @@ class Orderbooks:
 
         if __debug__:
             logging.debug('start_snapshot: %r', start_snapshot)
+            logging.debug('checkpoint: %r', self.time_of_checkpoint)
             logging.debug('actual_end: %r', self.actual_end)
 
+        # The orderbooks replayed, e.g. to fetch their trades up front
+        self.replay_filter = {
+            "e": envId,
+            "x": exchange,
+            "m": market,
+            "ts": ts_range,
+            "s": {
+                "$exists": True
+            },
+            "V": "V", # valid flag
+        }
+
         # Setup an iterator to drive the simulation
         self.iter = iter(
-            orderbooks_collection.find(
-                filter={
-                    "e": envId,
-                    "x": exchange,
-                    "m": market,
-                    "ts": {
-                        "$gte": self.time_of_start_snapshot,
-                        "$lt": end
-                    },
-                    "s": {
-                        "$exists": True
-                    },
-                    "V": "V", # valid flag
-                }
-            )
-        )
+            orderbooks_collection.find(filter=self.replay_filter))
 
     """
             ).sort([
@@ -158,6 +190,41 @@ class Orderbooks:
 
         return start_snapshot
 
+    @staticmethod
+    def get_checkpoint(
+        envId: int,
+        exchange: str,
+        market: str,
+        start: datetime,
+        checkpoints_collection,
+    ):
+        """The latest checkpoint strictly before start, if any"""
+
+        checkpoints = list(
+            checkpoints_collection.find(
+                filter={
+                    "e": envId,
+                    "x": exchange,
+                    "m": market,
+                    "ts": {
+                        "$lt": start,
+                    },
+                }).sort("ts", -1).limit(1)
+        )
+
+        if len(checkpoints) == 0:
+            return None
+        else:
+            return checkpoints[0]
+
+    @staticmethod
+    def pack_levels(levels: np.array) -> bytes:
+        return np.asarray(levels, dtype=CHECKPOINT_DTYPE).tobytes()
+
+    @staticmethod
+    def unpack_levels(blob: bytes) -> np.array:
+        return np.frombuffer(blob, dtype=CHECKPOINT_DTYPE).reshape(-1, 2)
+
     @staticmethod
     def get_first_orderbook(
         envId: int,
@@ -269,30 +336,42 @@ class Orderbooks:
 
             while True: # Until prelimary OBs are removed
 
-                orderbook = self.iter.next()
+                with self.timer.stage("fetch"):
+                    orderbook = self.iter.next()
 
                 if orderbook == None:
                     raise StopIteration
 
                 assert "s" in orderbook
 
-                if orderbook["s"] == True:
+                with self.timer.stage("deltas"):
+                    self.apply(orderbook)
 
-                    # Snapshot
-                    self.buy_orderbook = orderbook["buy"]
-                    self.sell_orderbook = orderbook["sell"]
+                # First orderbooks not needed
+                if self.start.replace(tzinfo=None) <= orderbook["ts"].replace(tzinfo=None):
+                    break
 
-                else:
+            with self.timer.stage("deltas"):
 
-                    # Delta
-                    self.apply_deltas(orderbook)
+                orderbook["buy"] = self.buy_orderbook.to_array()
+                orderbook["sell"] = self.sell_orderbook.to_array()
 
-                    orderbook["buy"] = self.buy_orderbook
-                    orderbook["sell"] = self.sell_orderbook
+                # Cumulative notional for depth trimming, kept up to date
+                # incrementally as the deltas land
+                orderbook["buyNotional"] = \
+                    self.buy_orderbook.notional(orderbook["buy"])
+                orderbook["sellNotional"] = \
+                    self.sell_orderbook.notional(orderbook["sell"])
 
-                # First orderbooks not needed
-                if self.start.replace(tzinfo=None) <= orderbook["ts"].replace(tzinfo=None):
-                    break
+                # Cumulative quantity as stored at load time, when this is
+                # a loaded snapshot
+                for side in ("buy", "sell"):
+                    quantity = orderbook.get(f'{side}Quantity')
+                    orderbook[f'{side}Quantity'] = \
+                        np.asarray(quantity, dtype=float) \
+                        if quantity is not None \
+                        and len(quantity) == len(orderbook[side]) \
+                        else self.cumulative_quantity(orderbook[side])
 
             # Sanity check: best buy strictly less than best sell
             try:
@@ -306,65 +385,138 @@ class Orderbooks:
                     logging.error (msg)
                 self.corrupt_order_book_count += 1
 
-        orderbook["buy"] = np.array(orderbook["buy"], dtype=float)
-        orderbook["sell"] = np.array(orderbook["sell"], dtype=float)
-
         assert len(orderbook["buy"]) > 0
         assert len(orderbook["sell"]) > 0
 
         return orderbook
 
 
+    def apply(self, orderbook: dict) -> None:
+        """Bring both sides up to date with a snapshot or delta"""
+
+        if orderbook["s"] == True:
+
+            # Snapshot
+            self.buy_orderbook.load(orderbook["buy"])
+            self.sell_orderbook.load(orderbook["sell"])
+
+        else:
+
+            # Delta
+            self.apply_deltas(orderbook)
+
     def apply_deltas(self, orderbook):
 
         assert self.buy_orderbook != None
         assert self.sell_orderbook != None
 
-        # Apply the deltas to both sides
-        self.apply_delta(self.buy_orderbook, orderbook["buy"])
-        self.apply_delta(self.sell_orderbook, orderbook["sell"])
+        # Apply the deltas to both sides; each side stays sorted and unique
+        self.buy_orderbook.apply_delta(orderbook["buy"])
+        self.sell_orderbook.apply_delta(orderbook["sell"])
+
+    @staticmethod
+    def cumulative_notional(orderbook: np.array) -> np.array:
+        return np.cumsum(np.prod(orderbook, axis=1))
 
-        self.buy_orderbook.sort(reverse=True)
-        self.sell_orderbook.sort(reverse=False)
+    @staticmethod
+    def cumulative_quantity(orderbook: np.array) -> np.array:
+        return np.cumsum(orderbook[:, 1])
 
-        # Ensure buy_orderbook has unique entries
-        assert len(self.buy_orderbook) == len(
-            set([x[0] for x in self.buy_orderbook]))
+    @staticmethod
+    def aggregates(
+        buy: np.array,
+        sell: np.array,
+        buy_notional: np.array = None,
+        sell_notional: np.array = None,
+    ) -> dict:
+        """
+        Per-orderbook aggregates stored with a loaded orderbook: the
+        cumulative notional and quantity of each side and the best bid
+        and ask.  Notional computed for the untrimmed side is cut to fit.
+        """
+
+        aggregates = {}
+
+        for side, levels, notional in (
+                ("buy", buy, buy_notional),
+                ("sell", sell, sell_notional)):
+
+            aggregates[f'{side}Notional'] = \
+                Orderbooks.cumulative_notional(levels) \
+                if notional is None else notional[:len(levels)]
+            aggregates[f'{side}Quantity'] = \
+                Orderbooks.cumulative_quantity(levels)
+
+        aggregates["bestBid"] = float(buy[0][0]) if len(buy) > 0 else None
+        aggregates["bestAsk"] = float(sell[0][0]) if len(sell) > 0 else None
+
+        return aggregates
 
-        # Ensure sell_orderbook has unique entries
-        assert len(self.sell_orderbook) == len(
-            set([x[0] for x in self.sell_orderbook]))
+    @staticmethod
+    def depth_below(
+        rate: float,
+        orderbook: np.array,
+        quantity: np.array = None,
+        *,
+        buy: bool,
+    ):
+        """
+        Total quantity of the levels priced beyond rate: above it on the
+        buy side, below it on the sell side.  Those levels are a prefix of
+        the side, so this is one lookup into its cumulative quantity, the
+        same sum as adding the levels one by one.
+        """
 
-    def apply_delta(self, orderbook, deltas):
+        if quantity is None:
+            quantity = Orderbooks.cumulative_quantity(orderbook)
 
-        for delta in deltas:
+        count = np.searchsorted(-orderbook[:, 0], -rate, 'left') if buy \
+            else np.searchsorted(orderbook[:, 0], rate, 'left')
 
-            for idx, entry in enumerate(orderbook):
-                if entry[0] == delta[1]:
-                    del orderbook[idx]
+        # The quantity may run past a trimmed orderbook
+        count = min(int(count), len(orderbook))
 
-            if delta[0] == 0:   # Insert
-                orderbook.append([delta[1], delta[2]])
+        return quantity[count - 1] if count > 0 else 0
 
-            elif delta[0] == 1:  # Remove
-                pass
+    @staticmethod
+    def depth_index(depth, notional: np.array):
+        """
+        Number of levels to keep for depth (a scalar or an array of
+        depths): up to and including the first level at which the
+        cumulative notional reaches the depth, or every level if it
+        never does
+        """
 
-            elif delta[0] == 2:  # Update
-                orderbook.append([delta[1], delta[2]])
+        return np.minimum(
+            np.searchsorted(notional, depth, 'left') + 1, len(notional))
 
     @staticmethod
-    def apply_depth(depth: float, orderbook: np.array) -> np.array:
+    def apply_depth(
+        depth: float,
+        orderbook: np.array,
+        notional: np.array = None,
+    ) -> np.array:
 
         if depth == 0:
             return orderbook
 
-        i = 0
+        if notional is None:
+            notional = Orderbooks.cumulative_notional(orderbook)
+
+        return orderbook[0:int(Orderbooks.depth_index(depth, notional))]
 
-        for entry in np.cumsum(np.prod(orderbook, axis=1)):
+    @staticmethod
+    def apply_depths(
+        depths: list,
+        orderbook: np.array,
+        notional: np.array = None,
+    ) -> list:
+        """The orderbook trimmed to each of several depths with one search"""
 
-            i += 1
+        if notional is None:
+            notional = Orderbooks.cumulative_notional(orderbook)
 
-            if entry >= depth:
-                break
+        indices = Orderbooks.depth_index(np.asarray(depths), notional)
 
-        return orderbook[0:i]
+        return [orderbook if depth == 0 else orderbook[0:int(i)]
+                for depth, i in zip(depths, indices)]
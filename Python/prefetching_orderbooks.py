@@ -0,0 +1,103 @@
+import logging
+import queue
+import threading
+
+from stage_timer import StageTimer
+
+try:
+    profile
+except NameError:
+    profile = lambda x: x
+
+
+# Queued after the last orderbook
+END = object()
+
+
+class PrefetchingOrderbooks:
+    """
+    Wraps Orderbooks or CachedOrderbooks and runs their next() in a
+    background thread, so cursor reads, BSON decoding and delta
+    application overlap with the simulation.  Up to size books are
+    prepared ahead and handed over through a bounded queue.  Exceptions
+    raised while prefetching are raised again by next().
+
+    The wrapped orderbooks must not share a StageTimer with the
+    simulation, which runs on another thread.  Time spent waiting for a
+    book is charged to "fetch" here.  close() stops the thread early.
+    """
+
+    def __init__(self, orderbooks, *, size: int = 64,
+                 timer: StageTimer = None):
+
+        assert size > 0
+
+        self.orderbooks = orderbooks
+        self.timer = timer if timer != None else StageTimer(enabled=False)
+
+        self.queue = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.finished = False
+
+        self.thread = threading.Thread(
+            target=self.prefetch, name="prefetch-orderbooks", daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        # corrupt_order_book_count, actual_end, ... of the wrapped books
+        return getattr(self.orderbooks, name)
+
+    def __iter__(self):
+        return self
+
+    def prefetch(self) -> None:
+
+        try:
+            while not self.stopped.is_set():
+                self.put(self.orderbooks.next())
+
+        except StopIteration:
+            self.put(END)
+
+        except BaseException as err:
+            self.put(err)
+
+    def put(self, item) -> None:
+        """Queue an item unless the consumer has stopped"""
+
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    @profile
+    def next(self):
+
+        if self.finished:
+            raise StopIteration
+
+        with self.timer.stage("fetch"):
+            item = self.queue.get()
+
+        if item is END:
+            self.finished = True
+            raise StopIteration
+
+        if isinstance(item, BaseException):
+            self.finished = True
+            raise item
+
+        return item
+
+    __next__ = next
+
+    def close(self) -> None:
+
+        self.stopped.set()
+        self.finished = True
+
+        self.thread.join()
+
+        logging.debug('Prefetching Stopped')
@@ -0,0 +1,87 @@
+import logging
+
+from bson.objectid import ObjectId
+
+from document_sink import MongoSink, StreamingSink
+
+try:
+    profile
+except NameError:
+    profile = lambda x: x
+
+
+# Fields the simulator stores in Redis as ObjectId strings
+OBJECT_ID_FIELDS = ("runId", "ob", "s", "p")
+
+
+def to_object_ids(documents: list, fields=OBJECT_ID_FIELDS) -> None:
+    """Convert the id fields of a chunk of documents, one field at a time"""
+
+    for field in fields:
+
+        ids = [ObjectId(document[field]) for document in documents]
+
+        for document, object_id in zip(documents, ids):
+            document[field] = object_id
+
+
+@profile
+def drain(
+    r,
+    list_key: str,
+    collection,
+    *,
+    chunk_size: int = 1000,
+    batch_size: int = 1000,
+    required: str = None,
+) -> int:
+    """
+    Move the hashes listed under list_key into collection and delete
+    them from Redis.  The hashes are read chunk_size at a time through
+    one pipeline and inserted in unordered batches of batch_size by a
+    background writer while the next chunk is read.  Only once every
+    insert has succeeded are they unlinked, with a single UNLINK per
+    chunk, so a failed drain can be retried.  Returns the number of
+    documents moved.
+    """
+
+    assert chunk_size > 0
+
+    keys = r.lrange(list_key, 0, -1)
+
+    sink = StreamingSink(MongoSink(collection), batch_size=batch_size)
+    chunks = []
+
+    try:
+
+        for start in range(0, len(keys), chunk_size):
+
+            chunk = keys[start:start + chunk_size]
+
+            pipe = r.pipeline(transaction=False)
+            for key in chunk:
+                pipe.hgetall(key)
+            documents = pipe.execute()
+
+            if required != None:
+                assert all(required in document for document in documents), \
+                    'Corrupt Document: ' + list_key
+
+            to_object_ids(documents)
+
+            for document in documents:
+                sink.write(document)
+
+            chunks.append(chunk)
+
+    finally:
+        sink.close()
+
+    for chunk in chunks:
+        r.unlink(*chunk)
+
+    r.unlink(list_key)
+
+    logging.debug("Drained %s: %d", list_key, len(keys))
+
+    return len(keys)
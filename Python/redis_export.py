@@ -0,0 +1,157 @@
+import logging
+
+import numpy as np
+
+try:
+    profile
+except NameError:
+    profile = lambda x: x
+
+
+# Packed columns are little-endian float64
+PACKED_DTYPE = np.dtype('<f8')
+
+
+class RedisExporter:
+    """
+    Exports loaded orderbooks and their trades to Redis.
+
+    Commands are queued on a pipeline that is sent every
+    books_per_pipeline orderbooks, so a load costs one round trip per
+    batch of books instead of several per trade.  The key layout is the
+    one load.py has always written:
+
+        <e>:<x>:<m>                  zset of orderbook ids scored by ts
+        <ob>                         hash of the orderbook header
+        <ob>:<n>:buy_trades, ...     hash per trade
+        <ob>:buy_trades, ...         zset of the trade keys, scored by n
+        <ob>:buy_rates, ...          list per side column
+
+    With packed=True each side column is instead a single string of
+    packed float64 values and the orderbook hash carries packed=1.
+    Writing them through a client made with decode_responses=True is
+    fine, as only replies are decoded, but readers of packed columns
+    need a client made with decode_responses=False; see unpack_column().
+    """
+
+    def __init__(
+        self,
+        r,
+        *,
+        books_per_pipeline: int = 100,
+        packed: bool = False,
+        transaction: bool = False,
+    ):
+
+        assert books_per_pipeline > 0
+
+        self.r = r
+        self.books_per_pipeline = books_per_pipeline
+        self.packed = packed
+        self.transaction = transaction
+
+        self.pipe = r.pipeline(transaction=transaction)
+        self.pending_books = 0
+        self.exported_count = 0
+
+    @profile
+    def add(self, orderbook: dict, buy_trades: list, sell_trades: list):
+
+        orderbook_id = str(orderbook['_id'])
+
+        redis_key = str(orderbook['e']) + ':' + orderbook['x'] + ':' + orderbook['m']
+        redis_score = int(orderbook["ts"].timestamp()*1000)
+
+        self.pipe.zadd(redis_key, {orderbook_id: redis_score})
+
+        for side, trades in (
+                ("buy_trades", buy_trades),
+                ("sell_trades", sell_trades)):
+
+            scores = {}
+
+            for score, t in enumerate(trades):
+
+                hmset_key = ":".join([orderbook_id, str(score), side])
+
+                self.pipe.hset(hmset_key, mapping={
+                    "_id": str(t["_id"]).encode(),
+                    "e": t['e'],
+                    "x": t['x'].encode(),
+                    "m": t['m'].encode(),
+                    "ts": str(t['ts']).encode(),
+                    "ob": str(t['ob']).encode(),
+                    "r": t['r'],
+                    "q": t['q'],
+                })
+
+                scores[hmset_key] = score
+
+            # All of the side's trade keys in one command
+            if len(scores) > 0:
+                self.pipe.zadd(":".join([orderbook_id, side]), scores)
+
+        header = {
+            "e": orderbook['e'],
+            "x": orderbook['x'].encode(),
+            "m": orderbook['m'].encode(),
+            "ts": str(orderbook['ts']).encode(),
+            "N": orderbook['N'],
+            "V": str(orderbook['V']).encode(),
+        }
+
+        if self.packed:
+            header["packed"] = 1
+
+        self.pipe.hset(orderbook_id, mapping=header)
+
+        for side in ("buy", "sell"):
+
+            levels = np.asarray(orderbook[side], dtype=float)
+
+            for column, name in ((0, "rates"), (1, "quantities")):
+
+                key = ":".join([orderbook_id, f'{side}_{name}'])
+                values = levels[:, column]
+
+                # SET replaces a previous list; lists are rebuilt
+                if self.packed:
+                    self.pipe.set(key, values.astype(PACKED_DTYPE).tobytes())
+
+                else:
+                    self.pipe.delete(key)
+                    self.pipe.rpush(key, *values.tolist())
+
+        self.pending_books += 1
+
+        if self.pending_books >= self.books_per_pipeline:
+            self.execute()
+
+    def execute(self) -> None:
+        """Send the queued commands"""
+
+        if self.pending_books > 0:
+
+            self.pipe.execute()
+
+            self.exported_count += self.pending_books
+            self.pending_books = 0
+
+    def close(self) -> None:
+
+        self.execute()
+        logging.debug('Redis Orderbooks: %d', self.exported_count)
+
+
+def unpack_column(blob: bytes) -> np.ndarray:
+    """
+    A side column stored with packed=True, as read by a client made
+    with decode_responses=False.  A decoding client cannot return the
+    packed bytes intact.
+    """
+
+    if not isinstance(blob, bytes):
+        raise TypeError(
+            'Packed columns must be read with decode_responses=False')
+
+    return np.frombuffer(blob, dtype=PACKED_DTYPE)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pymongo import MongoClient
+from bson.objectid import ObjectId
+import simulate
+
+# Per-worker connections, opened once and reused for every partition
+remote_mongo_client: MongoClient = None
+local_mongo_client: MongoClient = None
+
+
+def init_worker():
+
+    global remote_mongo_client
+    global local_mongo_client
+
+    logging.basicConfig(
+        format='[%(levelname)-5s] %(message)s',
+        level=logging.INFO,
+        datefmt='')
+
+    remote_mongo_client, local_mongo_client = simulate.connect()
+
+
+def run_partition(partition_id: str) -> tuple:
+
+    start = time.time()
+
+    returncode = simulate.simulate_partition(
+        ObjectId(partition_id),
+        remote_mongo_client=remote_mongo_client,
+        local_mongo_client=local_mongo_client,
+    )
+
+    return partition_id, returncode, time.time() - start
+
+
+def get_partition_ids(sim_db, ids: list) -> list:
+    """
+    A single id may be a runId, in which case all of the run's partitions
+    are returned; otherwise the ids are taken to be partition ids.
+    """
+
+    if len(ids) == 1:
+
+        partitions = sim_db.partitions.find(
+            filter={"runId": ObjectId(ids[0])},
+            projection={"_id": 1},
+        ).sort("partition", 1)
+
+        partition_ids = [str(p["_id"]) for p in partitions]
+
+        if len(partition_ids) > 0:
+            return partition_ids
+
+    return ids
+
+
+def run_partitions(sim_db, partition_ids: list, pool) -> int:
+    """
+    Run the partitions on pool, recording each one's status and
+    execution time as it completes.  Returns the number that failed.
+    """
+
+    failures = 0
+
+    futures = {
+        pool.submit(run_partition, partition_id): partition_id
+        for partition_id in partition_ids
+    }
+
+    for future in as_completed(futures):
+
+        partition_id = futures[future]
+
+        try:
+            _, returncode, elapsed = future.result()
+
+        except Exception as err:
+            logging.exception('Exception: %s', err)
+            returncode, elapsed = 1, 0.0
+
+        status = "COMPLETE" if returncode == 0 else "FAILED"
+
+        if returncode != 0:
+            failures += 1
+
+        logging.info(
+            "{0:30}{1:10}{2:8.1f}".format(
+                f'Partition {partition_id}:', status, elapsed))
+
+        sim_db.partitions.update_one(
+            {"_id": ObjectId(partition_id)},
+            {"$set": {"status": status, "executionTime": elapsed}})
+
+    return failures
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        format='[%(levelname)-5s] %(message)s',
+        level=logging.INFO,
+        datefmt='')
+
+    start_execution = time.time()
+
+    assert len(sys.argv) >= 2, \
+        'Usage: run_partitions.py <runId | partitionId ...>'
+
+    assert os.environ['MONGODB'], 'MONGODB Not Defined'
+    assert os.environ['SIMULATOR_DB'], 'SIMULATOR_DB Not Defined'
+    sim_db = MongoClient(os.environ['MONGODB'])[os.environ['SIMULATOR_DB']]
+
+    partition_ids = get_partition_ids(sim_db, sys.argv[1:])
+
+    # One worker per core unless SIM_WORKERS says otherwise
+    workers = int(os.environ.get('SIM_WORKERS', os.cpu_count()))
+
+    logging.info("{0:30}{1:<d}".format("Partitions:", len(partition_ids)))
+    logging.info("{0:30}{1:<d}".format("Workers:", workers))
+
+    # Workers are spawned rather than forked so that no MongoClient is
+    # shared across a fork
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker) as pool:
+
+        failures = run_partitions(sim_db, partition_ids, pool)
+
+    logging.info(
+        "{0:30}{1:4.1f}".format(
+            'Execution Time (secs):', time.time() - start_execution))
+
+    sys.exit(1 if failures > 0 else 0)
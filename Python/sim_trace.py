@@ -0,0 +1,71 @@
+"""
+Tracing for the simulator's hot paths.
+
+Trace points are guarded by the module's enabled flag:
+
+    if sim_trace.enabled:
+        sim_trace.trace("fill", buy=True, r=rate, q=quote)
+
+so a disabled trace point costs one attribute lookup.  They are not
+guarded by __debug__, as the simulations run under python -O and must
+still trace when asked to.  Each trace is a document, tagged with its
+event and the current orderbook, written to the DocumentSink given to
+enable().
+"""
+
+import os
+from datetime import datetime
+
+import sim_config
+from document_sink import DocumentSink, make_sink
+
+enabled: bool = False
+sink: DocumentSink = None
+
+
+def enable(trace_sink: DocumentSink) -> None:
+
+    global enabled, sink
+
+    sink = trace_sink
+    enabled = True
+
+
+def disable() -> None:
+    """Stop tracing and close the sink"""
+
+    global enabled, sink
+
+    if sink != None:
+        sink.close()
+
+    enabled = False
+    sink = None
+
+
+def from_config(partition_config: dict, partition_id) -> None:
+    """
+    Trace when $SIM_TRACE or the partition's traceSink is set; the sink
+    kind is taken from either, "log" by default.
+    """
+
+    kind = os.environ.get('SIM_TRACE') or partition_config.get("traceSink")
+
+    if kind:
+        enable(make_sink(
+            "log" if kind == "1" else kind,
+            collection=sim_config.sim_db.traces if kind == "mongo" else None,
+            path=partition_config.get(
+                "traceSinkPath", f'{partition_id}.trace.json'),
+            batch_size=partition_config.get("traceBatchSize", 1000),
+        ))
+
+
+def trace(event: str, **fields) -> None:
+
+    sink.write({
+        "event": event,
+        "ts": datetime.now(),
+        "o": sim_config.orderbook_id,
+        **fields,
+    })
@@ -16,10 +16,17 @@ import operator
 import numpy
 from matching_engine import MatchingEngine
 import sim_config
+import sim_trace
 from copy import copy
 from orderbooks import Orderbooks
+from orderbook_cache import CachedOrderbooks, find_cache
+from book_server import attach, find_books
+from prefetching_orderbooks import PrefetchingOrderbooks
 import numpy as np
 from match_result import MatchResult
+from document_sink import make_sink, MongoSink, StreamingSink
+from trade_records import trade_rates, trades_sorted
+from stage_timer import StageTimer
 import functools
 import redis
 
@@ -59,8 +66,122 @@ def find_trades(trades, filter):
 
     return buy_trades, sell_trades
 
+def connect():
+    """Connect to the remote and local MongoDBs"""
+
+    # Prep for remote mongodb access
+    assert os.environ['MONGODB'], 'MONGODB Not Defined'
+    remote_mongo_client = MongoClient(os.environ['MONGODB'])
+
+    # Prep for local mongodb access
+    assert os.environ['LOCALDB'], 'LOCALDB Not Defined'
+    local_mongo_client = MongoClient(os.environ['LOCALDB'])
+    assert local_mongo_client, 'Unable to Connect to Local MongoDB'
+
+    return remote_mongo_client, local_mongo_client
+
+
+def open_orderbooks(
+    partition_config: dict,
+    orderbooks_collection,
+    timer: StageTimer = None,
+):
+    """
+    Orderbooks of the partition's channel and time frame, replayed from
+    books published in shared memory by a book server or a columnar
+    cache if one covers them.  With prefetchOrderbooks set, that many
+    books are prepared ahead in a background thread.  Raises
+    StopIteration if there are no orderbooks.
+    """
+
+    prefetch = partition_config.get("prefetchOrderbooks", 0)
+
+    if prefetch > 0:
+        return PrefetchingOrderbooks(
+            find_orderbooks(partition_config, orderbooks_collection),
+            size=prefetch,
+            timer=timer)
+
+    return find_orderbooks(partition_config, orderbooks_collection, timer)
+
+
+def find_orderbooks(
+    partition_config: dict,
+    orderbooks_collection,
+    timer: StageTimer = None,
+):
+
+    books = find_books(
+        partition_config["envId"],
+        partition_config["exchange"],
+        partition_config["market"],
+        partition_config["depth"],
+        partition_config["startTime"],
+        partition_config["endTime"],
+    )
+
+    if books:
+
+        # The server may stop between finding the books and attaching
+        try:
+            arrays = attach(books)
+
+        except OSError as err:
+            logging.warning('Shared Orderbooks Unavailable: %s', err)
+            arrays = None
+
+        if arrays != None:
+            logging.debug('Shared Orderbooks: %s', books)
+            return CachedOrderbooks(
+                books,
+                start=partition_config["startTime"],
+                end=partition_config["endTime"],
+                arrays=arrays,
+                timer=timer,
+            )
+
+    cache = find_cache(
+        partition_config["envId"],
+        partition_config["exchange"],
+        partition_config["market"],
+        partition_config["depth"],
+        partition_config["startTime"],
+        partition_config["endTime"],
+    )
+
+    if cache:
+        logging.debug('Orderbook Cache: %s', cache)
+        return CachedOrderbooks(
+            cache,
+            start=partition_config["startTime"],
+            end=partition_config["endTime"],
+            timer=timer,
+        )
+
+    return Orderbooks(
+        orderbooks_collection=orderbooks_collection,
+        envId=partition_config["envId"],
+        exchange=partition_config["exchange"].lower(),
+        market=partition_config["market"].lower(),
+        depth=partition_config["depth"],
+        start=partition_config["startTime"],
+        end=partition_config["endTime"],
+        timer=timer,
+    )
+
+
 @profile
-def simulate():
+def simulate_partition(
+    partition_id: ObjectId,
+    *,
+    remote_mongo_client: MongoClient,
+    local_mongo_client: MongoClient,
+) -> int:
+    """
+    Simulate one partition and return its return code (0 on success).
+    The clients are passed in so that a batch runner can reuse them
+    across partitions.
+    """
 
     matching_engine: MatchingEngine = None
     CO_calls = 0
@@ -72,37 +193,19 @@ def simulate():
     buy_trades_count = 0
     sell_trades_count = 0
 
-    matchings = []
+    trade_sink = None
+    matchings_sink = None
+    orderbooks = None
 
     try:
 
-        logging.basicConfig(
-            format='[%(levelname)-5s] %(message)s',
-            level=logging.INFO,
-            datefmt='')
-
-        logging.debug(f'simulate args: {sys.argv}')
-
-        if len(sys.argv) == 2:
-            partition_id = ObjectId(sys.argv[1])
-        else:
-            assert False, 'Usage: simulate <Simulation ObjectId>'
-
         logging.debug('partition_id: ' + str(partition_id))
 
-        # Prep for remote mongodb access
-        assert os.environ['MONGODB'], 'MONGODB Not Defined'
-        remote_mongo_client = MongoClient(os.environ['MONGODB'])
-
         assert os.environ['SIMULATOR_DB'], 'SIMULATOR_DB Not Defined'
         sim_config.sim_db = remote_mongo_client[os.environ['SIMULATOR_DB']]
 
         sim_config.sim_configuration_db = remote_mongo_client['sim_configuration']
 
-        # Prep for local mongodb access
-        assert os.environ['LOCALDB'], 'LOCALDB Not Defined'
-        local_mongo_client = MongoClient(os.environ['LOCALDB'])
-        assert local_mongo_client, 'Unable to Connect to Local MongoDB'
         local_sim_db = local_mongo_client['sim']
         if local_sim_db == None:
             raise Exception('Unable to Connect to Local MongoDB')
@@ -135,6 +238,29 @@ def simulate():
             assert sim_config.pdf_x.shape == sim_config.pdf_y.shape
         """
 
+        # Optional per-stage timing
+        timer = StageTimer.from_config(sim_config.partition_config)
+
+        # Optional per-fill tracing
+        sim_trace.from_config(sim_config.partition_config, partition_id)
+
+        # Sim trades are buffered and written in batches
+        trade_sink = make_sink(
+            sim_config.partition_config.get("tradeSink", "mongo"),
+            collection=sim_config.sim_db.trades,
+            path=sim_config.partition_config.get(
+                "tradeSinkPath", f'{partition_id}.trades.json'),
+            batch_size=sim_config.partition_config.get("tradeBatchSize", 1000),
+        )
+        trade_sink.timer = timer
+
+        # Matchings are streamed to the database in fixed-size chunks
+        matchings_sink = StreamingSink(
+            MongoSink(sim_config.sim_db.matchings),
+            batch_size=sim_config.partition_config.get(
+                "matchingsBatchSize", 1000),
+        )
+
         # Matching Engine
         matching_engine = MatchingEngine(
 
@@ -143,7 +269,8 @@ def simulate():
             IL=sim_config.partition_config['inventoryLimit'],
             actual_fee_rate=sim_config.partition_config["actualFeeRate"],
             min_notional=sim_config.partition_config["minNotional"],
-            trades_collection=sim_config.sim_db.trades,
+            trade_sink=trade_sink,
+            kernel=sim_config.partition_config.get("matchingKernel", False),
         )
 
         sim_config.init(sim_config.partition_config)
@@ -160,18 +287,12 @@ def simulate():
                 ).Trader(sim_config)
 
         try:
-            orderbooks = Orderbooks(
-                orderbooks_collection=local_sim_db.orderbooks,
-                envId=sim_config.partition_config["envId"],
-                exchange=sim_config.partition_config["exchange"].lower(),
-                market=sim_config.partition_config["market"].lower(),
-                depth=sim_config.partition_config["depth"],
-                start=sim_config.partition_config["startTime"],
-                end=sim_config.partition_config["endTime"],
-            )
+            orderbooks = open_orderbooks(
+                sim_config.partition_config, local_sim_db.orderbooks, timer)
 
         except StopIteration:
-            os._exit(0)
+            # No orderbooks
+            return 0
 
         orderbook = None
 
@@ -185,101 +306,109 @@ def simulate():
 
                 sim_config.orderbook_id = orderbook['_id']
 
+                # Trade dicts, or TradeRecords from an orderbook cache
                 buy_trades = orderbook["buy_trades"]
-                assert all(buy_trades[i]["r"] >= buy_trades[i+1]["r"]
-                           for i in range(len(buy_trades)-1)), 'Buy Trades Not Sorted'
+                buys = trade_rates(buy_trades)
                 buy_trades_count += len(buy_trades)
 
                 sell_trades = orderbook["sell_trades"]
-                assert all(sell_trades[i]["r"] <= sell_trades[i+1]["r"]
-                           for i in range(len(sell_trades)-1)), 'Sell Trades Not Sorted'
+                sells = trade_rates(sell_trades)
                 sell_trades_count += len(sell_trades)
 
+                # Orderbooks loaded with aggregates were checked at load time
+                assert orderbook.get("tradesSorted", False) or \
+                    trades_sorted(buy_trades, sell_trades), \
+                    'Trades Not Sorted'
+
                 assert len(buy_trades) > 0 or len(sell_trades) > 0
 
-                if (__debug__ and
-                        (
-                            len(buy_trades) > 0 or
-                            len(sell_trades) > 0
-                        )
-                    ):
-                    logging.debug('len(buy_trades): ' + str(len(buy_trades)))
-                    logging.debug('len(sell_trades): ' + str(len(sell_trades)))
+                if sim_trace.enabled:
+                    sim_trace.trace("orderbook", buyCount=len(buy_trades),
+                                    sellCount=len(sell_trades))
 
                 CO_calls += 1
 
-                buyob = Orderbooks.apply_depth(depth, orderbook['buy']) \
-                    if depth > 0 else orderbook['buy']
+                with timer.stage("depth"):
+
+                    buyob = Orderbooks.apply_depth(
+                        depth, orderbook['buy'], orderbook.get('buyNotional')) \
+                        if depth > 0 else orderbook['buy']
 
-                sellob = Orderbooks.apply_depth(depth, orderbook['sell']) \
-                    if depth > 0 else orderbook['sell']
+                    sellob = Orderbooks.apply_depth(
+                        depth, orderbook['sell'], orderbook.get('sellNotional')) \
+                        if depth > 0 else orderbook['sell']
 
-                result = trader.compute_orders(buyob=buyob, sellob=sellob)
+                with timer.stage("computeOrders"):
+                    result = trader.compute_orders(buyob=buyob, sellob=sellob)
 
                 buy_rate, sell_rate = result
 
+                if sim_trace.enabled:
+                    sim_trace.trace("orders", buyRate=buy_rate,
+                                    sellRate=sell_rate)
+
                 if buy_rate > 0 and sell_rate > 0:
 
                     matching_engine_calls += 1
 
-                    buy_match, sell_match = matching_engine.match(
-                        buy_rate=buy_rate,
-                        sell_rate=sell_rate,
-                        buy_trades=buy_trades,
-                        sell_trades=sell_trades,
-                    )
-
-                    funds, inventory = matching_engine.assets
-
-                    if __debug__:
-                        logging.debug(f'compute_orders return: {result}')
-                        logging.debug('buy_match: ' + str(buy_match))
-                        logging.debug('sell_match: ' + str(sell_match))
-
-                    buy_depth = sum(map(
-                        lambda x: x[1] if x[0] > buy_rate else 0,
-                        buyob))
-
-                    sell_depth = sum(
-                        map(
-                            lambda x: x[1] if x[0] < sell_rate else 0,
-                            sellob))
-
-                    matchings.append ({
-                        "runId": sim_config.partition_config["runId"],
-                        "simVersion": sim_config.partition_config["simVersion"],
-                        "e": sim_config.partition_config["envId"],
-                        "x": sim_config.partition_config["exchange"],
-                        "m": sim_config.partition_config["market"],
-                        "s": sim_config.partition_config["simId"],
-                        "p": sim_config.partition_config["_id"],
-                        "depth": sim_config.partition_config["depth"],
-                        "allowOrderConflicts": sim_config.partition_config["allowOrderConflicts"],
-                        "ob": orderbook['_id'],
-                        "ts": datetime.now(),
-                        "topBuy": orderbook['buy'][0][0],
-                        "buyRate": buy_rate,
-                        "buyCount": len(buy_trades),
-                        "buyMatch": str(buy_match).split('.')[1],
-                        "buyDepth": buy_depth,
-                        "buys": list(map((lambda x: x["r"]), buy_trades))
-                        if len(buy_trades) > 0 else None,
-                        "topSell": orderbook['sell'][0][0],
-                        "sellRate": sell_rate,
-                        "sellCount": len(sell_trades),
-                        "sellMatch": str(sell_match).split('.')[1],
-                        "sellDepth": sell_depth,
-                        "sells": list(map((lambda x: x["r"]), sell_trades))
-                        if len(sell_trades) > 0 else None,
-                        "funds": funds,
-                        "inventory": inventory,
-                    })
+                    with timer.stage("match"):
+                        buy_match, sell_match = matching_engine.match(
+                            buy_rate=buy_rate,
+                            sell_rate=sell_rate,
+                            buy_trades=buy_trades,
+                            sell_trades=sell_trades,
+                        )
+
+                    funds = matching_engine.funds
+                    inventory = matching_engine.inventory
+
+                    buy_depth = Orderbooks.depth_below(
+                        buy_rate, buyob, orderbook.get('buyQuantity'),
+                        buy=True)
+
+                    sell_depth = Orderbooks.depth_below(
+                        sell_rate, sellob, orderbook.get('sellQuantity'),
+                        buy=False)
+
+                    with timer.stage("writes"):
+                        matchings_sink.write ({
+                            "runId": sim_config.partition_config["runId"],
+                            "simVersion": sim_config.partition_config["simVersion"],
+                            "e": sim_config.partition_config["envId"],
+                            "x": sim_config.partition_config["exchange"],
+                            "m": sim_config.partition_config["market"],
+                            "s": sim_config.partition_config["simId"],
+                            "p": sim_config.partition_config["_id"],
+                            "depth": sim_config.partition_config["depth"],
+                            "allowOrderConflicts": sim_config.partition_config["allowOrderConflicts"],
+                            "ob": orderbook['_id'],
+                            "ts": datetime.now(),
+                            "topBuy": orderbook['buy'][0][0],
+                            "buyRate": buy_rate,
+                            "buyCount": len(buy_trades),
+                            "buyMatch": str(buy_match).split('.')[1],
+                            "buyDepth": buy_depth,
+                            "buys": buys if len(buys) > 0 else None,
+                            "topSell": orderbook['sell'][0][0],
+                            "sellRate": sell_rate,
+                            "sellCount": len(sell_trades),
+                            "sellMatch": str(sell_match).split('.')[1],
+                            "sellDepth": sell_depth,
+                            "sells": sells if len(sells) > 0 else None,
+                            "funds": funds,
+                            "inventory": inventory,
+                        })
 
         except StopIteration:
             # logging.info('StopIteration Detected')
-                  # Send the matchings to the database
-            if len (matchings) > 0:
-                sim_config.sim_db.matchings.insert_many(matchings)
+
+            with timer.stage("writes"):
+
+                # End of partition: write out the remaining sim trades
+                trade_sink.close()
+
+                # Send the remaining matchings to the database
+                matchings_sink.close()
 
             logging.info(
                 "{0:24}{1:8d}".format("CO Calls:", CO_calls))
@@ -310,6 +439,12 @@ def simulate():
             logging.info(
                 "    {0:20}{1:8d}".format("Notion Failures:", matching_engine.sell_notion_failure_count))
 
+            if timer.enabled:
+                timer.log()
+                sim_config.sim_db.partitions.update_one(
+                    {"_id": partition_id},
+                    {"$set": {"stageTimes": timer.report()}})
+
             returncode = 0
 
         except KeyError as err:
@@ -319,12 +454,37 @@ def simulate():
 
     except Exception as err:
         logging.exception('Exception: %s', err)
+        returncode = 1
 
     except:
         logging.exception('Unknown Exception')
+        returncode = 1
 
     finally:
 
+        sim_trace.disable()
+
+        # Stop prefetching if the partition did not complete
+        if isinstance(orderbooks, PrefetchingOrderbooks):
+            orderbooks.close()
+
+        # Write out the buffered sim trades if the partition did not
+        # complete
+        if trade_sink != None:
+            try:
+                trade_sink.close()
+            except Exception as err:
+                logging.exception('Exception: %s', err)
+                returncode = 1
+
+        # Stop the matchings writer if the partition did not complete
+        if matchings_sink != None:
+            try:
+                matchings_sink.close()
+            except Exception as err:
+                logging.exception('Exception: %s', err)
+                returncode = 1
+
         """
         # Send the matchings to the database
         if len (matchings) > 0:
@@ -360,7 +520,30 @@ def simulate():
             "    {0:20}{1:8d}".format("Notion Failures:", matching_engine.sell_notion_failure_count))
         """
 
-        sys.exit(returncode)
+    return returncode
+
+
+def simulate():
+
+    logging.basicConfig(
+        format='[%(levelname)-5s] %(message)s',
+        level=logging.INFO,
+        datefmt='')
+
+    logging.debug(f'simulate args: {sys.argv}')
+
+    if len(sys.argv) == 2:
+        partition_id = ObjectId(sys.argv[1])
+    else:
+        assert False, 'Usage: simulate <Simulation ObjectId>'
+
+    remote_mongo_client, local_mongo_client = connect()
+
+    sys.exit(simulate_partition(
+        partition_id,
+        remote_mongo_client=remote_mongo_client,
+        local_mongo_client=local_mongo_client,
+    ))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+import contextlib
+import logging
+import os
+import time
+
+
+class Stage:
+    """Context manager timing one entry into a stage"""
+
+    __slots__ = ("timer", "name")
+
+    def __init__(self, timer, name: str):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.start(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.stop()
+        return False
+
+
+# Handed out for every stage while timing is disabled
+NULL_STAGE = contextlib.nullcontext()
+
+
+class StageTimer:
+    """
+    Counts the entries into each stage of a simulation and accumulates
+    their wall and CPU time.  Stages may nest; time spent in an inner
+    stage is charged to it alone, so the stages add up to the total.
+    CPU time is process-wide, so it includes background writer threads.
+
+    Disabled timers hand out a shared no-op context, so instrumented
+    code costs next to nothing unless timing is switched on.
+    """
+
+    enabled: bool = False
+
+    def __init__(self, enabled: bool = True):
+
+        self.enabled = enabled
+        self.totals = {}
+        self.stages = {}
+        self.stack = []
+
+    @classmethod
+    def from_config(cls, partition_config: dict):
+        """Enabled by $SIM_PROFILE or the partition's profileStages flag"""
+
+        return cls(enabled=bool(os.environ.get('SIM_PROFILE')) or
+                   bool(partition_config.get("profileStages", False)))
+
+    def stage(self, name: str):
+
+        if not self.enabled:
+            return NULL_STAGE
+
+        stage = self.stages.get(name)
+
+        if stage is None:
+            stage = self.stages[name] = Stage(self, name)
+
+        return stage
+
+    def start(self, name: str) -> None:
+        # name, wall, cpu, wall and cpu of nested stages
+        self.stack.append([name, time.perf_counter(), time.process_time(),
+                           0.0, 0.0])
+
+    def stop(self) -> None:
+
+        name, wall, cpu, inner_wall, inner_cpu = self.stack.pop()
+
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+
+        totals = self.totals.setdefault(name, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += wall - inner_wall
+        totals[2] += cpu - inner_cpu
+
+        if self.stack:
+            self.stack[-1][3] += wall
+            self.stack[-1][4] += cpu
+
+    def report(self) -> dict:
+
+        return {
+            name: {"count": count, "wall": wall, "cpu": cpu}
+            for name, (count, wall, cpu) in self.totals.items()
+        }
+
+    def log(self) -> None:
+
+        if not self.enabled:
+            return
+
+        logging.info("STAGE SUMMARY")
+        logging.info(
+            "    {0:20}{1:>10}{2:>10}{3:>10}".format(
+                "Stage", "Count", "Wall", "CPU"))
+
+        for name, (count, wall, cpu) in self.totals.items():
+            logging.info(
+                "    {0:20}{1:10d}{2:10.3f}{3:10.3f}".format(
+                    name + ':', count, wall, cpu))
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""
+Simulates a parameter sweep in a single replay of the orderbooks.
+
+The partitions must share the channel and time frame; typically they
+are the partitions of one run whose multiplyConfig varies quantityLimit,
+inventoryLimit, actualFeeRate and depth.  Partitions differing only in
+their matching parameters share a trader, and all of them are matched
+together by a SweepMatchingEngine.
+
+Usage: sweep.py <runId | partitionId ...>
+"""
+
+import os
+import sys
+import time
+import importlib
+import logging
+from datetime import datetime
+from pymongo import MongoClient
+from bson.objectid import ObjectId
+import numpy as np
+import sim_config
+import simulate
+from orderbooks import Orderbooks
+from document_sink import make_sink, MongoSink, StreamingSink
+from sweep_matching_engine import SweepMatchingEngine, RESULTS, NOT_MATCHED
+from run_partitions import get_partition_ids
+from trade_records import trade_rates
+from prefetching_orderbooks import PrefetchingOrderbooks
+
+try:
+    profile
+except NameError:
+    def profile(x): return x
+
+
+# Partition settings every partition of a sweep must share
+CHANNEL_KEYS = (
+    "envId",
+    "exchange",
+    "market",
+    "startTime",
+    "endTime",
+)
+
+# Partition settings the trader computes its orders from.  Everything
+# else (ids, timestamps, the inventory limit, the min notional) only
+# labels the partition or is applied by the matching engine.
+TRADER_KEYS = CHANNEL_KEYS + (
+    "trader",
+    "tick",
+    "depth",
+    "quantityLimit",
+    "feeRate",
+    "actualFeeRate",
+    "pdf",
+    "priceDepthLimit",
+    "allowOrderConflicts",
+)
+
+
+def trader_key(partition: dict) -> str:
+    """Partitions with the same key see the same orders from the trader"""
+
+    return repr([(key, partition.get(key)) for key in TRADER_KEYS])
+
+
+def make_trader(partition: dict) -> tuple:
+    """A trader for the partition and the rate precision of its tick"""
+
+    sim_config.partition_config = partition
+    sim_config.init(partition)
+
+    if __debug__:
+        from co1 import Trader
+        trader = Trader(sim_config)
+
+    else:
+        trader = importlib.import_module(
+            partition["trader"].lower()).Trader(sim_config)
+
+    return trader, sim_config.rate_precision
+
+
+@profile
+def sweep_partitions(
+    partition_ids: list,
+    *,
+    remote_mongo_client: MongoClient,
+    local_mongo_client: MongoClient,
+) -> int:
+    """
+    Simulate the partitions together and return the return code
+    (0 on success).
+    """
+
+    returncode = 0
+
+    assert os.environ['SIMULATOR_DB'], 'SIMULATOR_DB Not Defined'
+    sim_config.sim_db = remote_mongo_client[os.environ['SIMULATOR_DB']]
+    sim_config.sim_configuration_db = remote_mongo_client['sim_configuration']
+
+    local_sim_db = local_mongo_client['sim']
+
+    partitions = [
+        sim_config.sim_db.partitions.find_one({"_id": ObjectId(partition_id)})
+        for partition_id in partition_ids
+    ]
+    assert all(partitions), 'Unknown Trader Configuration'
+
+    for key in CHANNEL_KEYS:
+        assert all(p[key] == partitions[0][key] for p in partitions), \
+            f'Partitions Differ In {key}'
+
+    # One trader per distinct non-matching configuration
+    groups = {}
+    for k, partition in enumerate(partitions):
+        groups.setdefault(trader_key(partition), []).append(k)
+
+    traders = [
+        (np.array(members), *make_trader(partitions[members[0]]))
+        for members in groups.values()
+    ]
+
+    logging.info("{0:30}{1:<d}".format("Partitions:", len(partitions)))
+    logging.info("{0:30}{1:<d}".format("Traders:", len(traders)))
+
+    trade_sink = make_sink(
+        partitions[0].get("tradeSink", "mongo"),
+        collection=sim_config.sim_db.trades,
+        path=partitions[0].get(
+            "tradeSinkPath", f'{partitions[0]["runId"]}.trades.json'),
+        batch_size=partitions[0].get("tradeBatchSize", 1000),
+    )
+
+    matchings_sink = StreamingSink(
+        MongoSink(sim_config.sim_db.matchings),
+        batch_size=partitions[0].get("matchingsBatchSize", 1000),
+    )
+
+    matching_engine = SweepMatchingEngine.from_partitions(
+        partitions, trade_sink=trade_sink)
+
+    depths = [p["depth"] for p in partitions]
+    sweep_depths = sorted(set(depths))
+
+    orderbooks = None
+
+    try:
+
+        # Deep enough for every partition; each trims the books itself
+        orderbooks = simulate.open_orderbooks(
+            {**partitions[0], "depth": 0 if 0 in depths else max(depths)},
+            local_sim_db.orderbooks)
+
+        buy_rates = np.zeros(len(partitions))
+        sell_rates = np.zeros(len(partitions))
+
+        while True:
+
+            orderbook = orderbooks.next()
+
+            sim_config.orderbook_id = orderbook['_id']
+
+            buy_trades = orderbook["buy_trades"]
+            sell_trades = orderbook["sell_trades"]
+
+            # The books each depth sees, all trimmed with one search
+            books = dict(zip(sweep_depths, zip(
+                Orderbooks.apply_depths(
+                    sweep_depths,
+                    orderbook['buy'],
+                    orderbook.get('buyNotional')),
+                Orderbooks.apply_depths(
+                    sweep_depths,
+                    orderbook['sell'],
+                    orderbook.get('sellNotional')),
+            )))
+
+            for members, trader, rate_precision in traders:
+
+                buyob, sellob = books[partitions[members[0]]["depth"]]
+
+                # The settings sim_config.init() made for the group
+                sim_config.partition_config = partitions[members[0]]
+                sim_config.rate_precision = rate_precision
+                buy_rates[members], sell_rates[members] = \
+                    trader.compute_orders(buyob=buyob, sellob=sellob)
+
+            buy_codes, sell_codes = matching_engine.match(
+                buy_rate=buy_rates,
+                sell_rate=sell_rates,
+                buy_trades=buy_trades,
+                sell_trades=sell_trades,
+            )
+
+            if np.all(buy_codes == NOT_MATCHED):
+                continue
+
+            buys = trade_rates(buy_trades) if len(buy_trades) > 0 else None
+            sells = trade_rates(sell_trades) if len(sell_trades) > 0 else None
+
+            for k in np.flatnonzero(buy_codes != NOT_MATCHED):
+
+                partition = partitions[k]
+                buyob, sellob = books[partition["depth"]]
+                buy_rate = buy_rates[k].item()
+                sell_rate = sell_rates[k].item()
+                funds, inventory = matching_engine.assets[k].tolist()
+
+                matchings_sink.write({
+                    "runId": partition["runId"],
+                    "simVersion": partition["simVersion"],
+                    "e": partition["envId"],
+                    "x": partition["exchange"],
+                    "m": partition["market"],
+                    "s": partition["simId"],
+                    "p": partition["_id"],
+                    "depth": partition["depth"],
+                    "allowOrderConflicts": partition["allowOrderConflicts"],
+                    "ob": orderbook['_id'],
+                    "ts": datetime.now(),
+                    "topBuy": orderbook['buy'][0][0],
+                    "buyRate": buy_rate,
+                    "buyCount": len(buy_trades),
+                    "buyMatch": RESULTS[buy_codes[k]].name,
+                    "buyDepth": Orderbooks.depth_below(
+                        buy_rate, buyob, orderbook.get('buyQuantity'),
+                        buy=True),
+                    "buys": buys,
+                    "topSell": orderbook['sell'][0][0],
+                    "sellRate": sell_rate,
+                    "sellCount": len(sell_trades),
+                    "sellMatch": RESULTS[sell_codes[k]].name,
+                    "sellDepth": Orderbooks.depth_below(
+                        sell_rate, sellob, orderbook.get('sellQuantity'),
+                        buy=False),
+                    "sells": sells,
+                    "funds": funds,
+                    "inventory": inventory,
+                })
+
+    except StopIteration:
+
+        trade_sink.close()
+
+        for k, partition in enumerate(partitions):
+            logging.info(
+                "{0:30}{1:8d}{2:8d}".format(
+                    f'Partition {partition["_id"]}:',
+                    matching_engine.buy_match_count[k],
+                    matching_engine.sell_match_count[k]))
+
+    except Exception as err:
+        logging.exception('Exception: %s', err)
+        returncode = 1
+
+    finally:
+
+        # Stop prefetching if the sweep did not complete
+        if isinstance(orderbooks, PrefetchingOrderbooks):
+            orderbooks.close()
+
+        # Write out the buffered sim trades if the sweep did not complete
+        try:
+            trade_sink.close()
+        except Exception as err:
+            logging.exception('Exception: %s', err)
+            returncode = 1
+
+        try:
+            matchings_sink.close()
+        except Exception as err:
+            logging.exception('Exception: %s', err)
+            returncode = 1
+
+    status = "COMPLETE" if returncode == 0 else "FAILED"
+
+    for partition in partitions:
+        sim_config.sim_db.partitions.update_one(
+            {"_id": partition["_id"]}, {"$set": {"status": status}})
+
+    return returncode
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        format='[%(levelname)-5s] %(message)s',
+        level=logging.INFO,
+        datefmt='')
+
+    start_execution = time.time()
+
+    assert len(sys.argv) >= 2, 'Usage: sweep.py <runId | partitionId ...>'
+
+    remote_mongo_client, local_mongo_client = simulate.connect()
+
+    returncode = sweep_partitions(
+        get_partition_ids(
+            remote_mongo_client[os.environ['SIMULATOR_DB']], sys.argv[1:]),
+        remote_mongo_client=remote_mongo_client,
+        local_mongo_client=local_mongo_client,
+    )
+
+    logging.info(
+        "{0:30}{1:4.1f}".format(
+            'Execution Time (secs):', time.time() - start_execution))
+
+    sys.exit(returncode)
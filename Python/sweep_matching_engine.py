@@ -0,0 +1,402 @@
+import logging
+import math
+from datetime import datetime
+
+import numpy as np
+
+import sim_config
+from document_sink import DocumentSink
+from match_result import MatchResult
+from trade_records import trade_at, trade_columns
+
+try:
+    profile
+except NameError:
+    def profile(x): return x
+
+
+# Match results are returned as int8 codes indexing RESULTS;
+# NOT_MATCHED marks configs that were not active for the orderbook
+RESULTS = tuple(MatchResult)
+NO_TRADES, BLOCKED, MIN_NOTIONAL_FAILURE, UNMATCHABLE, MATCHED = (
+    RESULTS.index(result) for result in (
+        MatchResult.NO_TRADES,
+        MatchResult.BLOCKED,
+        MatchResult.MIN_NOTIONAL_FAILURE,
+        MatchResult.UNMATCHABLE,
+        MatchResult.MATCHED,
+    ))
+NOT_MATCHED = -1
+
+
+class SweepMatchingEngine:
+    """
+    Matches each orderbook's history trades for N configurations at once.
+
+    Same rules as MatchingEngine, but the assets are an (N, 2) array and
+    QL, IL, actual_fee_rate and min_notional are (N,) arrays, so a whole
+    parameter sweep is evaluated in a single replay of the orderbooks.
+    Each config gets exactly the results and assets MatchingEngine would
+    give it; the counters are (N,) arrays.
+    """
+
+    assets: np.array
+    QL: np.array
+    IL: np.array
+    actual_fee_rate: np.array
+    min_notional: np.array
+    partitions: list = None
+    trade_sink: DocumentSink = None
+
+    def __init__(
+        self,
+        *,
+        QL,
+        IL,
+        actual_fee_rate,
+        min_notional=0.0005,
+        assets: np.array = None,
+        partitions: list = None,
+        trade_sink: DocumentSink = None,
+    ) -> None:
+
+        self.QL = np.array(QL, dtype=float, ndmin=1)
+        self.n = len(self.QL)
+
+        assert np.all(self.QL > 0)
+
+        self.IL = np.broadcast_to(
+            np.array(IL, dtype=float), self.n).copy()
+        self.actual_fee_rate = np.broadcast_to(
+            np.array(actual_fee_rate, dtype=float), self.n).copy()
+        self.min_notional = np.broadcast_to(
+            np.array(min_notional, dtype=float), self.n).copy()
+
+        self.assets = np.tile(
+            np.array([math.inf, 0], dtype=float), (self.n, 1)) \
+            if assets is None else np.array(assets, dtype=float)
+        assert self.assets.shape == (self.n, 2)
+
+        # Partition documents, one per config, to tag the sim trades with
+        assert partitions == None or len(partitions) == self.n
+        self.partitions = partitions
+
+        # Without a sink the sim trades are not recorded
+        self.trade_sink = trade_sink
+
+        counter = lambda: np.zeros(self.n, dtype=np.int64)
+
+        self.buy_blocked_count = counter()
+        self.buy_no_trades_count = counter()
+        self.buy_notion_failure_count = counter()
+        self.buy_match_count = counter()
+        self.buy_unmatchable_count = counter()
+        self.sell_blocked_count = counter()
+        self.sell_match_count = counter()
+        self.sell_no_trades_count = counter()
+        self.sell_notion_failure_count = counter()
+        self.sell_unmatchable_count = counter()
+
+        self.sim_trades_idx = counter()
+
+    @classmethod
+    def from_partitions(
+        cls,
+        partitions: list,
+        *,
+        trade_sink: DocumentSink = None,
+    ):
+
+        return cls(
+            QL=[p['quantityLimit'] for p in partitions],
+            IL=[p['inventoryLimit'] for p in partitions],
+            actual_fee_rate=[p['actualFeeRate'] for p in partitions],
+            min_notional=[p['minNotional'] for p in partitions],
+            partitions=partitions,
+            trade_sink=trade_sink,
+        )
+
+    def __str__(self):
+        return str(self.__class__) + '\n' + '\n'.join(('{} = {}'.format(
+            item, self.__dict__[item]
+        ) for item in self.__dict__))
+
+    def flush(self) -> None:
+        """Write out any buffered sim trades"""
+
+        if self.trade_sink != None:
+            self.trade_sink.flush()
+
+    def results(self, codes: np.array) -> list:
+        """Map result codes back to MatchResults (None when not matched)"""
+        return [RESULTS[code] if code != NOT_MATCHED else None
+                for code in codes]
+
+    @profile
+    def match(
+        self,
+        buy_rate: np.array,
+        sell_rate: np.array,
+        buy_trades: [dict],
+        sell_trades: [dict],
+        active: np.array = None,
+    ):
+        """
+        Match every active config; configs are active by default when
+        both of their rates are positive, as in simulate.py.
+        """
+
+        buy_rate = np.broadcast_to(np.array(buy_rate, dtype=float), self.n)
+        sell_rate = np.broadcast_to(np.array(sell_rate, dtype=float), self.n)
+
+        if active is None:
+            active = (buy_rate > 0) & (sell_rate > 0)
+
+        # As with MatchingEngine, sell starts from the assets buy left
+        buy_result = self.buy(
+            buy_rate=buy_rate,
+            sell_rate=sell_rate,
+            sell_trades=sell_trades,
+            active=active,
+        )
+
+        sell_result = self.sell(
+            sell_rate=sell_rate,
+            buy_trades=buy_trades,
+            active=active,
+        )
+
+        return buy_result, sell_result
+
+    def finish(
+        self,
+        results: np.array,
+        done: np.array,
+        matched: np.array,
+        failure: int,
+        failure_count: np.array,
+    ) -> None:
+        """Record the result of the configs that stopped matching"""
+
+        results[done] = np.where(matched[done], MATCHED, failure)
+        failure_count += done & ~matched
+
+    def record(
+        self,
+        matches: np.array,
+        trade: dict,
+        fields: dict,
+    ) -> None:
+
+        for k in np.flatnonzero(matches):
+
+            partition = self.partitions[k] if self.partitions != None \
+                else sim_config.partition_config
+
+            document = {
+                "runId": partition["runId"],
+                "simVersion": partition["simVersion"],
+                "s": partition["simId"],
+                "p": partition["_id"],
+            }
+
+            for key, value in fields.items():
+                document[key] = value[k].item() \
+                    if isinstance(value, np.ndarray) else value
+
+            document["o"] = sim_config.orderbook_id
+            document["t"] = trade['_id']
+            document["historyTrade"] = trade
+
+            self.trade_sink.write(document)
+
+    @profile
+    def buy(
+        self,
+        buy_rate: np.array,
+        sell_rate: np.array,
+        sell_trades: [dict],
+        active: np.array,
+    ) -> np.array:
+
+        results = np.full(self.n, NOT_MATCHED, dtype=np.int8)
+
+        if len(sell_trades) == 0:
+            results[active] = NO_TRADES
+            self.buy_no_trades_count += active
+            return results
+
+        funds = self.assets[:, 0].copy()
+        inventory = self.assets[:, 1].copy()
+
+        ceiling = self.IL - inventory * sell_rate
+        quantity = np.minimum(np.minimum(self.QL, funds), ceiling)
+
+        blocked = active & ((ceiling <= 0) | (funds <= 0))
+        results[blocked] = BLOCKED
+        self.buy_blocked_count += blocked
+
+        running = active & ~blocked
+        matched = np.zeros(self.n, dtype=bool)
+        match = np.zeros(self.n, dtype=np.int64)
+
+        # Configs with inactive (zero) rates are masked out of the results
+        with np.errstate(divide='ignore', invalid='ignore'):
+
+            rates, quantities = trade_columns(sell_trades)
+
+            for i, rate in enumerate(rates):
+
+                # Trades higher than rate are ignored
+                eligible = running & (rate <= buy_rate)
+
+                if not eligible.any():
+                    if not running.any():
+                        break
+                    continue
+
+                exhausted = eligible & (quantity <= 0)
+                if exhausted.any():
+                    self.finish(results, exhausted, matched,
+                                UNMATCHABLE, self.buy_unmatchable_count)
+                    running &= ~exhausted
+                    eligible &= ~exhausted
+
+                base = np.minimum(quantity, quantities[i] * buy_rate)
+                quote = base / buy_rate
+                fee = quote * self.actual_fee_rate
+                notion = quote * buy_rate
+
+                # Ensure we meet the min notional
+                failed = eligible & (notion < self.min_notional)
+                if failed.any():
+                    self.finish(results, failed, matched,
+                                MIN_NOTIONAL_FAILURE,
+                                self.buy_notion_failure_count)
+                    running &= ~failed
+                    eligible &= ~failed
+
+                if not eligible.any():
+                    continue
+
+                matched |= eligible
+                self.buy_match_count += eligible
+
+                if self.trade_sink != None:
+                    self.record(eligible, trade_at(sell_trades, i), {
+                        "ceiling": ceiling,
+                        "idx": self.sim_trades_idx,
+                        "match": match,
+                        "ts": datetime.now(),
+                        "buy": True,
+                        "quantity": quantity,
+                        "r": buy_rate,
+                        "q": quote,
+                        "b": -base,
+                        "buyFee": fee,
+                    })
+
+                quantity = np.where(eligible, quantity - base, quantity)
+                self.assets[eligible, 0] += -base[eligible]
+                self.assets[eligible, 1] += (quote - fee)[eligible]
+
+                self.sim_trades_idx += eligible
+                match += eligible
+
+        self.finish(results, running, matched,
+                    UNMATCHABLE, self.buy_unmatchable_count)
+
+        return results
+
+    @profile
+    def sell(
+        self,
+        sell_rate: np.array,
+        buy_trades: [dict],
+        active: np.array,
+    ) -> np.array:
+
+        results = np.full(self.n, NOT_MATCHED, dtype=np.int8)
+
+        if len(buy_trades) == 0:
+            results[active] = NO_TRADES
+            self.sell_no_trades_count += active
+            return results
+
+        inventory = self.assets[:, 1].copy()
+
+        quantity = np.minimum(self.QL, inventory * sell_rate)
+
+        blocked = active & (quantity <= 0)
+        results[blocked] = BLOCKED
+        self.sell_blocked_count += blocked
+
+        running = active & ~blocked
+        matched = np.zeros(self.n, dtype=bool)
+        match = np.zeros(self.n, dtype=np.int64)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+
+            rates, quantities = trade_columns(buy_trades)
+
+            for i, rate in enumerate(rates):
+
+                # Trades lower than rate are ignored
+                eligible = running & (rate >= sell_rate)
+
+                if not eligible.any():
+                    if not running.any():
+                        break
+                    continue
+
+                exhausted = eligible & (quantity <= 0)
+                if exhausted.any():
+                    self.finish(results, exhausted, matched,
+                                UNMATCHABLE, self.sell_unmatchable_count)
+                    running &= ~exhausted
+                    eligible &= ~exhausted
+
+                base = np.minimum(quantity, quantities[i] * sell_rate)
+                quote = base / sell_rate
+                fee = base * self.actual_fee_rate
+                notion = quote * sell_rate
+
+                # Ensure we meet the min notional
+                failed = eligible & (notion < self.min_notional)
+                if failed.any():
+                    self.finish(results, failed, matched,
+                                MIN_NOTIONAL_FAILURE,
+                                self.sell_notion_failure_count)
+                    running &= ~failed
+                    eligible &= ~failed
+
+                if not eligible.any():
+                    continue
+
+                matched |= eligible
+                self.sell_match_count += eligible
+
+                if self.trade_sink != None:
+                    self.record(eligible, trade_at(buy_trades, i), {
+                        "idx": self.sim_trades_idx,
+                        "match": match,
+                        "ts": datetime.now(),
+                        "buy": False,
+                        "quantity": quantity,
+                        "r": sell_rate,
+                        "q": -quote,
+                        "b": base,
+                        "sellFee": fee,
+                    })
+
+                quantity = np.where(eligible, quantity - base, quantity)
+                self.assets[eligible, 0] += (base - fee)[eligible]
+                self.assets[eligible, 1] += -quote[eligible]
+
+                self.sim_trades_idx += eligible
+                match += eligible
+
+        self.finish(results, running, matched,
+                    UNMATCHABLE, self.sell_unmatchable_count)
+
+        return results
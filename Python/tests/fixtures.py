@@ -6,6 +6,7 @@ from bson.objectid import ObjectId
 from pymongo import MongoClient
 import json
 import math
+import numpy as np
 import sys
 
 buy_side: bool = None
@@ -22,6 +23,28 @@ def selling():
     buy_side = False
 
 
+@pytest.fixture(scope="module", params=[False, True], ids=["python", "kernel"])
+def matching_kernel(request):
+    """
+    Runs a module's tests with and without the matching kernel, each run
+    starting from the state of the module's shared matching_engine.
+    """
+    from matching_engine import MatchingEngine
+
+    engine = getattr(request.module, "matching_engine", None)
+    state = None if engine == None else {
+        k: v.copy() if isinstance(v, np.ndarray) else v
+        for k, v in engine.__dict__.items()}
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(MatchingEngine, "kernel", request.param)
+        yield request.param
+
+    if engine != None:
+        engine.__dict__.clear()
+        engine.__dict__.update(state)
+
+
 @pytest.fixture()
 def load_object_ids():
     sim_config.sim_id = ObjectId()
@@ -0,0 +1,139 @@
+import json
+import os
+import subprocess
+import sys
+from datetime import timedelta
+import numpy as np
+import pytest
+from book_server import attach, find_books, publish, unpublish
+from orderbook_cache import OrderbookCacheWriter, CachedOrderbooks, cache_name
+from simulate import find_orderbooks
+from test_orderbook_cache import make_orderbook, write_cache, start, end
+
+
+@pytest.fixture()
+def books_dir(tmp_path, monkeypatch):
+
+    monkeypatch.setenv('SIM_BOOKS', str(tmp_path))
+
+    path = str(tmp_path / cache_name(0, "bittrex", "btc-xrp", 2000))
+
+    writer = OrderbookCacheWriter(
+        path,
+        envId=0,
+        exchange="bittrex",
+        market="btc-xrp",
+        depth=2000,
+        trim=True,
+        start=start,
+        end=end,
+    )
+
+    for i in range(10):
+        writer.append(*make_orderbook(i))
+
+    segments = publish(path, writer.arrays(), writer.manifest)
+
+    yield path
+
+    unpublish(path, segments)
+
+
+def test_find_books(books_dir):
+
+    assert find_books(0, "bittrex", "btc-xrp", 1000, start, end) == books_dir
+    assert not find_books(0, "bittrex", "btc-xrp", 3000, start, end)
+    assert not find_books(0, "bittrex", "btc-eth", 1000, start, end)
+
+
+def rewrite_manifest(path: str, **changes) -> None:
+
+    manifest_path = os.path.join(path, "manifest.json")
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    for key, change in changes.items():
+        manifest[key] = change(manifest[key])
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def test_skip_stopped_server(books_dir):
+
+    # The pid of a process that has exited
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+
+    rewrite_manifest(books_dir, pid=lambda pid: process.pid)
+
+    assert not find_books(0, "bittrex", "btc-xrp", 1000, start, end)
+
+
+def test_attach_failure_falls_back(books_dir, tmp_path, monkeypatch):
+
+    # The segments are gone, as when the server stops after find_books
+    rewrite_manifest(books_dir, segments=lambda segments: {
+        name: {**layout, "segment": layout["segment"] + "-gone"}
+        for name, layout in segments.items()})
+
+    with pytest.raises(FileNotFoundError):
+        attach(books_dir)
+
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    monkeypatch.setenv('SIM_CACHE', str(cache_dir))
+    write_cache(str(cache_dir), start, end)
+
+    orderbooks = find_orderbooks({
+        "envId": 0,
+        "exchange": "bittrex",
+        "market": "btc-xrp",
+        "depth": 1000,
+        "startTime": start,
+        "endTime": end,
+    }, None)
+
+    assert isinstance(orderbooks, CachedOrderbooks)
+    assert "segments" not in orderbooks.manifest
+    assert len(orderbooks) == 10
+
+
+def test_replay_shared(books_dir):
+
+    arrays = attach(books_dir)
+
+    # Attached once per process, and read-only
+    assert attach(books_dir) is arrays
+    assert not arrays["buy"].flags.writeable
+
+    orderbooks = CachedOrderbooks(
+        books_dir,
+        start=start + timedelta(minutes=2),
+        end=start + timedelta(minutes=7),
+        arrays=arrays,
+    )
+
+    assert len(orderbooks) == 5
+
+    for i in range(2, 7):
+
+        orderbook = orderbooks.next()
+        expected, buy_trades, sell_trades = make_orderbook(i)
+
+        assert orderbook["ts"] == expected["ts"]
+        assert orderbook["x"] == "bittrex"
+        assert np.array_equal(orderbook["buy"], expected["buy"])
+        assert np.array_equal(orderbook["sell"], expected["sell"])
+        assert np.array_equal(orderbook["buyQuantity"],
+                              np.cumsum(expected["buy"][:, 1]))
+
+        replayed_trades = orderbook["buy_trades"].to_list()
+
+        for key in ("ts", "r", "q"):
+            assert [t[key] for t in replayed_trades] == \
+                [t[key] for t in buy_trades]
+
+    with pytest.raises(StopIteration):
+        orderbooks.next()
@@ -0,0 +1,160 @@
+import math
+import threading
+import numpy as np
+import pytest
+from bson import json_util
+from bson.objectid import ObjectId
+import sim_config
+from document_sink import MemorySink, FileSink, StreamingSink, make_sink
+from matching_engine import MatchingEngine
+
+
+class CountingSink(MemorySink):
+
+    batches: int = 0
+
+    def write_batch(self, documents: list) -> None:
+        self.batches += 1
+        super().write_batch(documents)
+
+
+@pytest.fixture()
+def partition_ids():
+    sim_config.partition_config["runId"] = ObjectId()
+    sim_config.partition_config["simId"] = ObjectId()
+    sim_config.partition_config["_id"] = ObjectId()
+    sim_config.partition_config["simVersion"] = "testing"
+    sim_config.orderbook_id = ObjectId()
+
+
+def test_batches_are_written_when_full():
+
+    sink = CountingSink(batch_size=3)
+
+    for i in range(7):
+        sink.write({"i": i})
+
+    assert sink.batches == 2
+    assert len(sink.buffer) == 1
+
+    sink.close()
+
+    assert sink.batches == 3
+    assert sink.written_count == 7
+    assert [d["i"] for d in sink.documents] == list(range(7))
+
+
+def test_file_sink(tmp_path):
+
+    path = str(tmp_path / "trades.json")
+    sink = FileSink(path, batch_size=2)
+
+    documents = [{"_id": ObjectId(), "r": 0.1 * i} for i in range(5)]
+    for document in documents:
+        sink.write(document)
+    sink.close()
+
+    with open(path) as f:
+        assert [json_util.loads(line) for line in f] == documents
+
+
+class BlockingSink(MemorySink):
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def write_batch(self, documents: list) -> None:
+        self.release.wait()
+        super().write_batch(documents)
+
+
+class FailingSink(MemorySink):
+
+    def write_batch(self, documents: list) -> None:
+        raise IOError("write failed")
+
+
+def test_streaming_sink_writes_in_order():
+
+    target = MemorySink()
+    sink = StreamingSink(target, batch_size=10, max_pending=2)
+
+    for i in range(95):
+        sink.write({"i": i})
+
+    sink.close()
+
+    assert [d["i"] for d in target.documents] == list(range(95))
+
+
+def test_streaming_sink_applies_backpressure():
+
+    target = BlockingSink()
+    sink = StreamingSink(target, batch_size=1, max_pending=2)
+
+    def produce():
+        for i in range(10):
+            sink.write({"i": i})
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    producer.join(timeout=0.5)
+
+    # One batch being written plus two pending; the producer must wait
+    assert producer.is_alive()
+    assert len(target.documents) == 0
+
+    target.release.set()
+    producer.join(timeout=5)
+    sink.close()
+
+    assert len(target.documents) == 10
+
+
+def test_streaming_sink_raises_write_errors():
+
+    sink = StreamingSink(FailingSink(), batch_size=1)
+    sink.write({"i": 0})
+
+    with pytest.raises(IOError):
+        sink.close()
+
+
+def test_make_sink():
+
+    assert isinstance(make_sink("memory"), MemorySink)
+
+    with pytest.raises(Exception):
+        make_sink("unknown")
+
+
+def test_matching_engine_buffers_sim_trades(partition_ids):
+
+    sink = MemorySink(batch_size=1000)
+
+    matching_engine = MatchingEngine(
+        assets=np.array([math.inf, 0]),
+        QL=0.02,
+        IL=0.02,
+        actual_fee_rate=0.0027,
+        trade_sink=sink,
+    )
+
+    matching_engine.buy(
+        start_assets=matching_engine.assets,
+        buy_rate=0.2,
+        sell_rate=0.21,
+        sell_trades=[
+            {"_id": ObjectId(), "r": 0.2, "q": 0.05},
+            {"_id": ObjectId(), "r": 0.2, "q": 0.05},
+        ],
+    )
+
+    assert matching_engine.buy_match_count == 2
+    assert len(sink.documents) == 0
+
+    matching_engine.flush()
+
+    assert len(sink.documents) == 2
+    assert all(d["o"] == sim_config.orderbook_id for d in sink.documents)
@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import tuning_generator
+from generate_tunings import generate_tunings, get_config_names
+
+
+class FakeConfigs:
+
+    def __init__(self, configs: list):
+        self.configs = configs
+        self.queries = []
+
+    def find(self, filter: dict, projection: dict = None):
+
+        self.queries.append(filter)
+
+        return [{"name": c["name"]} for c in self.configs
+                if all(c.get(key) == value for key, value in filter.items())]
+
+
+class FakeTunings:
+
+    def __init__(self):
+        self.batches = []
+
+    def bulk_write(self, requests: list, ordered: bool = True):
+        assert not ordered
+        self.batches.append(list(requests))
+
+
+def make_config_db(configs: list = ()) -> dict:
+
+    return {
+        "generate.tuning": FakeConfigs(list(configs)),
+        "tuning": FakeTunings(),
+    }
+
+
+def test_get_config_names():
+
+    config_db = make_config_db([
+        {"name": "a", "market": "btc-xrp"},
+        {"name": "b", "market": "btc-eth"},
+        {"name": "c", "market": "btc-xrp"},
+    ])
+
+    # Config names are taken as given
+    assert get_config_names(config_db, ["c", "x"]) == ["c", "x"]
+    assert config_db["generate.tuning"].queries == []
+
+    # A JSON filter on the configs
+    assert get_config_names(config_db, ['{"market": "btc-xrp"}']) == \
+        ["a", "c"]
+
+    # Every config
+    assert get_config_names(config_db, []) == ["a", "b", "c"]
+
+
+@pytest.fixture()
+def tunings(monkeypatch):
+    """The tuning (or exception) each config generates"""
+
+    tunings = {}
+
+    def generate_tuning(name):
+
+        tuning = tunings[name]
+
+        if isinstance(tuning, Exception):
+            raise tuning
+
+        return {"name": name}, tuning
+
+    monkeypatch.setattr(tuning_generator, "generate_tuning", generate_tuning)
+
+    return tunings
+
+
+def test_failed_config(tunings):
+
+    names = [f"config-{i}" for i in range(5)]
+
+    for name in names:
+        tunings[name] = {"x": [0.1], "y": [1.0]}
+
+    tunings["config-1"] = RuntimeError('Tuning Failed')
+    tunings["config-3"] = None
+
+    config_db = make_config_db()
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        returncode = generate_tunings(config_db, names, pool, batch_size=2)
+
+    assert returncode == 1
+
+    # The other configs' tunings are still saved; none for no trades
+    upserted = [request for batch in config_db["tuning"].batches
+                for request in batch]
+
+    assert len(upserted) == 3
+    assert all(tuning_generator.tuning_upsert({"name": name}, tunings[name])
+               in upserted for name in ("config-0", "config-2", "config-4"))
+    assert all(len(batch) <= 2 for batch in config_db["tuning"].batches)
+
+
+def test_all_configs_succeed(tunings):
+
+    tunings["config-0"] = {"x": [0.1], "y": [1.0]}
+
+    config_db = make_config_db()
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        assert generate_tunings(config_db, ["config-0"], pool) == 0
+
+    assert len(config_db["tuning"].batches) == 1
@@ -0,0 +1,96 @@
+import random
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from load import close_exports, find_trades, group_trades
+
+
+class FakeTradesCollection:
+    """Just enough of find() for the trade queries of load.py"""
+
+    def __init__(self, trades: list):
+        self.trades = trades
+        self.queries = 0
+
+    def find(self, filter: dict, batch_size: int = None):
+
+        self.queries += 1
+
+        for trade in self.trades:
+
+            if all(trade.get(key) in value["$in"] if isinstance(value, dict)
+                   else trade.get(key) == value
+                   for key, value in filter.items()):
+
+                yield dict(trade)
+
+
+class FakeExporter:
+    """Records whether the export was closed"""
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def make_trades(orderbook_ids: list, start: datetime) -> list:
+
+    rng = random.Random(3)
+    trades = []
+
+    for i, ob in enumerate(orderbook_ids):
+        for _ in range(rng.randint(0, 4)):
+            trades.append({
+                "_id": ObjectId(),
+                "e": 1,
+                "x": "binance",
+                "m": "BTC-ETH",
+                # Some fall outside the books' time frame
+                "ts": start + timedelta(minutes=i - 2),
+                "ob": ob,
+                "buy": rng.random() < 0.5,
+                "r": rng.choice([0.1, 0.2, 0.3]),
+                "q": rng.random(),
+            })
+
+    # A trade of another orderbook and one of another market
+    trades.append({**trades[0], "_id": ObjectId(), "ob": ObjectId()})
+    trades.append({**trades[0], "_id": ObjectId(), "m": "BTC-XRP"})
+
+    return trades
+
+
+def test_group_trades():
+
+    orderbook_ids = [ObjectId() for _ in range(25)]
+    collection = FakeTradesCollection(
+        make_trades(orderbook_ids, datetime(2020, 1, 1)))
+
+    grouped = group_trades(collection, 1, "binance", "BTC-ETH",
+                           orderbook_ids, chunk_size=10)
+
+    # One query per chunk of orderbooks
+    assert collection.queries == 3
+
+    for ob in orderbook_ids:
+
+        expected = find_trades(collection, {
+            "e": 1,
+            "x": "binance",
+            "m": "BTC-ETH",
+            "ob": ob,
+        })
+
+        assert grouped.pop(ob, ([], [])) == expected
+
+    assert grouped == {}
+
+
+def test_close_redis_export_without_cache():
+
+    exporter = FakeExporter()
+
+    # saveRedis on and saveCache off
+    close_exports(None, exporter)
+
+    assert exporter.closed
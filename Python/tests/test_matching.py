@@ -8,7 +8,7 @@ from matching_engine import MatchingEngine
 import json
 import math
 import sys
-from fixtures import load_object_ids, buying, selling
+from fixtures import load_object_ids, buying, selling, matching_kernel
 import fixtures
 import numpy as np
 from match_result import MatchResult
@@ -17,6 +17,9 @@ remote_mongo_client = MongoClient(os.environ['MONGODB'])
 sim_db = remote_mongo_client.sim_dev
 sim_config.trades_collection = sim_db.trades
 
+# Every test runs with and without the matching kernel
+pytestmark = pytest.mark.usefixtures("matching_kernel")
+
 matching_engine = MatchingEngine(
     QL=0.02,
     IL=0.02,
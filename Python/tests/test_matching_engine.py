@@ -1,7 +1,7 @@
 import os
 from bson.objectid import ObjectId
 import sim_config
-from fixtures import load_object_ids, buying, selling
+from fixtures import load_object_ids, buying, selling, matching_kernel
 import logging
 import math
 from matching_engine import MatchingEngine
@@ -14,6 +14,9 @@ remote_mongo_client = MongoClient(os.environ['MONGODB'])
 sim_db = remote_mongo_client.sim_dev
 sim_config.trades_collection = sim_db.trades
 
+# Every test runs with and without the matching kernel
+pytestmark = pytest.mark.usefixtures("matching_kernel")
+
 
 def make_trade(r: float, q: float = None):
 
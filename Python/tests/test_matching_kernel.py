@@ -0,0 +1,196 @@
+import math
+import random
+import numpy as np
+import pytest
+from bson.objectid import ObjectId
+import sim_config
+import matching_kernel
+from document_sink import MemorySink
+from matching_engine import MatchingEngine
+from match_result import MatchResult
+from trade_records import TradeRecords
+
+COUNTERS = (
+    "buy_blocked_count",
+    "buy_no_trades_count",
+    "buy_notion_failure_count",
+    "buy_match_count",
+    "buy_unmatchable_count",
+    "sell_blocked_count",
+    "sell_match_count",
+    "sell_no_trades_count",
+    "sell_notion_failure_count",
+    "sell_unmatchable_count",
+    "sim_trades_idx",
+)
+
+
+@pytest.fixture()
+def partition_ids():
+    sim_config.partition_config["runId"] = ObjectId()
+    sim_config.partition_config["simId"] = ObjectId()
+    sim_config.partition_config["_id"] = ObjectId()
+    sim_config.partition_config["simVersion"] = "testing"
+    sim_config.orderbook_id = ObjectId()
+
+
+def make_engine(kernel: bool, **kwargs) -> MatchingEngine:
+
+    return MatchingEngine(
+        assets=np.array([math.inf, 0], dtype=float),
+        trade_sink=MemorySink(),
+        kernel=kernel,
+        **kwargs)
+
+
+def make_trades(rng, count: int, rate: float, buy: bool) -> list:
+
+    rates = sorted((rate * rng.uniform(0.97, 1.03) for _ in range(count)),
+                   reverse=buy)
+
+    return [{"_id": str(ObjectId()), "r": r, "q": rng.uniform(0.0, 0.05)}
+            for r in rates]
+
+
+def test_results():
+
+    assert matching_kernel.RESULTS[matching_kernel.MATCHED] == \
+        MatchResult.MATCHED
+    assert matching_kernel.RESULTS[matching_kernel.BLOCKED] == \
+        MatchResult.BLOCKED
+
+
+@pytest.mark.parametrize("records", [False, True], ids=["dicts", "records"])
+@pytest.mark.parametrize("IL", [0.03, math.inf])
+def test_kernel_agrees(partition_ids, records, IL):
+
+    rng = random.Random(7)
+
+    engines = [make_engine(kernel, QL=0.01, IL=IL, actual_fee_rate=0.0027,
+                           min_notional=0.0005)
+               for kernel in (False, True)]
+
+    for _ in range(500):
+
+        rate = rng.uniform(0.2, 0.3)
+        buy_rate = rate * rng.uniform(0.98, 1.01)
+        sell_rate = rate * rng.uniform(0.99, 1.02)
+
+        buy_trades = make_trades(rng, rng.randint(0, 6), rate, True)
+        sell_trades = make_trades(rng, rng.randint(0, 6), rate, False)
+
+        if records:
+            buy_trades = TradeRecords.from_trades(buy_trades)
+            sell_trades = TradeRecords.from_trades(sell_trades)
+
+        python, kernel = (
+            engine.match(buy_rate, sell_rate, buy_trades, sell_trades)
+            for engine in engines)
+
+        assert python == kernel
+        assert np.asarray(engines[0].assets).tobytes() == \
+            np.asarray(engines[1].assets).tobytes()
+
+    for counter in COUNTERS:
+        assert getattr(engines[0], counter) == getattr(engines[1], counter)
+
+    assert engines[1].buy_match_count > 0
+    assert engines[1].sell_match_count > 0
+
+    for engine in engines:
+        engine.flush()
+
+    python, kernel = (engine.trade_sink.documents for engine in engines)
+
+    assert len(python) == len(kernel)
+
+    for expected, actual in zip(python, kernel):
+        assert {**expected, "ts": None} == {**actual, "ts": None}
+
+
+@pytest.mark.parametrize("kernel", [False, True], ids=["python", "kernel"])
+def test_assets(partition_ids, kernel):
+
+    engine = make_engine(kernel, QL=0.01, IL=math.inf,
+                         actual_fee_rate=0.0027)
+
+    assert engine.assets.tolist() == [math.inf, 0]
+
+    with pytest.raises(TypeError):
+        engine.assets[1] = 1.0
+
+    engine.assets = np.array([1.0, 0.0])
+    assert engine.funds == 1.0 and engine.inventory == 0.0
+
+    trades = [{"_id": str(ObjectId()), "r": 0.25, "q": 1.0}]
+
+    # Sell starts from the inventory buy left
+    buy_result, sell_result = engine.match(0.25, 0.25, trades, trades)
+
+    assert buy_result == MatchResult.MATCHED
+    assert sell_result == MatchResult.MATCHED
+
+    engine.flush()
+    buy, sell = engine.trade_sink.documents
+
+    assert engine.funds == 1.0 - 0.01 + (sell["b"] - sell["sellFee"])
+    assert engine.inventory == buy["q"] - buy["buyFee"] + sell["q"]
+
+
+def test_start_assets(partition_ids):
+    """Limits come from the start assets, fills add to the engine's"""
+
+    engines = [make_engine(kernel, QL=0.01, IL=math.inf,
+                           actual_fee_rate=0.0027)
+               for kernel in (False, True)]
+
+    trades = [{"_id": str(ObjectId()), "r": 0.25, "q": 0.02}] * 3
+
+    for engine in engines:
+        engine.assets = np.array([0.5, 0.02])
+
+        engine.buy(start_assets=np.array([math.inf, 0.0]), buy_rate=0.25,
+                   sell_rate=0.25, sell_trades=trades)
+        engine.sell(start_assets=np.array([math.inf, 0.1]), sell_rate=0.25,
+                    buy_trades=trades)
+
+    assert np.asarray(engines[0].assets).tobytes() == \
+        np.asarray(engines[1].assets).tobytes()
+    assert engines[1].buy_match_count == 2
+    assert engines[1].sell_match_count == 2
+
+
+def test_compiled():
+    """With numba installed, the compiled loops agree with the Python ones"""
+
+    pytest.importorskip("numba")
+
+    assert matching_kernel.compiled
+
+    rng = np.random.default_rng(11)
+
+    for _ in range(200):
+
+        rates = np.sort(rng.uniform(0.24, 0.26, rng.integers(0, 8)))
+        quantities = rng.uniform(0.0, 0.05, len(rates))
+        buy_rate, sell_rate = rng.uniform(0.24, 0.26, 2)
+        funds, inventory = rng.uniform(0.0, 0.1, 2)
+
+        for match, args in (
+                (matching_kernel.match_buy,
+                 (buy_rate, sell_rate, funds, inventory, funds, inventory,
+                  0.01, 0.03)),
+                (matching_kernel.match_sell,
+                 (sell_rate, inventory, funds, inventory, 0.01))):
+
+            results = []
+
+            for f in (match, match.py_func):
+                index, fills = matching_kernel.fill_buffers(len(rates))
+                code, funds_after, inventory_after, n = f(
+                    rates, quantities[::-1], *args, 0.0027, 0.0005,
+                    index, fills)
+                results.append((code, funds_after, inventory_after,
+                                index[:n].tolist(), fills[:n].tobytes()))
+
+            assert results[0] == results[1]
@@ -0,0 +1,153 @@
+import os
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from bson.objectid import ObjectId
+from orderbook_cache import (
+    OrderbookCacheWriter, CachedOrderbooks, cache_path, find_cache)
+
+start = datetime(2025, 1, 1)
+end = datetime(2025, 1, 1, 1)
+
+
+def make_orderbook(i: int):
+
+    orderbook = {
+        "_id": ObjectId(),
+        "ts": start + timedelta(minutes=i),
+        "buy": np.array([[10 - i, 100], [9 - i, 101]], dtype=float),
+        "sell": np.array([[11 + i, 100], [12 + i, 101], [13 + i, 1]],
+                         dtype=float),
+    }
+
+    # load.py hands the trades over with stringified ids and timestamps
+    buy_trades = [{
+        "_id": str(ObjectId()),
+        "ts": str(orderbook["ts"] + timedelta(seconds=1)),
+        "ob": str(orderbook["_id"]),
+        "r": 10.5 - i,
+        "q": 0.25 * j,
+    } for j in range(i % 3)]
+
+    return orderbook, buy_trades, []
+
+
+@pytest.fixture()
+def cache_dir(tmp_path):
+
+    write_cache(str(tmp_path), start, end)
+
+    return str(tmp_path)
+
+
+def write_cache(cache_dir: str, start: datetime, end: datetime, count=10):
+
+    writer = OrderbookCacheWriter(
+        cache_path(0, "Bittrex", "BTC-XRP", 2000, cache_dir,
+                   start=start, end=end),
+        envId=0,
+        exchange="bittrex",
+        market="btc-xrp",
+        depth=2000,
+        trim=True,
+        start=start,
+        end=end,
+    )
+
+    for i in range(count):
+        writer.append(*make_orderbook(i))
+
+    writer.close()
+
+    return writer.path
+
+
+def test_find_cache(cache_dir):
+
+    assert find_cache(0, "bittrex", "btc-xrp", 1000, start, end, cache_dir)
+    assert find_cache(0, "bittrex", "btc-xrp", 2000, start, end, cache_dir)
+
+    # Not loaded deeply enough
+    assert not find_cache(0, "bittrex", "btc-xrp", 3000, start, end, cache_dir)
+
+    # Outside the time frame of the load
+    assert not find_cache(
+        0, "bittrex", "btc-xrp", 1000, start, end + timedelta(1), cache_dir)
+
+    # Another market
+    assert not find_cache(0, "bittrex", "btc-eth", 1000, start, end, cache_dir)
+
+
+def test_replay(cache_dir):
+
+    orderbooks = CachedOrderbooks(
+        find_cache(0, "bittrex", "btc-xrp", 2000, start, end, cache_dir),
+        start=start + timedelta(minutes=2),
+        end=start + timedelta(minutes=7),
+    )
+
+    assert len(orderbooks) == 5
+
+    replayed = []
+    try:
+        while True:
+            replayed.append(orderbooks.next())
+    except StopIteration:
+        pass
+
+    assert len(replayed) == 5
+
+    for i, orderbook in zip(range(2, 7), replayed):
+
+        expected, buy_trades, sell_trades = make_orderbook(i)
+
+        assert orderbook["ts"] == expected["ts"]
+        assert np.array_equal(orderbook["buy"], expected["buy"])
+        assert np.array_equal(orderbook["sell"], expected["sell"])
+
+        # Aggregates of the levels, stored with them
+        for side in ("buy", "sell"):
+            assert np.array_equal(
+                orderbook[f'{side}Quantity'], np.cumsum(expected[side][:, 1]))
+            assert np.array_equal(
+                orderbook[f'{side}Notional'],
+                np.cumsum(np.prod(expected[side], axis=1)))
+        assert orderbook["tradesSorted"]
+
+        # Full trades are only rebuilt on request
+        replayed_trades = orderbook["buy_trades"].to_list()
+
+        for key in ("ts", "r", "q"):
+            assert [t[key] for t in replayed_trades] == \
+                [t[key] for t in buy_trades]
+        assert all(t["ob"] == str(orderbook["_id"]) for t in replayed_trades)
+        assert len(orderbook["sell_trades"]) == 0
+
+    # Books are views into the memory-mapped arrays
+    assert not replayed[0]["buy"].flags.owndata
+
+
+def test_caches_per_time_frame(cache_dir):
+
+    wide = find_cache(0, "bittrex", "btc-xrp", 2000, start, end, cache_dir)
+
+    # A narrower load keeps the cache covering it
+    assert write_cache(cache_dir, start + timedelta(minutes=10),
+                       start + timedelta(minutes=20)) == wide
+
+    # Another time frame gets a cache of its own
+    later = write_cache(cache_dir, end, end + timedelta(hours=1), count=3)
+
+    assert later != wide
+    assert find_cache(0, "bittrex", "btc-xrp", 2000, start, end,
+                      cache_dir) == wide
+    assert find_cache(0, "bittrex", "btc-xrp", 2000, end,
+                      end + timedelta(hours=1), cache_dir) == later
+
+    # Reloading a time frame replaces its cache
+    assert write_cache(cache_dir, end, end + timedelta(hours=1)) == later
+    assert len(CachedOrderbooks(later, start=end - timedelta(hours=1),
+                                end=end + timedelta(hours=1))) == 10
+
+    assert sorted(os.listdir(cache_dir)) == sorted(
+        os.path.basename(path) for path in (wide, later))
@@ -0,0 +1,101 @@
+import numpy as np
+from orderbook_side import OrderbookSide
+
+buy_ref = [
+    [10, 100],
+    [9, 101],
+    [8, 102],
+    [7, 103],
+    [6, 104],
+]
+
+sell_ref = [
+    [11, 100],
+    [12, 101],
+    [13, 102],
+    [14, 103],
+    [15, 104],
+]
+
+
+def test_load_sorts_buy_side():
+
+    side = OrderbookSide(buy_ref[::-1], descending=True)
+
+    assert np.array_equal(side.to_array(), np.array(buy_ref, dtype=float))
+
+
+def test_load_sorts_sell_side():
+
+    side = OrderbookSide(sell_ref[::-1], descending=False)
+
+    assert np.array_equal(side.to_array(), np.array(sell_ref, dtype=float))
+
+
+def test_insert_keeps_price_order():
+
+    buy = OrderbookSide(buy_ref, descending=True)
+    sell = OrderbookSide(sell_ref, descending=False)
+
+    buy.apply_delta([[0, 8.5, 50], [0, 11, 60], [0, 5, 70]])
+    sell.apply_delta([[0, 12.5, 50], [0, 10.5, 60], [0, 16, 70]])
+
+    assert buy.to_list() == [
+        [11, 60], [10, 100], [9, 101], [8.5, 50],
+        [8, 102], [7, 103], [6, 104], [5, 70]]
+
+    assert sell.to_list() == [
+        [10.5, 60], [11, 100], [12, 101], [12.5, 50],
+        [13, 102], [14, 103], [15, 104], [16, 70]]
+
+
+def test_update_replaces_quantity():
+
+    buy = OrderbookSide(buy_ref, descending=True)
+
+    buy.apply_delta([[2, 10, 200], [2, 6, 204]])
+
+    assert len(buy) == 5
+    assert buy.to_list() == [
+        [10, 200], [9, 101], [8, 102], [7, 103], [6, 204]]
+
+
+def test_remove():
+
+    sell = OrderbookSide(sell_ref, descending=False)
+
+    sell.apply_delta([[1, 11, 0], [1, 13, 0], [1, 99, 0]])
+
+    assert sell.to_list() == [[12, 101], [14, 103], [15, 104]]
+
+
+def test_empty_side():
+
+    side = OrderbookSide(descending=True)
+
+    assert len(side) == 0
+    assert side.to_array().shape == (0, 2)
+
+
+def test_notional_tracks_deltas():
+
+    buy = OrderbookSide(buy_ref, descending=True)
+    sell = OrderbookSide(sell_ref, descending=False)
+
+    for side, deltas in (
+            (buy, [[2, 7, 50], [0, 11, 60], [1, 6, 0], [0, 5.5, 3]]),
+            (sell, [[1, 15, 0], [0, 14.5, 7], [2, 11, 1], [1, 11, 0]])):
+
+        assert np.array_equal(
+            side.notional(),
+            np.cumsum(np.prod(side.to_array(), axis=1)))
+
+        # One delta at a time, so only part of the side is re-summed
+        for delta in deltas:
+
+            side.apply_delta([delta])
+            levels = side.to_array()
+
+            assert np.array_equal(
+                side.notional(levels),
+                np.cumsum(np.prod(levels, axis=1)))
@@ -7,7 +7,7 @@ import pymongo
 import math
 from pprint import pprint
 from pymongo import MongoClient
-from datetime import datetime
+from datetime import datetime, timedelta
 import dateutil.parser
 import dateutil.parser as parser
 import importlib
@@ -21,6 +21,7 @@ import sim_config
 from copy import copy
 from matching_engine import MatchingEngine
 from orderbooks import Orderbooks
+from orderbook_checkpoints import build_checkpoints
 import pytest
 from fixtures import delete_test_orderbooks
 import numpy as np
@@ -376,6 +377,72 @@ def test_orderbook_1_delta(delete_test_orderbooks):
         assert False
 
 
+def test_orderbook_checkpoint(delete_test_orderbooks):
+
+    checkpoints = history_db.orderbook_checkpoints
+    checkpoints.delete_many({"e": int(99)})
+
+    insert_snapshot()
+
+    for minute in range(1, 60):
+        insert_delta(
+            ts=f"2025-01-01T00:{minute:02d}:00.000+0000",
+            buy=[[2, 10, 100 + minute], [0, 10 - minute / 100, minute]],
+            sell=[[2, 11, 100 + minute]],
+        )
+
+    end = dateutil.parser.parse("2025-01-01T01:00:00.000+0000")
+
+    count = build_checkpoints(
+        orderbooks,
+        checkpoints,
+        envId=int(99),
+        exchange="test-exchange",
+        market="base-quote",
+        start=dateutil.parser.parse("2025-01-01T00:00:00.000+0000"),
+        end=end,
+        interval=timedelta(minutes=10),
+    )
+
+    assert count == 6
+
+    def replay(start, checkpoints_collection):
+
+        OBs = Orderbooks(
+            orderbooks_collection=orderbooks,
+            envId=int(99),
+            exchange="test-exchange",
+            market="base-quote",
+            depth=10000,
+            start=start,
+            end=end,
+            checkpoints_collection=checkpoints_collection,
+        )
+
+        replayed = []
+        try:
+            while True:
+                orderbook = OBs.next()
+                replayed.append((orderbook["ts"], orderbook["buy"].tolist(),
+                                 orderbook["sell"].tolist()))
+        except StopIteration:
+            pass
+
+        return OBs, replayed
+
+    start = dateutil.parser.parse("2025-01-01T00:35:30.000+0000")
+
+    OBs, expected = replay(start, None)
+    OBs, replayed = replay(start, checkpoints)
+
+    # Seeks to the 00:30 checkpoint, then replays the deltas from there
+    assert OBs.time_of_checkpoint.replace(tzinfo=None) == \
+        datetime(2025, 1, 1, 0, 30)
+    assert replayed == expected
+
+    checkpoints.delete_many({"e": int(99)})
+
+
 def test_apply_depth_1():
 
     orderbook = np.array([
@@ -511,3 +578,76 @@ def test_apply_depth_4():
 
     except:
         assert False
+
+
+def test_apply_depths():
+
+    # Several depths trimmed with one search
+
+    orderbook = np.array([
+        [10, 100],
+        [9, 100],
+        [8, 100],
+        [7, 100],
+        [6, 100],
+    ], dtype=float)
+
+    depths = [0, 999, 1000, 2000, 100000]
+
+    obs = Orderbooks.apply_depths(depths, orderbook)
+
+    assert len(obs) == len(depths)
+
+    for depth, ob in zip(depths, obs):
+        assert np.array_equal(ob, Orderbooks.apply_depth(depth, orderbook))
+
+    assert np.array_equal(obs[0], orderbook)
+    assert len(obs[1]) == 1
+    assert len(obs[3]) == 3
+
+
+def test_depth_below():
+
+    # Same sums as adding up the levels beyond the rate one by one
+
+    rng = np.random.default_rng(19)
+
+    buy = np.array(
+        [[10 - 0.5 * i, q] for i, q in enumerate(rng.uniform(0, 10, 12))])
+    sell = np.array(
+        [[11 + 0.5 * i, q] for i, q in enumerate(rng.uniform(0, 10, 12))])
+
+    for rate in (3.0, 4.5, 4.6, 7.0, 10.0, 10.5, 11.0, 13.2, 18.0):
+
+        assert Orderbooks.depth_below(rate, buy, buy=True) == \
+            sum(map(lambda x: x[1] if x[0] > rate else 0, buy))
+
+        assert Orderbooks.depth_below(rate, sell, buy=False) == \
+            sum(map(lambda x: x[1] if x[0] < rate else 0, sell))
+
+        # Aggregates of the untrimmed side work for a trimmed one
+        aggregates = Orderbooks.aggregates(buy, sell)
+
+        assert Orderbooks.depth_below(
+            rate, buy[:5], aggregates["buyQuantity"], buy=True) == \
+            sum(map(lambda x: x[1] if x[0] > rate else 0, buy[:5]))
+
+        assert Orderbooks.depth_below(
+            rate, sell[:5], aggregates["sellQuantity"], buy=False) == \
+            sum(map(lambda x: x[1] if x[0] < rate else 0, sell[:5]))
+
+
+def test_aggregates():
+
+    buy = np.array([[10, 1], [9, 2], [8, 3]], dtype=float)
+    sell = np.array([[11, 4], [12, 5]], dtype=float)
+
+    aggregates = Orderbooks.aggregates(
+        buy[:2], sell, Orderbooks.cumulative_notional(buy))
+
+    assert aggregates["buyNotional"].tolist() == [10, 28]
+    assert aggregates["sellNotional"].tolist() == [44, 104]
+    assert aggregates["buyQuantity"].tolist() == [1, 3]
+    assert aggregates["sellQuantity"].tolist() == [4, 9]
+    assert aggregates["bestBid"] == 10
+    assert aggregates["bestAsk"] == 11
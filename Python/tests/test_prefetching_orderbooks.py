@@ -0,0 +1,88 @@
+import threading
+import pytest
+from prefetching_orderbooks import PrefetchingOrderbooks
+from stage_timer import StageTimer
+
+
+class FakeOrderbooks:
+
+    corrupt_order_book_count = 0
+
+    def __init__(self, count: int, fail_at: int = None):
+        self.count = count
+        self.fail_at = fail_at
+        self.i = 0
+        self.threads = set()
+
+    def next(self):
+
+        self.threads.add(threading.current_thread().name)
+
+        if self.i == self.fail_at:
+            raise KeyError("fail")
+
+        if self.i >= self.count:
+            raise StopIteration
+
+        self.i += 1
+        self.corrupt_order_book_count += self.i % 2
+
+        return {"i": self.i}
+
+
+def drain(orderbooks) -> list:
+
+    replayed = []
+
+    try:
+        while True:
+            replayed.append(orderbooks.next()["i"])
+    except StopIteration:
+        pass
+
+    return replayed
+
+
+def test_prefetch():
+
+    source = FakeOrderbooks(100)
+    timer = StageTimer()
+    orderbooks = PrefetchingOrderbooks(source, size=4, timer=timer)
+
+    assert drain(orderbooks) == list(range(1, 101))
+
+    # Stays exhausted
+    with pytest.raises(StopIteration):
+        orderbooks.next()
+
+    assert source.threads == {"prefetch-orderbooks"}
+    assert orderbooks.corrupt_order_book_count == 50
+    assert timer.report()["fetch"]["count"] == 101
+
+    orderbooks.close()
+
+
+def test_prefetch_error():
+
+    orderbooks = PrefetchingOrderbooks(FakeOrderbooks(100, fail_at=10))
+
+    for i in range(1, 11):
+        assert orderbooks.next()["i"] == i
+
+    with pytest.raises(KeyError):
+        orderbooks.next()
+
+    orderbooks.close()
+
+
+def test_close_early():
+
+    source = FakeOrderbooks(10**6)
+    orderbooks = PrefetchingOrderbooks(source, size=2)
+
+    assert orderbooks.next()["i"] == 1
+
+    orderbooks.close()
+
+    assert not orderbooks.thread.is_alive()
+    assert source.i < 10
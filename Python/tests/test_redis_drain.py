@@ -0,0 +1,125 @@
+import pytest
+from bson.objectid import ObjectId
+from redis_drain import drain
+
+
+class FakePipeline:
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.keys = []
+
+    def hgetall(self, key):
+        self.keys.append(key)
+
+    def execute(self):
+        self.redis.round_trips += 1
+        return [dict(self.redis.hashes.get(key, {})) for key in self.keys]
+
+
+class FakeRedis:
+    """Just the commands drain() uses"""
+
+    def __init__(self):
+        self.lists = {}
+        self.hashes = {}
+        self.round_trips = 0
+        self.unlinks = 0
+
+    def lrange(self, key, start, end):
+        self.round_trips += 1
+        return list(self.lists.get(key, []))
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def unlink(self, *keys):
+        self.round_trips += 1
+        self.unlinks += 1
+        for key in keys:
+            self.hashes.pop(key, None)
+            self.lists.pop(key, None)
+
+
+class FakeCollection:
+
+    def __init__(self, fail_at: int = None):
+        self.documents = []
+        self.batches = 0
+        self.fail_at = fail_at
+
+    def insert_many(self, documents, ordered=True):
+        assert not ordered
+        self.batches += 1
+        if self.batches == self.fail_at:
+            raise RuntimeError('Insert Failed')
+        self.documents.extend(documents)
+
+
+def fill(r: FakeRedis, list_key: str, count: int) -> list:
+
+    ids = [str(ObjectId()) for _ in range(4)]
+
+    for i in range(count):
+        key = f'{list_key}:{i}'
+        r.hashes[key] = {
+            "runId": ids[0], "ob": ids[1], "s": ids[2], "p": ids[3],
+            "r": "0.1", "idx": str(i),
+        }
+        r.lists.setdefault(list_key, []).append(key)
+
+    return ids
+
+
+def test_drain_moves_documents_in_chunks():
+
+    r = FakeRedis()
+    ids = fill(r, "p:matchings", 25)
+    collection = FakeCollection()
+
+    assert drain(r, "p:matchings", collection,
+                 chunk_size=10, batch_size=4) == 25
+
+    # One pipelined read and one UNLINK per chunk
+    assert r.round_trips == 1 + 3 * 2 + 1
+    assert r.hashes == {} and r.lists == {}
+
+    assert collection.batches == 7
+    assert [d["idx"] for d in collection.documents] == \
+        [str(i) for i in range(25)]
+    assert all(d["runId"] == ObjectId(ids[0]) and d["p"] == ObjectId(ids[3])
+               for d in collection.documents)
+
+
+def test_drain_rejects_corrupt_documents():
+
+    r = FakeRedis()
+    fill(r, "p:sim:trades", 3)
+    del r.hashes["p:sim:trades:1"]["runId"]
+
+    with pytest.raises(AssertionError):
+        drain(r, "p:sim:trades", FakeCollection(), required="runId")
+
+
+def test_failed_drain_can_be_retried():
+
+    r = FakeRedis()
+    fill(r, "p:matchings", 25)
+    hashes = dict(r.hashes)
+
+    with pytest.raises(RuntimeError):
+        drain(r, "p:matchings", FakeCollection(fail_at=3),
+              chunk_size=10, batch_size=4, required="runId")
+
+    # Nothing is deleted until every insert succeeds
+    assert r.hashes == hashes
+    assert len(r.lists["p:matchings"]) == 25
+
+    collection = FakeCollection()
+
+    assert drain(r, "p:matchings", collection,
+                 chunk_size=10, batch_size=4, required="runId") == 25
+
+    assert [d["idx"] for d in collection.documents] == \
+        [str(i) for i in range(25)]
+    assert r.hashes == {} and r.lists == {}
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+import redis
+from bson.objectid import ObjectId
+from redis_export import RedisExporter, unpack_column
+
+
+@pytest.fixture()
+def sent(monkeypatch):
+    """The command batches the pipeline would have sent to Redis"""
+
+    batches = []
+
+    def execute(pipe, raise_on_error=True):
+        batches.append([args for args, _ in pipe.command_stack])
+        pipe.reset()
+
+    monkeypatch.setattr(redis.client.Pipeline, "execute", execute)
+
+    return batches
+
+
+def make_orderbook(i: int):
+
+    orderbook = {
+        "_id": ObjectId(),
+        "e": 0,
+        "x": "bittrex",
+        "m": "btc-xrp",
+        "ts": datetime(2025, 1, 1) + timedelta(minutes=i),
+        "N": i,
+        "V": "V",
+        "buy": np.array([[10, 100], [9, 101]], dtype=float),
+        "sell": np.array([[11, 100], [12, 101], [13, 1]], dtype=float),
+    }
+
+    buy_trades = [{
+        "_id": str(ObjectId()),
+        "e": 0,
+        "x": "bittrex",
+        "m": "btc-xrp",
+        "ts": str(orderbook["ts"]),
+        "ob": str(orderbook["_id"]),
+        "r": 10.5,
+        "q": 0.25 * j,
+    } for j in range(3)]
+
+    return orderbook, buy_trades, []
+
+
+def test_books_are_sent_in_batches(sent):
+
+    exporter = RedisExporter(redis.Redis(port=1), books_per_pipeline=4)
+
+    for i in range(10):
+        exporter.add(*make_orderbook(i))
+
+    assert len(sent) == 2
+
+    exporter.close()
+
+    assert len(sent) == 3
+    assert exporter.exported_count == 10
+
+    commands = [c[0] for c in sent[0]]
+
+    # Per book: ids zset, 3 trade hashes, 1 trade zset, header and
+    # delete + rpush per side column
+    assert len(commands) == 4 * (1 + 3 + 1 + 1 + 8)
+    assert commands.count('ZADD') == 4 * 2
+    assert commands.count('RPUSH') == 4 * 4
+
+
+def test_packed_columns(sent):
+
+    exporter = RedisExporter(
+        redis.Redis(port=1), books_per_pipeline=1, packed=True)
+
+    orderbook, buy_trades, sell_trades = make_orderbook(0)
+    exporter.add(orderbook, buy_trades, sell_trades)
+
+    columns = {c[1]: c[2] for c in sent[0] if c[0] == 'SET'}
+
+    assert np.array_equal(
+        unpack_column(columns[f'{orderbook["_id"]}:sell_rates']),
+        orderbook["sell"][:, 0])
+    assert np.array_equal(
+        unpack_column(columns[f'{orderbook["_id"]}:buy_quantities']),
+        orderbook["buy"][:, 1])
+
+    assert not any(c[0] == 'RPUSH' for c in sent[0])
+
+
+def test_packed_round_trip(sent):
+    """Packed columns written as load.py does, read back as bytes"""
+
+    # load.py's client decodes replies
+    writer = redis.Redis(port=1, encoding='utf-8', decode_responses=True)
+
+    exporter = RedisExporter(writer, books_per_pipeline=1, packed=True)
+
+    orderbook, buy_trades, sell_trades = make_orderbook(0)
+    exporter.add(orderbook, buy_trades, sell_trades)
+
+    # What the server stores is what the writer's encoder sends
+    encoder = writer.get_encoder()
+    stored = {c[1]: encoder.encode(c[2]) for c in sent[0] if c[0] == 'SET'}
+
+    key = f'{orderbook["_id"]}:sell_rates'
+
+    # A reader's replies go through its own encoder's decode()
+    reader = redis.Redis(port=1, decode_responses=False)
+
+    assert np.array_equal(
+        unpack_column(reader.get_encoder().decode(stored[key])),
+        orderbook["sell"][:, 0])
+
+    # A decoding client cannot read them
+    decoding = redis.Redis(port=1, encoding='utf-8', decode_responses=True)
+
+    with pytest.raises((UnicodeDecodeError, TypeError)):
+        unpack_column(decoding.get_encoder().decode(stored[key]))
@@ -0,0 +1,103 @@
+from concurrent.futures import ThreadPoolExecutor
+from bson.objectid import ObjectId
+import pytest
+import run_partitions
+from run_partitions import get_partition_ids
+
+
+class FakeCursor(list):
+
+    def sort(self, key, direction):
+        return FakeCursor(sorted(self, key=lambda d: d[key] * direction))
+
+
+class FakePartitions:
+    """Just enough of the partitions collection for run_partitions.py"""
+
+    def __init__(self, partitions: list = ()):
+        self.partitions = list(partitions)
+        self.updates = {}
+
+    def find(self, filter: dict, projection: dict = None):
+        return FakeCursor(
+            p for p in self.partitions
+            if all(p.get(key) == value for key, value in filter.items()))
+
+    def update_one(self, filter: dict, update: dict):
+        self.updates[filter["_id"]] = update["$set"]
+
+
+class FakeSimDb:
+
+    def __init__(self, partitions: list = ()):
+        self.partitions = FakePartitions(partitions)
+
+
+def test_get_partition_ids():
+
+    run_id = ObjectId()
+    partitions = [{"_id": ObjectId(), "runId": run_id, "partition": i}
+                  for i in (2, 0, 1)]
+
+    sim_db = FakeSimDb(partitions + [
+        {"_id": ObjectId(), "runId": ObjectId(), "partition": 0}])
+
+    # A runId gives the run's partitions in partition order
+    assert get_partition_ids(sim_db, [str(run_id)]) == \
+        [str(p["_id"]) for p in sorted(partitions,
+                                       key=lambda p: p["partition"])]
+
+    # Otherwise the ids are partition ids
+    ids = [str(p["_id"]) for p in partitions]
+    assert get_partition_ids(sim_db, ids) == ids
+    assert get_partition_ids(sim_db, ids[:1]) == ids[:1]
+
+
+@pytest.fixture()
+def returncodes(monkeypatch):
+    """The return code (or exception) each partition's simulation gives"""
+
+    returncodes = {}
+
+    def simulate_partition(partition_id, **kwargs):
+
+        returncode = returncodes[str(partition_id)]
+
+        if isinstance(returncode, Exception):
+            raise returncode
+
+        return returncode
+
+    monkeypatch.setattr(
+        run_partitions.simulate, "simulate_partition", simulate_partition)
+
+    return returncodes
+
+
+def test_run_partitions(returncodes):
+
+    complete, failed, raised = (str(ObjectId()) for _ in range(3))
+
+    returncodes[complete] = 0
+    returncodes[failed] = 1
+    returncodes[raised] = RuntimeError('Partition Failed')
+
+    sim_db = FakeSimDb()
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        failures = run_partitions.run_partitions(
+            sim_db, [complete, failed, raised], pool)
+
+    assert failures == 2
+
+    updates = sim_db.partitions.updates
+
+    assert updates.keys() == {ObjectId(complete), ObjectId(failed),
+                              ObjectId(raised)}
+
+    assert updates[ObjectId(complete)]["status"] == "COMPLETE"
+    assert updates[ObjectId(failed)]["status"] == "FAILED"
+    assert updates[ObjectId(raised)] == \
+        {"status": "FAILED", "executionTime": 0.0}
+
+    assert all(update["executionTime"] >= 0.0 for update in updates.values())
@@ -0,0 +1,137 @@
+import logging
+import math
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+from bson.objectid import ObjectId
+import sim_config
+import sim_trace
+from document_sink import LogSink, MemorySink
+from matching_engine import MatchingEngine
+
+
+@pytest.fixture()
+def partition_ids():
+    sim_config.partition_config["runId"] = ObjectId()
+    sim_config.partition_config["simId"] = ObjectId()
+    sim_config.partition_config["_id"] = ObjectId()
+    sim_config.partition_config["simVersion"] = "testing"
+    sim_config.orderbook_id = ObjectId()
+
+
+@pytest.fixture()
+def traces():
+
+    trace_sink = MemorySink(batch_size=1)
+    sim_trace.enable(trace_sink)
+
+    yield trace_sink.documents
+
+    sim_trace.disable()
+
+
+def make_trades(rates: list) -> list:
+    return [{"_id": str(ObjectId()), "r": r, "q": 0.02} for r in rates]
+
+
+def test_disabled_by_default():
+
+    assert not sim_trace.enabled
+    assert sim_trace.sink == None
+
+
+@pytest.mark.parametrize("kernel", [False, True], ids=["python", "kernel"])
+def test_fills_are_traced(partition_ids, traces, kernel):
+
+    engine = MatchingEngine(
+        assets=np.array([math.inf, 0.1]),
+        QL=0.01,
+        IL=math.inf,
+        actual_fee_rate=0.0027,
+        trade_sink=MemorySink(),
+        kernel=kernel,
+    )
+
+    engine.match(0.25, 0.26, make_trades([0.27, 0.26]),
+                 make_trades([0.24, 0.25]))
+    engine.flush()
+
+    events = [t["event"] for t in traces]
+
+    assert events == ["match", "buy", "fill", "fill",
+                      "sell", "fill", "fill", "matched"]
+
+    assert all(t["o"] == sim_config.orderbook_id for t in traces)
+
+    fills = [t for t in traces if t["event"] == "fill"]
+    sim_trades = engine.trade_sink.documents
+
+    assert [t["buy"] for t in fills] == [s["buy"] for s in sim_trades]
+    assert [t["q"] for t in fills] == [s["q"] for s in sim_trades]
+    assert [t["b"] for t in fills] == [s["b"] for s in sim_trades]
+
+    assert traces[-1]["buyMatch"] == "MATCHED"
+    assert traces[-1]["inventory"] == engine.inventory
+
+
+def test_from_config(monkeypatch, caplog):
+
+    monkeypatch.setenv("SIM_TRACE", "1")
+    sim_trace.from_config({"traceBatchSize": 1}, ObjectId())
+
+    assert sim_trace.enabled
+    assert isinstance(sim_trace.sink, LogSink)
+
+    with caplog.at_level(logging.DEBUG):
+        sim_trace.trace("orders", buyRate=0.25, sellRate=0.26)
+
+    assert '"event": "orders"' in caplog.text
+
+    sim_trace.disable()
+
+    assert not sim_trace.enabled
+
+    # Off unless asked for
+    monkeypatch.delenv("SIM_TRACE")
+    sim_trace.from_config({}, ObjectId())
+
+    assert not sim_trace.enabled
+
+
+def test_traced_when_optimized():
+    """Simulations run under python -O, and must still trace"""
+
+    script = """
+import math
+import numpy as np
+import sim_config
+import sim_trace
+from document_sink import MemorySink
+from matching_engine import MatchingEngine
+
+assert not __debug__
+
+sim_config.partition_config.update(
+    runId=1, simId=2, _id=3, simVersion="testing")
+
+traces = MemorySink(batch_size=1)
+sim_trace.enable(traces)
+
+engine = MatchingEngine(
+    assets=np.array([math.inf, 0.1]), QL=0.01, IL=math.inf,
+    actual_fee_rate=0.0027, trade_sink=MemorySink())
+engine.match(0.25, 0.26, [{"_id": "b", "r": 0.27, "q": 0.02}],
+             [{"_id": "s", "r": 0.24, "q": 0.02}])
+
+print(" ".join(t["event"] for t in traces.documents))
+"""
+
+    result = subprocess.run(
+        [sys.executable, "-O", "-c", script],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True, text=True, check=True)
+
+    assert result.stdout.split() == ["match", "buy", "fill", "sell", "fill",
+                                     "matched"]
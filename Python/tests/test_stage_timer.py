@@ -0,0 +1,49 @@
+import time
+from document_sink import MemorySink
+from stage_timer import StageTimer, NULL_STAGE
+
+
+def test_disabled_timer_records_nothing():
+
+    timer = StageTimer(enabled=False)
+
+    with timer.stage("fetch"):
+        pass
+
+    assert timer.stage("fetch") is NULL_STAGE
+    assert timer.report() == {}
+
+
+def test_nested_stages_are_exclusive():
+
+    timer = StageTimer()
+
+    for _ in range(3):
+        with timer.stage("match"):
+            with timer.stage("writes"):
+                time.sleep(0.01)
+
+    report = timer.report()
+
+    assert report["match"]["count"] == 3
+    assert report["writes"]["count"] == 3
+
+    # The sleep is charged to the inner stage only
+    assert report["writes"]["wall"] >= 0.03
+    assert report["match"]["wall"] < report["writes"]["wall"]
+
+
+def test_sink_batches_are_timed(monkeypatch):
+
+    monkeypatch.setenv("SIM_PROFILE", "1")
+    timer = StageTimer.from_config({})
+    assert timer.enabled
+
+    sink = MemorySink(batch_size=2)
+    sink.timer = timer
+
+    for i in range(5):
+        sink.write({"i": i})
+    sink.close()
+
+    assert timer.report()["writes"]["count"] == 3
@@ -0,0 +1,49 @@
+from datetime import datetime
+from bson.objectid import ObjectId
+from sweep import trader_key
+
+
+def make_partition(**settings) -> dict:
+    """A partition as the simulator writes it for one sweep variant"""
+
+    return {
+        "_id": ObjectId(),
+        "simId": ObjectId(),
+        "runId": ObjectId(),
+        "ts": datetime.now(),
+        "configName": f"config-{ObjectId()}",
+        "partition": 0,
+        "envId": 1,
+        "exchange": "binance",
+        "market": "BTC-ETH",
+        "startTime": datetime(2020, 1, 1),
+        "endTime": datetime(2020, 1, 2),
+        "trader": "CO1",
+        "depth": 2000,
+        "tick": 1e-8,
+        "quantityLimit": 0.01,
+        "inventoryLimit": 0.05,
+        "actualFeeRate": 0.0025,
+        "minNotional": 0.0005,
+        **settings,
+    }
+
+
+def test_trader_key():
+
+    key = trader_key(make_partition())
+
+    # Variants get their own ids and timestamps but share a trader
+    assert trader_key(make_partition()) == key
+
+    # Settings only the matching engine uses share a trader
+    assert trader_key(make_partition(inventoryLimit=0.1)) == key
+    assert trader_key(make_partition(minNotional=0.001)) == key
+
+    # The trader computes its orders from these
+    assert trader_key(make_partition(quantityLimit=0.02)) != key
+    assert trader_key(make_partition(actualFeeRate=0.001)) != key
+    assert trader_key(make_partition(tick=1e-6)) != key
+    assert trader_key(make_partition(depth=1000)) != key
+    assert trader_key(make_partition(pdf="pdf-2")) != key
+    assert trader_key(make_partition(endTime=datetime(2020, 1, 3))) != key
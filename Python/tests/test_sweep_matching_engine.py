@@ -0,0 +1,140 @@
+import math
+import random
+import numpy as np
+import pytest
+from bson.objectid import ObjectId
+import sim_config
+from document_sink import MemorySink
+from matching_engine import MatchingEngine
+from sweep_matching_engine import SweepMatchingEngine
+
+configs = [
+    # QL, IL, actual_fee_rate, min_notional
+    (0.01, math.inf, 0.0027, 0.0005),
+    (0.02, 0.05, 0.0027, 0.0005),
+    (0.05, 0.02, 0.001, 0.0005),
+    (0.001, math.inf, 0.0, 0.002),
+    (0.5, 1.0, 0.0025, 0.0001),
+]
+
+
+@pytest.fixture()
+def partition_ids():
+    sim_config.partition_config["runId"] = ObjectId()
+    sim_config.partition_config["simId"] = ObjectId()
+    sim_config.partition_config["_id"] = ObjectId()
+    sim_config.partition_config["simVersion"] = "testing"
+
+
+def make_trades(rng, rate: float, count: int, reverse: bool) -> list:
+
+    trades = [{
+        "_id": ObjectId(),
+        "r": round(rate * rng.uniform(0.98, 1.02), 6),
+        "q": rng.choice([0.001, 0.01, 0.1, 1.0]) * rng.random(),
+    } for _ in range(count)]
+
+    return sorted(trades, key=lambda t: t["r"], reverse=reverse)
+
+
+def test_sweep_matches_matching_engine(partition_ids):
+
+    rng = random.Random(42)
+
+    start_assets = np.array([1.0, 0.5])
+
+    engines = [MatchingEngine(
+        assets=start_assets.copy(),
+        QL=QL,
+        IL=IL,
+        actual_fee_rate=fee,
+        min_notional=min_notional,
+        trade_sink=MemorySink(),
+    ) for QL, IL, fee, min_notional in configs]
+
+    partitions = [{
+        **sim_config.partition_config, "_id": ObjectId(),
+    } for _ in configs]
+
+    sink = MemorySink()
+    sweep = SweepMatchingEngine(
+        QL=[c[0] for c in configs],
+        IL=[c[1] for c in configs],
+        actual_fee_rate=[c[2] for c in configs],
+        min_notional=[c[3] for c in configs],
+        assets=np.tile(start_assets, (len(configs), 1)),
+        partitions=partitions,
+        trade_sink=sink,
+    )
+
+    for _ in range(300):
+
+        sim_config.orderbook_id = ObjectId()
+
+        rate = rng.uniform(0.1, 0.3)
+        buy_trades = make_trades(rng, rate, rng.randint(0, 4), True)
+        sell_trades = make_trades(rng, rate, rng.randint(0, 4), False)
+
+        # Each config quotes its own rates; some sit the orderbook out
+        buy_rates = np.array([
+            rate * rng.uniform(0.99, 1.01) if rng.random() > 0.1 else 0
+            for _ in configs])
+        sell_rates = buy_rates * 1.001
+
+        buy_codes, sell_codes = sweep.match(
+            buy_rate=buy_rates,
+            sell_rate=sell_rates,
+            buy_trades=buy_trades,
+            sell_trades=sell_trades,
+        )
+
+        buy_results = sweep.results(buy_codes)
+        sell_results = sweep.results(sell_codes)
+
+        for k, engine in enumerate(engines):
+
+            if buy_rates[k] > 0 and sell_rates[k] > 0:
+                assert engine.match(
+                    buy_rate=buy_rates[k],
+                    sell_rate=sell_rates[k],
+                    buy_trades=buy_trades,
+                    sell_trades=sell_trades,
+                ) == (buy_results[k], sell_results[k])
+
+            else:
+                assert buy_results[k] == None and sell_results[k] == None
+
+            assert np.array_equal(engine.assets, sweep.assets[k])
+
+    sweep.flush()
+
+    for k, engine in enumerate(engines):
+
+        for counter in (
+                "buy_blocked_count",
+                "buy_no_trades_count",
+                "buy_notion_failure_count",
+                "buy_match_count",
+                "buy_unmatchable_count",
+                "sell_blocked_count",
+                "sell_match_count",
+                "sell_no_trades_count",
+                "sell_notion_failure_count",
+                "sell_unmatchable_count"):
+            assert getattr(engine, counter) == getattr(sweep, counter)[k]
+
+        engine.flush()
+
+        documents = [d for d in sink.documents
+                     if d["p"] == partitions[k]["_id"]]
+
+        assert len(documents) == len(engine.trade_sink.documents)
+
+        for actual, expected in zip(documents, engine.trade_sink.documents):
+            for key in ("idx", "match", "buy", "o", "t", "r", "q", "b"):
+                assert actual[key] == expected[key]
+
+    # The random books exercise every outcome
+    assert sweep.buy_match_count.sum() > 0
+    assert sweep.sell_match_count.sum() > 0
+    assert sweep.buy_blocked_count.sum() > 0
@@ -0,0 +1,71 @@
+import math
+import numpy as np
+import pytest
+from bson.objectid import ObjectId
+import sim_config
+from document_sink import MemorySink
+from matching_engine import MatchingEngine
+from match_result import MatchResult
+from trade_records import TradeRecords, trade_columns, trade_at
+
+
+@pytest.fixture()
+def partition_ids():
+    sim_config.partition_config["runId"] = ObjectId()
+    sim_config.partition_config["simId"] = ObjectId()
+    sim_config.partition_config["_id"] = ObjectId()
+    sim_config.partition_config["simVersion"] = "testing"
+    sim_config.orderbook_id = ObjectId()
+
+
+def make_trades(rates: list) -> list:
+    return [{"_id": str(ObjectId()), "r": r, "q": 0.05} for r in rates]
+
+
+def test_records_match_dicts():
+
+    trades = make_trades([0.2, 0.21, 0.22])
+    records = TradeRecords.from_trades(trades)
+
+    assert len(records) == 3
+    assert trade_columns(records) == trade_columns(trades)
+    assert trade_at(records, 1) == trades[1]
+    assert records.to_list() == trades
+
+
+def test_matching_engine_matches_records(partition_ids):
+
+    sell_trades = make_trades([0.19, 0.2, 0.205])
+    buy_trades = make_trades([0.23, 0.22, 0.21])
+
+    engines = []
+
+    for wrap in (list, TradeRecords.from_trades):
+
+        engine = MatchingEngine(
+            assets=np.array([1.0, 0.2]),
+            QL=0.02,
+            IL=math.inf,
+            actual_fee_rate=0.0027,
+            trade_sink=MemorySink(),
+        )
+
+        assert engine.match(
+            buy_rate=0.2,
+            sell_rate=0.215,
+            buy_trades=wrap(buy_trades),
+            sell_trades=wrap(sell_trades),
+        ) == (MatchResult.MATCHED, MatchResult.MATCHED)
+
+        engine.flush()
+        engines.append(engine)
+
+    from_dicts, from_records = engines
+
+    assert np.array_equal(from_dicts.assets, from_records.assets)
+
+    # The full history trades are looked up for the sim trades
+    assert [d["historyTrade"] for d in from_dicts.trade_sink.documents] == \
+        [d["historyTrade"] for d in from_records.trade_sink.documents]
+    assert [d["t"] for d in from_records.trade_sink.documents] == \
+        [t["_id"] for t in sell_trades[:2] + buy_trades[:2]]
@@ -7,7 +7,10 @@ import json
 import math
 import sys
 import numpy as np
-from tuning_generator import TuningGenerator
+import bson
+from datetime import datetime, timedelta, timezone
+from tuning_generator import TuningGenerator, TRADE_DTYPE, TRADE_PROJECTION, \
+    load_trade_table
 
 # The following is a generic TuningGenerator configuration
 config = {
@@ -568,6 +571,45 @@ def test_trades_price_depth_5():
     assert compare2D(tg.meta_price_depths, expected)
 
 
+def test_trades_price_depth_ties():
+
+    # Unsorted, with a buy and a sell meta trade sharing a ts and
+    # rate ties within each
+    trades = [
+        [12345, 1236, 2, 10, False],
+        [12345, 1234, 3, 50, True],
+        [12345, 1237, 4, 20, False],
+        [12345, 1233, 3, 30, True],
+        [12340, 1240, 5, 1, True],
+        [12345, 1238, 2, 40, False],
+        [12345, 1235, 6, 100, True],
+    ]
+
+    config = {
+        "priceDepthStart": 0.0000000001,
+        "priceDepthEnd": 1.0,
+        "priceDepthSamples": 100,
+        "depthStart": 0.01,
+        "depthEnd": 100.0,
+        "depthSamples": 100,
+        "inventoryLimit": math.inf,
+    }
+
+    tg = TuningGenerator(config=config)
+    tg.load_trades(trades=trades)
+    tg.trades_price_depth()
+
+    assert tg.meta_trade_starts.tolist() == [0, 1, 4]
+    assert tg.trade_table["id"].tolist() == [
+        1240, 1237, 1236, 1238, 1233, 1234, 1235]
+
+    expected = [[5], [180, 100, 80], [840, 750, 600]]
+    assert compare2D(tg.meta_remaining_volumes, expected)
+
+    expected = [[1.0], [1.0, 2.0, 2.0], [1.0, 1.0, 2.0]]
+    assert compare2D(tg.meta_price_depths, expected)
+
+
 def test_load_remaining_depth_0():
 
     trades = [
@@ -763,6 +805,48 @@ def test_load_remaining_price_depths_2():
     assert compare2D(tg.remaining_price_depths, expected)
 
 
+def test_load_remaining_price_depths_ties():
+
+    config = {
+        "priceDepthStart": 0.0000000001,
+        "priceDepthEnd": 1.0,
+        "priceDepthSamples": 25,
+        "depthStart": 0.01,
+        "depthEnd": 100.0,
+        "depthSamples": 3,
+        "inventoryLimit": math.inf,
+    }
+
+    tg = TuningGenerator(config=config)
+
+    # Ragged meta trades with repeated price depths
+    rng = np.random.default_rng(14)
+    tg.meta_price_depths = [
+        rng.choice([0.0, 0.1, 0.25, 0.5, 0.75], size=n).tolist()
+        for n in (1, 4, 7, 2)]
+    tg.meta_remaining_volumes = [
+        rng.uniform(0, 100, size=len(x)).tolist()
+        for x in tg.meta_price_depths]
+
+    tg.load_remaining_price_depths()
+
+    # The first smallest price depth at or above each price depth
+    expected = []
+    for price_depth in tg.price_depths:
+        row = []
+        for pds, volumes in zip(tg.meta_price_depths,
+                                tg.meta_remaining_volumes):
+            best_idx = None
+            for idx, pd in enumerate(pds):
+                if pd >= price_depth and (
+                        best_idx == None or pd < pds[best_idx]):
+                    best_idx = idx
+            row.append(0.0 if best_idx == None else volumes[best_idx])
+        expected.append(row)
+
+    assert tg.remaining_price_depths == expected
+
+
 def test_get_values_0():
 
     trades = [
@@ -869,4 +953,123 @@ def test_meta_remaining_volumes_0():
 
     logging.error("tg.meta_remaining_volumes:\n%r", tg.meta_remaining_volumes)
     expected = [[450, 270, 120]]
-    assert compare2D(tg.meta_remaining_volumes, expected)
\ No newline at end of file
+    assert compare2D(tg.meta_remaining_volumes, expected)
+
+class FakeCursor:
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, key, direction):
+        assert direction == 1
+        return iter(sorted(self.documents, key=lambda d: d[key]))
+
+
+class FakeRawCursor(FakeCursor):
+
+    def __init__(self, documents, batch_size):
+        super().__init__(documents)
+        self.batch_size = batch_size
+
+    def sort(self, key, direction):
+        documents = list(super().sort(key, direction))
+        return iter(b''.join(bson.encode(d) for d in
+                             documents[i:i + self.batch_size])
+                    for i in range(0, len(documents), self.batch_size))
+
+
+class FakeTradesCollection:
+    """Just the queries load_trade_table() makes"""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def project(self, projection):
+        assert projection == TRADE_PROJECTION
+        return [{k: v for k, v in d.items() if projection.get(k)}
+                for d in self.documents]
+
+    def find(self, filter, projection, batch_size):
+        return FakeCursor(self.project(projection))
+
+    def find_raw_batches(self, filter, projection, batch_size):
+        return FakeRawCursor(self.project(projection), batch_size)
+
+
+@pytest.mark.parametrize("raw", [False, True])
+def test_load_trade_table(raw):
+
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    documents = [{
+        "_id": ObjectId(),
+        "e": 0,
+        "ts": start + timedelta(milliseconds=250 * (i % 7)),
+        "id": 1000 + i,
+        "r": 1.0 + i / 10,
+        "q": float(i),
+        "buy": i % 2 == 0,
+    } for i in range(23)]
+
+    trades = load_trade_table(FakeTradesCollection(documents), {},
+                              batch_size=5, raw=raw)
+
+    assert trades.dtype == TRADE_DTYPE
+    assert trades["ts"].tolist() == sorted(
+        int(d["ts"].timestamp() * 1000) for d in documents)
+
+    expected = sorted(documents, key=lambda d: d["ts"])
+    assert trades["id"].tolist() == [d["id"] for d in expected]
+    assert trades["r"].tolist() == [d["r"] for d in expected]
+    assert trades["q"].tolist() == [d["q"] for d in expected]
+    assert trades["buy"].tolist() == [d["buy"] for d in expected]
+
+
+def test_load_trade_table_empty():
+
+    trades = load_trade_table(FakeTradesCollection([]), {})
+    assert len(trades) == 0
+    assert trades.dtype == TRADE_DTYPE
+
+
+def test_refresh(tmp_path):
+
+    config = {
+        "priceDepthStart": 0.0001,
+        "priceDepthEnd": 1.0,
+        "priceDepthSamples": 10,
+        "depthStart": 0.01,
+        "depthEnd": 100.0,
+        "depthSamples": 10,
+        "inventoryLimit": 500,
+        "window": 60000,
+    }
+
+    state_path = str(tmp_path / "tuning.npz")
+
+    rng = np.random.default_rng(17)
+    start = datetime(2020, 1, 1)
+    start_ms = int(start.timestamp() * 1000)
+
+    trades = [[start_ms + 500 * int(i // 3), i,
+               float(rng.uniform(0.9, 1.1)), float(rng.uniform(0, 100)),
+               bool(rng.integers(0, 2))] for i in range(1500)]
+
+    # Some refreshes see only part of the last ts's trades
+    for count in (100, 161, 162, 400, 401, 1200, 1500):
+
+        available = trades[:count]
+
+        now_ms = available[-1][0]
+        now = start + timedelta(milliseconds=now_ms - start_ms)
+
+        tg = TuningGenerator(config=config)
+        values = tg.refresh(state_path, trades=available, now=now)
+
+        window = [t for t in available if t[0] >= now_ms - config["window"]]
+
+        tg = TuningGenerator(config=config)
+        tg.load_trades(trades=window)
+        expected = tg.get_values()
+
+        assert compare2D(values, expected)
@@ -0,0 +1,169 @@
+"""
+Compact history trades for replay and matching.
+
+The matching engines only need the rate and quantity of a history trade,
+plus the full trade for the few that end up in a sim trade.  A side's
+trades are therefore held as a structured array of (r, q, ref) records,
+where ref indexes a trade table that rebuilds the full trade on demand.
+"""
+
+import numpy as np
+from bson.objectid import ObjectId
+
+try:
+    profile
+except NameError:
+    profile = lambda x: x
+
+
+TRADE_RECORD_DTYPE = np.dtype([
+    ("r", np.float64),
+    ("q", np.float64),
+    ("ref", np.int64),
+])
+
+# Row of a trade table; ob is the row of the trade's orderbook
+TRADE_ID_DTYPE = np.dtype([
+    ("id", np.uint8, (12,)),
+    ("ts", "datetime64[ms]"),
+    ("ob", np.int64),
+])
+
+
+class TradeTable:
+    """
+    Full trades by reference, backed by a TRADE_ID_DTYPE array and the
+    orderbook ids it points into.  lookup() builds a trade in the form
+    load.py stores with each orderbook, less the rate and quantity.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        orderbook_ids: np.ndarray,
+        *,
+        buy: bool,
+        envId: int = None,
+        exchange: str = None,
+        market: str = None,
+    ):
+
+        self.ids = ids
+        self.orderbook_ids = orderbook_ids
+        self.buy = buy
+        self.envId = envId
+        self.exchange = exchange
+        self.market = market
+
+    def lookup(self, ref: int) -> dict:
+
+        row = self.ids[ref]
+
+        return {
+            "_id": str(ObjectId(bytes(row["id"]))),
+            "e": self.envId,
+            "x": self.exchange,
+            "m": self.market,
+            "ts": str(row["ts"].tolist()),
+            "ob": str(ObjectId(bytes(self.orderbook_ids[row["ob"]]))),
+            "buy": self.buy,
+        }
+
+
+class TradeListTable:
+    """A trade table over a list of already decoded trades"""
+
+    def __init__(self, trades: list):
+        self.trades = trades
+
+    def lookup(self, ref: int) -> dict:
+        return self.trades[ref]
+
+
+class TradeRecords:
+    """The history trades of one side of an orderbook, in match order"""
+
+    __slots__ = ("records", "table")
+
+    def __init__(self, records: np.ndarray, table):
+
+        self.records = records
+        self.table = table
+
+    @classmethod
+    def from_trades(cls, trades: list):
+
+        records = np.empty(len(trades), dtype=TRADE_RECORD_DTYPE)
+        records["r"] = [t["r"] for t in trades]
+        records["q"] = [t["q"] for t in trades]
+        records["ref"] = np.arange(len(trades))
+
+        return cls(records, TradeListTable(trades))
+
+    def __len__(self):
+        return len(self.records)
+
+    def rates(self) -> list:
+        return self.records["r"].tolist()
+
+    def quantities(self) -> list:
+        return self.records["q"].tolist()
+
+    def trade(self, i: int) -> dict:
+        """The full i'th trade, looked up in the trade table"""
+
+        record = self.records[i]
+
+        return {
+            **self.table.lookup(int(record["ref"])),
+            "r": float(record["r"]),
+            "q": float(record["q"]),
+        }
+
+    def to_list(self) -> list:
+        return [self.trade(i) for i in range(len(self.records))]
+
+
+@profile
+def trade_columns(trades) -> tuple:
+    """The rates and quantities of a list of trade dicts or TradeRecords"""
+
+    if isinstance(trades, TradeRecords):
+        return trades.rates(), trades.quantities()
+
+    return [t['r'] for t in trades], [t['q'] for t in trades]
+
+
+def trade_arrays(trades) -> tuple:
+    """The rates and quantities of trades as contiguous float64 arrays"""
+
+    if isinstance(trades, TradeRecords):
+        return (np.ascontiguousarray(trades.records["r"]),
+                np.ascontiguousarray(trades.records["q"]))
+
+    return (np.array([t['r'] for t in trades], dtype=np.float64),
+            np.array([t['q'] for t in trades], dtype=np.float64))
+
+
+def trade_rates(trades) -> list:
+
+    if isinstance(trades, TradeRecords):
+        return trades.rates()
+
+    return [t['r'] for t in trades]
+
+
+def trades_sorted(buy_trades, sell_trades) -> bool:
+    """Buy trades by falling rate and sell trades by rising rate"""
+
+    return bool(np.all(np.diff(trade_rates(buy_trades)) <= 0) and
+                np.all(np.diff(trade_rates(sell_trades)) >= 0))
+
+
+def trade_at(trades, i: int) -> dict:
+    """The full i'th trade of a list of trade dicts or TradeRecords"""
+
+    if isinstance(trades, TradeRecords):
+        return trades.trade(i)
+
+    return trades[i]
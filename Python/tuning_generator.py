@@ -1,13 +1,20 @@
 import numpy as np
 from operator import sub
 import os
-from pymongo import MongoClient
+import itertools
+import bson
+from pymongo import MongoClient, ReplaceOne
 from bson.objectid import ObjectId
 import sys
 import logging
 from datetime import datetime, timedelta
 import math
 
+try:
+    profile
+except NameError:
+    profile = lambda x: x
+
 mongodb = None
 config_db = None
 BUY = 1
@@ -25,6 +32,262 @@ def compare2D(x, y) -> bool:
     return True
 
 
+def pad(rows: list, fill, dtype=None) -> np.ndarray:
+    """
+    Ragged rows as a 2-D array, filled out on the right with fill.  There
+    is always at least one column, so reductions along a row are defined.
+    """
+
+    width = max((len(row) for row in rows), default=1) or 1
+    padded = np.full((len(rows), width), fill, dtype=dtype)
+
+    for i, row in enumerate(rows):
+        padded[i, :len(row)] = row
+
+    return padded
+
+
+# Only these fields of a history trade are fetched
+TRADE_PROJECTION = {"_id": 0, "ts": 1, "id": 1, "r": 1, "q": 1, "buy": 1}
+
+# Bittrex v1 trade ids are integers
+TRADE_DTYPE = np.dtype([
+    ("ts", np.int64),
+    ("id", np.int64),
+    ("r", np.float64),
+    ("q", np.float64),
+    ("buy", np.bool_),
+])
+
+
+def trade_table(trades) -> np.ndarray:
+    """
+    Trades as a structured array of (ts, id, r, q, buy) records; a list
+    of [ts, id, r, q, buy] rows is converted, a table is passed through.
+    """
+
+    if isinstance(trades, np.ndarray):
+        return trades
+
+    ids = np.asarray([t[1] for t in trades])
+
+    # Ids keep whatever type the rows have
+    table = np.empty(len(trades), dtype=[
+        (name, ids.dtype if name == "id" and len(trades) > 0
+         else TRADE_DTYPE[name]) for name in TRADE_DTYPE.names])
+
+    table["ts"] = [t[0] for t in trades]
+    table["id"] = ids
+    table["r"] = [t[2] for t in trades]
+    table["q"] = [t[3] for t in trades]
+    table["buy"] = [t[4] for t in trades]
+
+    return table
+
+
+def trade_batches(collection, filter: dict, *, batch_size: int,
+                  raw: bool = False):
+    """
+    The projected trades matching filter, in ts order, as lists of at
+    most batch_size documents.  With raw each batch the server returns
+    is decoded in one bson.decode_all call instead of document by
+    document.
+    """
+
+    if raw:
+        for batch in collection.find_raw_batches(
+                filter=filter,
+                projection=TRADE_PROJECTION,
+                batch_size=batch_size).sort("ts", 1):
+            yield bson.decode_all(batch)
+        return
+
+    cursor = collection.find(
+        filter=filter,
+        projection=TRADE_PROJECTION,
+        batch_size=batch_size).sort("ts", 1)
+
+    while True:
+        documents = list(itertools.islice(cursor, batch_size))
+        if len(documents) == 0:
+            return
+        yield documents
+
+
+@profile
+def load_trade_table(collection, filter: dict, *, batch_size: int = 10000,
+                     raw: bool = False) -> np.ndarray:
+    """
+    Stream the trades matching filter into a TRADE_DTYPE table.  Each
+    batch is decoded into a chunk of columns as it arrives, so only one
+    batch of documents is held at a time.
+    """
+
+    assert batch_size > 0
+
+    chunks = []
+
+    for documents in trade_batches(collection, filter,
+                                   batch_size=batch_size, raw=raw):
+
+        chunk = np.empty(len(documents), dtype=TRADE_DTYPE)
+
+        chunk["ts"] = [int(t["ts"].timestamp() * 1000) for t in documents]
+        chunk["id"] = [t["id"] for t in documents]
+        chunk["r"] = [t["r"] for t in documents]
+        chunk["q"] = [t["q"] for t in documents]
+        chunk["buy"] = [t["buy"] for t in documents]
+
+        chunks.append(chunk)
+
+    if len(chunks) == 0:
+        return np.empty(0, dtype=TRADE_DTYPE)
+
+    return np.concatenate(chunks)
+
+
+def group_reverse_cumsum(values: np.ndarray, starts: np.ndarray,
+                         lengths: np.ndarray) -> np.ndarray:
+    """
+    Cumulative sums of the groups of values, each summed from its last
+    value back to its first.  Groups of equal length are summed as the
+    rows of one 2-D array, so each sum adds up in the same order as
+    np.cumsum over the reversed group would.
+    """
+
+    sums = np.empty_like(values)
+
+    for length in np.unique(lengths).tolist():
+
+        group_starts = starts[lengths == length]
+        index = group_starts[:, None] + np.arange(length)[::-1]
+
+        sums[index] = np.cumsum(values[index], axis=1)
+
+    return sums
+
+
+class TuningState:
+    """
+    The per meta trade intermediates of a window tuning, persisted between
+    refreshes: each meta trade's ts, side, volume and remaining volume at
+    every price depth, plus the running quadrant sums they add up to.
+    """
+
+    VERSION = 1
+
+    def __init__(self, price_depths: list, depths: list,
+                 inventory_limit: float):
+
+        self.price_depths = np.array(price_depths, dtype=float)
+        self.depths = np.array(depths, dtype=float)
+        self.inventory_limit = float(inventory_limit)
+
+        self.meta_ts = np.empty(0, dtype=np.int64)
+        self.meta_buy = np.empty(0, dtype=bool)
+        self.meta_volume = np.empty(0, dtype=float)
+        self.meta_remaining = np.empty((0, len(price_depths)), dtype=float)
+
+        # Sum over the meta trades of each (depth, price depth) quadrant
+        self.sums = np.zeros((len(depths), len(price_depths)))
+
+    def __len__(self):
+        return len(self.meta_ts)
+
+    @classmethod
+    def load(cls, path: str, price_depths: list, depths: list,
+             inventory_limit: float):
+        """
+        The state saved at path, or an empty one when there is none or it
+        was made for a different grid or inventory limit.
+        """
+
+        state = cls(price_depths, depths, inventory_limit)
+
+        if not os.path.exists(path):
+            return state
+
+        with np.load(path) as arrays:
+
+            if (int(arrays["version"]) != cls.VERSION
+                    or not np.array_equal(arrays["price_depths"],
+                                          state.price_depths)
+                    or not np.array_equal(arrays["depths"], state.depths)
+                    or float(arrays["inventory_limit"])
+                    != state.inventory_limit):
+                logging.warning("Tuning state %s is stale, rebuilding", path)
+                return state
+
+            state.meta_ts = arrays["meta_ts"]
+            state.meta_buy = arrays["meta_buy"]
+            state.meta_volume = arrays["meta_volume"]
+            state.meta_remaining = arrays["meta_remaining"]
+            state.sums = arrays["sums"]
+
+        return state
+
+    def save(self, path: str) -> None:
+
+        tmp_path = path + '.tmp'
+
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                version=self.VERSION,
+                price_depths=self.price_depths,
+                depths=self.depths,
+                inventory_limit=self.inventory_limit,
+                meta_ts=self.meta_ts,
+                meta_buy=self.meta_buy,
+                meta_volume=self.meta_volume,
+                meta_remaining=self.meta_remaining,
+                sums=self.sums,
+            )
+
+        os.replace(tmp_path, path)
+
+    def quadrants(self, volume: np.ndarray, remaining: np.ndarray,
+                  block: int = 256) -> np.ndarray:
+        """The quadrant sums of a set of meta trades"""
+
+        sums = np.zeros_like(self.sums)
+
+        # Remaining depth of each meta trade at each depth, (D, M)
+        remaining_depth = np.maximum(volume - self.depths[:, None], 0)
+
+        for start in range(0, len(volume), block):
+            sums += np.minimum(
+                remaining_depth[:, start:start + block, None],
+                remaining[None, start:start + block, :]).sum(axis=1)
+
+        return sums
+
+    def update(self, keep: np.ndarray, meta_ts: np.ndarray,
+               meta_buy: np.ndarray, meta_volume: np.ndarray,
+               meta_remaining: np.ndarray) -> None:
+        """Drop the meta trades not kept and add the new ones"""
+
+        expired = ~keep
+
+        if keep.any():
+            self.sums -= self.quadrants(self.meta_volume[expired],
+                                        self.meta_remaining[expired])
+        else:
+            self.sums = np.zeros_like(self.sums)
+
+        self.sums += self.quadrants(meta_volume, meta_remaining)
+
+        self.meta_ts = np.concatenate((self.meta_ts[keep], meta_ts))
+        self.meta_buy = np.concatenate((self.meta_buy[keep], meta_buy))
+        self.meta_volume = np.concatenate(
+            (self.meta_volume[keep], meta_volume))
+        self.meta_remaining = np.concatenate(
+            (self.meta_remaining[keep], meta_remaining))
+
+    def values(self) -> list:
+        return (self.sums / self.meta_volume.sum()).tolist()
+
+
 class TuningGenerator:
     def __init__(self, config: dict = None, configName: str = None):
         """
@@ -40,7 +303,6 @@ class TuningGenerator:
         self.meta_remaining_volumes = []
         self.meta_price_depths = []
         self.remaining_depth = []
-        self.meta_trades = []
 
         if config:
             self.config = config
@@ -70,48 +332,123 @@ class TuningGenerator:
                     if x[2] > best_rate else best_rate / x[2],
                     self.meta_trade)))
 
-    def process_meta_trade(self) -> None:
+    @profile
+    def trades_price_depth(self) -> None:
+        """
+        Group the trades into meta trades, the trades sharing a ts and
+        side, and load the price depths and remaining volumes of each.
+        Within a meta trade the trades run from the best rate outwards,
+        ties in id order.
+        """
 
-        assert len(self.meta_trade) > 0
+        table = trade_table(self.trades)
 
-        logging.debug("meta_trade-before: %r", self.meta_trade)
+        if len(table) == 0:
+            return
 
-        self.meta_trade.sort(key=lambda x: x[2],
-                             reverse=not self.meta_trade[0][4])
+        ts = table["ts"]
+        buy = table["buy"]
+        rates = table["r"]
 
-        logging.debug("meta_trade-after: %r", self.meta_trade)
+        # By ts, then buy, then rate from the best, then id
+        order = np.lexsort(
+            (table["id"], np.where(buy, rates, -rates), buy, ts))
+        table = table[order]
 
-        self.meta_trades.append(self.meta_trade)
+        ts = table["ts"]
+        buy = table["buy"]
+        rates = table["r"]
 
-        self.load_trades_price_depths()
-        self.load_trades_volumes()
+        # First trade of each meta trade
+        starts = np.flatnonzero(np.concatenate(
+            ([True], (ts[1:] != ts[:-1]) | (buy[1:] != buy[:-1]))))
+        lengths = np.diff(np.append(starts, len(table)))
 
-    def trades_price_depth(self) -> None:
+        best_rate = np.repeat(rates[starts], lengths)
+        price_depths = np.where(
+            rates > best_rate, rates / best_rate, best_rate / rates)
+
+        volumes = np.minimum(
+            group_reverse_cumsum(rates * table["q"], starts, lengths),
+            self.config["inventoryLimit"])
+
+        self.trade_table = table
+        self.meta_trade_starts = starts
+
+        bounds = np.append(starts, len(table)).tolist()
+        price_depths = price_depths.tolist()
+        volumes = volumes.tolist()
+
+        self.meta_price_depths.extend(
+            price_depths[a:b] for a, b in zip(bounds[:-1], bounds[1:]))
+        self.meta_remaining_volumes.extend(
+            volumes[a:b] for a, b in zip(bounds[:-1], bounds[1:]))
 
-        # Preliminary sort by ts, id, and buy
-        self.trades.sort(key=lambda x: (x[0], x[4], x[1]))
+    @profile
+    def refresh(self, state_path: str, trades=None,
+                now: datetime = None) -> list:
+        """
+        get_values for a window config, kept up to date in the state at
+        state_path.  Only the trades since the last refresh are fetched
+        and grouped; meta trades that left the window are expired.  The
+        last saved ts is fetched again, since more of its trades may have
+        arrived.  Returns None when the window has no trades.
+        """
 
-        self.meta_trade = []
-        ref_trade = self.trades[0]
+        state = TuningState.load(state_path, self.price_depths, self.depths,
+                                 self.config["inventoryLimit"])
 
-        try:
-            for trade in self.trades:
+        if now == None:
+            now = datetime.now()
 
-                # New meta_trade?
-                if trade[0] != ref_trade[0] or trade[4] != ref_trade[4]:
+        window_start = now - timedelta(milliseconds=self.config["window"])
+        since = int(window_start.timestamp() * 1000)
 
-                    # Process the existing meta_trade and...
-                    self.process_meta_trade()
+        if len(state) > 0:
+            since = max(since, int(state.meta_ts.max()))
 
-                    # ...start again with an empty one
-                    self.meta_trade = []
-                    ref_trade = trade
+        if trades is None:
+            self.load_trades(since=datetime.fromtimestamp(since // 1000) +
+                             timedelta(milliseconds=since % 1000))
+        else:
+            trades = trade_table(trades)
+            self.load_trades(trades=trades[trades["ts"] >= since])
 
-                self.meta_trade.append(trade)
+        keep = (state.meta_ts >= int(window_start.timestamp() * 1000)) & \
+            (state.meta_ts < since)
 
-        finally:
-            # Handle the last meta_trade
-            self.process_meta_trade()
+        self.meta_price_depths = []
+        self.meta_remaining_volumes = []
+
+        if len(self.trades) > 0:
+
+            self.trades_price_depth()
+            self.load_remaining_price_depths()
+
+            starts = self.meta_trade_starts
+            meta_ts = self.trade_table["ts"][starts]
+            meta_buy = self.trade_table["buy"][starts]
+            meta_volume = np.array(
+                [max(x) for x in self.meta_remaining_volumes], dtype=float)
+            meta_remaining = np.array(self.remaining_price_depths,
+                                      dtype=float).T
+
+        else:
+            meta_ts = np.empty(0, dtype=np.int64)
+            meta_buy = np.empty(0, dtype=bool)
+            meta_volume = np.empty(0, dtype=float)
+            meta_remaining = np.empty((0, len(self.price_depths)))
+
+        logging.debug("Meta trades kept: %d, expired: %d, added: %d",
+                      keep.sum(), len(keep) - keep.sum(), len(meta_ts))
+
+        state.update(keep, meta_ts, meta_buy, meta_volume, meta_remaining)
+        state.save(state_path)
+
+        if len(state) == 0:
+            return None
+
+        return state.values()
 
     def load_total_volume(self):
         self.total_volume = sum(max(x) for x in self.meta_remaining_volumes)
@@ -131,29 +468,28 @@ class TuningGenerator:
         logging.debug("meta_price_depths:\n%r", self.meta_price_depths)
         logging.debug("price_depths:\n%r", self.price_depths)
 
-        self.remaining_price_depths = []
-
-        for price_depth in self.price_depths:
+        # Meta trades padded out to an (M, L) grid; valid marks real levels
+        meta_price_depths = pad(self.meta_price_depths, math.inf)
+        meta_remaining_volumes = pad(self.meta_remaining_volumes, 0.0)
+        valid = pad([[pd < math.inf for pd in x]
+                     for x in self.meta_price_depths], False)
 
-            tmp = []
+        rows = np.arange(len(meta_price_depths))
 
-            for idx_x, trade_price_depth in enumerate(self.meta_price_depths):
+        self.remaining_price_depths = []
 
-                found = False
-                best_trade_price_depth = math.inf
-                best_idx: int = 0
-                for idx, pd in enumerate(trade_price_depth):
-                    if price_depth <= pd and pd < best_trade_price_depth:
-                        best_trade_price_depth = pd
-                        best_idx = idx
-                        found = True
+        for price_depth in self.price_depths:
 
-                if found:
-                    tmp.append(self.meta_remaining_volumes[idx_x][best_idx])
-                else:
-                    tmp.append(0.0)
+            # The smallest trade price depth at or above price_depth; ties
+            # go to the first level, as argmin returns the first minimum
+            above = valid & (meta_price_depths >= price_depth)
+            best_idx = np.argmin(
+                np.where(above, meta_price_depths, math.inf), axis=1)
 
-            self.remaining_price_depths.append(tmp)
+            self.remaining_price_depths.append(np.where(
+                above.any(axis=1),
+                meta_remaining_volumes[rows, best_idx],
+                0.0).tolist())
 
     def get_values(self) -> None:
 
@@ -209,13 +545,16 @@ class TuningGenerator:
                                 math.log10(self.config["depthEnd"]),
                                 self.config["depthSamples"] - 1), 0, 0))
 
-    def load_trades(self, trades: list = None) -> None:
+    def load_trades(self, trades: list = None,
+                    since: datetime = None) -> None:
 
-        if trades == None:
+        if trades is None:
 
             # Retrieve trades from the database
 
-            if "window" in self.config:
+            if since != None:
+                ts_range = {"$gte": since}
+            elif "window" in self.config:
                 ts_range = {
                     "$gte":
                     datetime.now() -
@@ -227,29 +566,28 @@ class TuningGenerator:
                     "$lte": self.config["endTime"]
                 }
 
-            self.trades = list(mongodb["history"]["bittrex-v1-trades"].find(
-                filter={
+            self.trades = load_trade_table(
+                mongodb["history"]["bittrex-v1-trades"],
+                {
                     "e": self.config["envId"],
                     "x": self.config["exchange"],
                     "m": self.config["market"],
                     "ts": ts_range
-                }).sort("ts", 1))
-
-            # Extract salient fields from each trade
-            self.trades = [[
-                int(t["ts"].timestamp() * 1000), t["id"], t["r"], t["q"],
-                t["buy"]
-            ] for t in self.trades]
-
-            logging.error("First trade: %r", self.trades[0])
-            logging.error("Last trade: %r", self.trades[-1])
-
-            logging.error(
-                datetime.utcfromtimestamp(self.trades[0][0] /
-                                          1000).strftime('%Y-%m-%d %H:%M:%S'))
-            logging.error(
-                datetime.utcfromtimestamp(self.trades[-1][0] /
-                                          1000).strftime('%Y-%m-%d %H:%M:%S'))
+                },
+                batch_size=self.config.get("batchSize", 10000),
+                raw=self.config.get("rawBson", False))
+
+            if len(self.trades) > 0:
+
+                logging.error("First trade: %r", self.trades[0])
+                logging.error("Last trade: %r", self.trades[-1])
+
+                logging.error(
+                    datetime.utcfromtimestamp(self.trades[0]["ts"] /
+                                              1000).strftime('%Y-%m-%d %H:%M:%S'))
+                logging.error(
+                    datetime.utcfromtimestamp(self.trades[-1]["ts"] /
+                                              1000).strftime('%Y-%m-%d %H:%M:%S'))
         else:
             self.trades = trades
 
@@ -261,46 +599,55 @@ class TuningGenerator:
         self.config = config_collection.find_one({"name": configName})
 
 
-def save_tuning(config: dict, tuning: dict) -> None:
+def output_name(config: dict) -> dict:
 
     if not "output" in config or config["output"] is None:
-        output_name = {"name": config["name"]}
-    else:
-        output_name = {"name": config["output"]}
+        return {"name": config["name"]}
 
-    # Delete existing if one existing
-    config_db["tuning"].delete_one(output_name)
+    return {"name": config["output"]}
 
-    document = {"$set": {**output_name, **tuning}}
 
-    config_db["tuning"].update_one(output_name, document, upsert=True)
+def tuning_upsert(config: dict, tuning: dict) -> ReplaceOne:
+    """Replaces the config's tuning document, creating it if need be"""
 
+    name = output_name(config)
 
-if __name__ == '__main__':
+    return ReplaceOne(name, {**name, **tuning}, upsert=True)
 
-    logging.basicConfig(format='[%(levelname)-5s] %(message)s',
-                        level=logging.ERROR,
-                        datefmt='')
 
-    logging.debug(f'sys.argv: {sys.argv}')
+def save_tuning(config: dict, tuning: dict) -> None:
+    config_db["tuning"].bulk_write([tuning_upsert(config, tuning)])
 
-    assert os.environ['MONGODB'], 'MONGODB Not Defined'
-    mongodb = MongoClient(os.environ['MONGODB'])
-    config_db = mongodb["configuration"]
 
-    tg = TuningGenerator(configName=sys.argv[1])
-    tg.load_trades()
+def generate_tuning(configName: str) -> tuple:
+    """
+    The named config and its tuning, or None for the tuning when there
+    are no trades.  Window configs with a statePath are refreshed
+    incrementally.
+    """
 
-    if len(tg.trades) == 0:
-        logging.debug("(%s) No Trades!", sys.argv[1])
-        exit(0)
+    tg = TuningGenerator(configName=configName)
+
+    if "window" in tg.config and tg.config.get("statePath"):
 
-    logging.debug("(%s) Trades Count: %d", sys.argv[1], len(tg.trades))
-    logging.debug(tg.trades)
+        values = tg.refresh(tg.config["statePath"])
 
-    values = tg.get_values()
+    else:
+
+        tg.load_trades()
+
+        if len(tg.trades) == 0:
+            values = None
+        else:
+            logging.debug("(%s) Trades Count: %d", configName,
+                          len(tg.trades))
+            values = tg.get_values()
+
+    if values == None:
+        logging.debug("(%s) No Trades!", configName)
+        return tg.config, None
 
-    tuning = {
+    return tg.config, {
         "price_depths": tg.price_depths,
         "depths": tg.depths,
         "values": values,
@@ -310,6 +657,35 @@ if __name__ == '__main__':
         #"metaRemainingVolumes": tg.meta_remaining_volumes,
     }
 
-    save_tuning(tg.config, tuning)
+
+def connect() -> MongoClient:
+    """Connect the module to $MONGODB"""
+
+    global mongodb
+    global config_db
+
+    assert os.environ['MONGODB'], 'MONGODB Not Defined'
+    mongodb = MongoClient(os.environ['MONGODB'])
+    config_db = mongodb["configuration"]
+
+    return mongodb
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(format='[%(levelname)-5s] %(message)s',
+                        level=logging.ERROR,
+                        datefmt='')
+
+    logging.debug(f'sys.argv: {sys.argv}')
+
+    connect()
+
+    config, tuning = generate_tuning(sys.argv[1])
+
+    if tuning == None:
+        exit(0)
+
+    save_tuning(config, tuning)
 
     print("That's All Folks")
@@ -37,6 +37,26 @@ const simSchema = {
             "type": "boolean",
             "default": true,
         },
+        "batchTrades": {
+            "type": "boolean",
+            "default": false,
+        },
+        "saveCache": {
+            "type": "boolean",
+            "default": false,
+        },
+        "redisPipelineBooks": {
+            "type": "number",
+            "default": 100,
+        },
+        "redisPacked": {
+            "type": "boolean",
+            "default": false,
+        },
+        "useCheckpoints": {
+            "type": "boolean",
+            "default": false,
+        },
     },
     "required": [
         "name",
@@ -61,6 +81,11 @@ export interface SimConfiguration {
     readonly parallelSimulations: number;
     readonly onlyOrderbooksWithTrades: boolean;
     readonly saveRedis: boolean;
+    readonly batchTrades: boolean;
+    readonly saveCache: boolean;
+    readonly redisPipelineBooks: number;
+    readonly redisPacked: boolean;
+    readonly useCheckpoints: boolean;
     readonly multiplyConfig: MultiplyConfig;
     multiplyConfigParams: string;
 }
@@ -104,7 +104,12 @@ const start = async (
                     envId: configGenerator.config!.envId,
                     trim: configGenerator.config!.trim,
                     onlyOrderbooksWithTrades: configGenerator.config!.onlyOrderbooksWithTrades,
-                    saveRedis: configGenerator.config!.saveRedis
+                    saveRedis: configGenerator.config!.saveRedis,
+                    batchTrades: configGenerator.config!.batchTrades,
+                    saveCache: configGenerator.config!.saveCache,
+                    redisPipelineBooks: configGenerator.config!.redisPipelineBooks,
+                    redisPacked: configGenerator.config!.redisPacked,
+                    useCheckpoints: configGenerator.config!.useCheckpoints,
                 }, ...loadConfig
             }
 
@@ -35,6 +35,26 @@ const simSchema = {
             "type": "boolean",
             "default": true,
         },
+        "batchTrades": {
+            "type": "boolean",
+            "default": false,
+        },
+        "saveCache": {
+            "type": "boolean",
+            "default": false,
+        },
+        "redisPipelineBooks": {
+            "type": "number",
+            "default": 100,
+        },
+        "redisPacked": {
+            "type": "boolean",
+            "default": false,
+        },
+        "useCheckpoints": {
+            "type": "boolean",
+            "default": false,
+        },
     },
     "required": [
         "name",